@@ -17,6 +17,7 @@ from ._experiment_controller import ExperimentController, get_keyboard_input
 from ._eyelink_controller import EyelinkController
 from ._sound_controllers import SoundCardController
 from ._trigger_controllers import (decimals_to_binary, binary_to_decimals,
+                                   decimals_to_triggers, triggers_to_decimals,
                                    ParallelTrigger)
 from ._tdt_controller import TDTController
 from . import analyze
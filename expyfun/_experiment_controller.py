@@ -14,30 +14,64 @@ import sys
 import warnings
 from os import path as op
 from functools import partial
+import hashlib
 import traceback as tb
 import string
 
 import numpy as np
 
 from ._utils import (get_config, verbose_dec, _check_pyglet_version,
-                     running_rms, _sanitize, logger, ZeroClock, date_str,
+                     _max_running_rms, _sanitize, logger, ZeroClock, date_str,
                      check_units, set_log_file, flush_logger, _TempDir,
                      string_types, _fix_audio_dims, input, _get_args,
-                     _get_display, _wait_secs)
+                     _get_display, _wait_secs, _AsyncWriter, text_type,
+                     _LRUCache)
 from ._tdt_controller import TDTController
-from ._trigger_controllers import ParallelTrigger
+from ._trigger_controllers import ParallelTrigger, _binary_to_triggers
 from ._sound_controllers import (SoundPlayer, SoundCardController,
                                  _AUTO_BACKENDS)
 from ._input_controllers import Keyboard, CedrusBox, Mouse, Joystick
+from ._timing import _FrameMonitor, _Profiler
+from ._resample import resample
 from .visual import Text, Rectangle, Video, _convert_color
+from .io._binary import _BinaryTabWriter
 from ._git import assert_version, __version__
 
+# Methods whose timing is recorded by ec.set_profiling
+_PROFILED_METHODS = ('load_buffer', 'load_timeline', '_validate_audio',
+                     'start_stimulus', 'flip', 'stamp_triggers',
+                     'identify_trial', 'trial_ok', 'wait_secs', 'wait_until',
+                     'wait_one_press', 'wait_for_presses', 'wait_one_click',
+                     'wait_for_clicks', 'wait_for_click_on')
+
 # Note: ec._trial_progress has three values:
 # 1. 'stopped', which ec.identify_trial turns into...
 # 2. 'identified', which ec.start_stimulus turns into...
 # 3. 'started', which ec.trial_ok turns into 'stopped'.
 
 
+class PreparedBuffer(object):
+    """Audio data that is ready to be loaded by an ExperimentController.
+
+    Use :meth:`ExperimentController.prepare_buffer` to create one.
+    """
+
+    def __init__(self, samples, scaler, ec):
+        samples.flags.writeable = False
+        self._samples = samples
+        self._scaler = scaler
+        self._ec_id = id(ec)
+
+    def __repr__(self):
+        return ('<PreparedBuffer : %d samples, %d channels>'
+                % self._samples.shape)
+
+    @property
+    def samples(self):
+        """The (read-only) samples, with shape (n_samples, n_channels)."""
+        return self._samples
+
+
 class ExperimentController(object):
     """Interface for hardware control (audio, buttonbox, eye tracker, etc.)
 
@@ -106,7 +140,8 @@ class ExperimentController(object):
         default); see `set_rms_checking` for details.
     suppress_resamp : bool
         If ``True``, will suppress resampling of stimuli to the sampling
-        frequency of the sound output device.
+        frequency of the sound output device. Otherwise
+        :func:`expyfun.stimuli.resample` is used.
     version : str | None
         A length-7 string passed to ``expyfun.assert_version()`` to ensure that
         the expected version of the expyfun codebase is being used when running
@@ -127,6 +162,17 @@ class ExperimentController(object):
         The trigger duration to use (sec). Must be 0.01 for TDT.
     joystick : bool
         Whether or not to enable joystick control.
+    binary_log : bool
+        If True, also write a compact binary copy of the data file next to
+        the ``.tab`` file, which can be loaded quickly with
+        :func:`expyfun.io.read_tab_binary`.
+    async_write : bool
+        If True, data lines are queued and written to disk by a background
+        thread, which flushes them at the end of each trial (see
+        `trial_ok`), when many lines are pending, or when lines have been
+        pending for one second. This keeps file I/O out of time-critical
+        calls such as `flip`. Queued lines are written when the
+        ExperimentController is closed.
     verbose : bool, str, int, or None
         If not None, override default verbose level (see expyfun.verbose).
 
@@ -149,7 +195,8 @@ class ExperimentController(object):
                  monitor=None, trigger_controller=None, session=None,
                  check_rms='windowed', suppress_resamp=False, version=None,
                  enable_video=False, safe_flipping=None, n_channels=2,
-                 trigger_duration=0.01, joystick=False, verbose=None):
+                 trigger_duration=0.01, joystick=False, binary_log=False,
+                 async_write=False, verbose=None):
         # initialize some values
         self._stim_fs = stim_fs
         self._stim_rms = stim_rms
@@ -169,6 +216,13 @@ class ExperimentController(object):
         self._id_call_dict = dict(ec_id=self._stamp_ec_id)
         self._ac = None
         self._data_file = None
+        self._binary_file = None
+        self._writer = None
+        self._frame_monitor = None
+        self._profiler = None
+        self._buffer_cache = _LRUCache(256 * 1024 * 1024)
+        self._trace_fname = None
+        self._timeline_triggers = []  # (offset, code) pairs in the buffer
         self._clock = ZeroClock()
         self._master_clock = self._clock.get_time
 
@@ -246,10 +300,17 @@ class ExperimentController(object):
                 # initialize data file
                 self._data_file = open(self._output_dir + '.tab', 'a')
                 self._extra_cleanup_fun.append(self.flush)  # flush
-                self._extra_cleanup_fun.append(self._data_file.close)  # close
+                self._extra_cleanup_fun.append(self._close_data_files)
                 self._extra_cleanup_fun.append(closer)  # un-set log file
-                self._data_file.write('# ' + json.dumps(self._exp_info) + '\n')
+                header = '# ' + json.dumps(self._exp_info) + '\n'
+                self._data_file.write(header)
                 self.write_data_line('event', 'value', 'timestamp')
+                if binary_log:
+                    self._binary_file = _BinaryTabWriter(self._output_dir,
+                                                         header)
+                if async_write:
+                    self._writer = _AsyncWriter(self._write_data_line,
+                                                self._flush_data_files)
             logger.info('Expyfun: Using version %s (requested %s)'
                         % (__version__, version))
 
@@ -367,8 +428,8 @@ class ExperimentController(object):
                             'suppress_resamp is "True"')
                 else:
                     msg += ('Experiment Controller will resample for you, but '
-                            'this takes a non-trivial amount of processing '
-                            'time and may compromise your experimental '
+                            'this takes some processing time when loading '
+                            'each buffer and may compromise your experimental '
                             'timing and/or cause artifacts.')
                 logger.warning(msg)
 
@@ -672,7 +733,10 @@ class ExperimentController(object):
         -----
         Order of operations is: screen flip (optional), audio start, then
         (only if ``flip=True``) additional functions added with
-        `call_on_next_flip` and `call_on_every_flip`.
+        `call_on_next_flip` and `call_on_every_flip`. If triggers stamped
+        with ``block=False`` (e.g., by `identify_trial`) are still being
+        stamped, this first waits for them (and logs a warning), so that
+        they do not overlap the onset trigger.
         """
         if start_of_trial:
             if self._trial_progress != 'identified':
@@ -681,6 +745,7 @@ class ExperimentController(object):
             self._trial_progress = 'started'
         extra = 'flipping screen and ' if flip else ''
         logger.exp('Expyfun: Starting stimuli: {0}playing audio'.format(extra))
+        self._wait_for_triggers()
         # ensure self._play comes first in list, followed by other critical
         # private functions (e.g., EL stamping), then user functions:
         if flip:
@@ -1006,6 +1071,8 @@ class ExperimentController(object):
         if self.safe_flipping:
             # On NVIDIA Linux these calls cause a 2x delay (33ms instead of 16)
             gl.glFinish()
+        if self._frame_monitor is not None:
+            swap_time = self.get_time()
         self._win.flip()
         # this waits until everything is called, including last draw
         gl.glClear(gl.GL_COLOR_BUFFER_BIT)
@@ -1019,6 +1086,9 @@ class ExperimentController(object):
         flip_time = self.get_time()
         for function in call_list:
             function()
+        if self._frame_monitor is not None:
+            self._frame_monitor.add(flip_time, flip_time - swap_time,
+                                    self.get_time() - flip_time)
         self.write_data_line('flip', flip_time)
         self._on_next_flip = []
         return flip_time
@@ -1044,6 +1114,131 @@ class ExperimentController(object):
         times = [self.flip() for _ in range(n_rep)]
         return 1. / np.median(np.diff(times[1:]))
 
+    def set_frame_monitoring(self, monitor=True, screen_fs=None,
+                             buffer_size=1000):
+        """Set frame timing monitoring.
+
+        Parameters
+        ----------
+        monitor : bool
+            If True, record the flip-to-flip interval, the buffer swap
+            duration, and the time spent in `call_on_next_flip` and
+            `call_on_every_flip` functions for each `flip`, and log a
+            warning whenever frames are dropped. A summary of each trial
+            (see `get_frame_stats`) is written to the data file as a
+            ``'frame_timing'`` line when `trial_ok` is called. If False,
+            stop monitoring.
+        screen_fs : float | None
+            The screen refresh rate to check intervals against. If None,
+            it is measured using `estimate_screen_fs`.
+        buffer_size : int
+            Number of flips to keep measurements for.
+
+        See Also
+        --------
+        ExperimentController.get_frame_stats
+
+        Notes
+        -----
+        Any interval between flips longer than 1.5 refresh periods is
+        counted as late, so monitoring should be enabled only during
+        periods of continuous flipping (e.g., animations or videos).
+        """
+        self._frame_monitor = None
+        if monitor:
+            if screen_fs is None:
+                screen_fs = self.estimate_screen_fs()
+            self._frame_monitor = _FrameMonitor(screen_fs, buffer_size)
+            logger.info('Expyfun: Monitoring frame timing at %0.2f Hz'
+                        % (self._frame_monitor.screen_fs,))
+
+    def get_frame_stats(self, scope='trial'):
+        """Get frame timing statistics.
+
+        Parameters
+        ----------
+        scope : str
+            If ``'trial'``, summarize the flips since the last `trial_ok`.
+            If ``'buffer'``, summarize all flips still in the buffer.
+
+        Returns
+        -------
+        stats : dict
+            The number of flip intervals (``'n_intervals'``), the number of
+            late intervals (``'n_late'``) and dropped frames
+            (``'n_dropped'``), the histogram of intervals measured in
+            refresh periods (``'hist'``, with bins for 1, 2, 3, and 4 or
+            more periods), and the 50th, 95th, and 99th percentiles and
+            the maximum (e.g., ``'interval_p95'`` or ``'swap_max'``) of the
+            flip ``'interval'``, the ``'swap'`` duration, and the
+            ``'callback'`` duration (all in seconds).
+
+        See Also
+        --------
+        ExperimentController.set_frame_monitoring
+        """
+        if self._frame_monitor is None:
+            raise RuntimeError('Frame monitoring is not enabled, use '
+                               'set_frame_monitoring')
+        return self._frame_monitor.get_stats(scope)
+
+    def set_profiling(self, profile=True, trace_fname=None):
+        """Set profiling of the trial-related methods.
+
+        Parameters
+        ----------
+        profile : bool
+            If True, record the wall-clock and CPU duration of each call to
+            `load_buffer`, `start_stimulus`, `flip`, `stamp_triggers`,
+            `identify_trial`, `trial_ok`, the ``wait_*`` methods, and the
+            internal audio validation. A per-method report is logged when
+            the ExperimentController is closed. If False, stop profiling
+            and discard the recorded calls.
+        trace_fname : str | None
+            If not None, the filename to write the recorded calls to in
+            Chrome trace format (viewable in ``chrome://tracing``) when
+            the ExperimentController is closed.
+
+        See Also
+        --------
+        ExperimentController.get_profiling_stats
+        """
+        if self._profiler is not None:
+            self._profiler.remove()
+            self._profiler = None
+        if profile:
+            self._profiler = _Profiler(self, _PROFILED_METHODS,
+                                       self._clock._start_time)
+        self._trace_fname = trace_fname
+
+    def get_profiling_stats(self):
+        """Get profiling statistics of the trial-related methods.
+
+        Returns
+        -------
+        stats : dict
+            For each method, a dict with the number of calls
+            (``'n_calls'``), and the 50th and 95th percentiles, maximum,
+            and total of the wall-clock and CPU durations (e.g.,
+            ``'wall_p95'`` or ``'cpu_total'``) in seconds.
+
+        See Also
+        --------
+        ExperimentController.set_profiling
+        """
+        if self._profiler is None:
+            raise RuntimeError('Profiling is not enabled, use set_profiling')
+        return self._profiler.get_stats()
+
+    def _end_profiling(self):
+        """Report profiling results and restore the original methods."""
+        if self._profiler is not None:
+            logger.info('Expyfun: Profiling report (ms):\n%s'
+                        % (self._profiler.get_report(),))
+            if self._trace_fname is not None:
+                self._profiler.write_trace(self._trace_fname)
+            self.set_profiling(False)
+
     def set_visible(self, visible=True, flip=True):
         """Set the window visibility
 
@@ -1636,13 +1831,16 @@ class ExperimentController(object):
 
         Parameters
         ----------
-        samples : np.array
+        samples : np.array | instance of PreparedBuffer
             Audio data as floats scaled to (-1,+1), formatted as numpy array
-            with shape (1, N), (2, N), or (N,) dtype float32.
+            with shape (1, N), (2, N), or (N,) dtype float32. Can also be
+            the output of `prepare_buffer`, which avoids repeating the
+            validation and scaling steps.
 
         See Also
         --------
         ExperimentController.play
+        ExperimentController.prepare_buffer
         ExperimentController.set_stim_db
         ExperimentController.start_stimulus
         ExperimentController.stop
@@ -1650,11 +1848,117 @@ class ExperimentController(object):
         if self._playing:
             raise RuntimeError('Previous audio must be stopped before loading '
                                'the buffer')
-        samples = self._validate_audio(samples)
-        samples *= self._stim_scaler
+        if isinstance(samples, PreparedBuffer):
+            if samples._ec_id != id(self):
+                raise ValueError('PreparedBuffer was created by a different '
+                                 'ExperimentController')
+            if samples._scaler == self._stim_scaler:
+                samples = samples._samples
+            else:  # stim_db changed since it was prepared
+                samples = samples._samples * np.float32(
+                    self._stim_scaler / samples._scaler)
+        else:
+            samples = self._validate_audio(samples)
+            samples *= self._stim_scaler
         logger.exp('Expyfun: Loading {} samples to buffer'
                    ''.format(samples.size))
         self._ac.load_buffer(samples)
+        self._timeline_triggers = []
+
+    def load_timeline(self, timeline):
+        """Load audio and trigger codes from a timeline into the audio buffer
+
+        Parameters
+        ----------
+        timeline : instance of expyfun.stimuli.Timeline
+            The timeline, with sample offsets at ``stim_fs``.
+
+        See Also
+        --------
+        ExperimentController.load_buffer
+        ExperimentController.start_stimulus
+        expyfun.stimuli.Timeline
+
+        Notes
+        -----
+        This requires the sound card to be used for audio with at least one
+        trigger channel (``SOUND_CARD_TRIGGER_CHANNELS``). The audio and the
+        trigger codes are rendered into a single buffer, so the triggers are
+        sample-locked to the audio, and no triggers need to be stamped during
+        playback. As with `load_buffer`, a trigger ``1`` is encoded at the
+        first sample. Triggers (including this one) must be at least twice
+        ``trigger_duration`` apart, so that each has an off period. Each
+        time the buffer is played, the timeline trigger codes are written to
+        the data file as ``'trigger'`` lines, with timestamps computed from
+        their offsets.
+        """
+        if self._playing:
+            raise RuntimeError('Previous audio must be stopped before loading '
+                               'the buffer')
+        if not isinstance(self._ac, SoundCardController) or \
+                self._ac._n_channels_stim == 0:
+            raise RuntimeError('Loading a timeline requires the sound card '
+                               'with SOUND_CARD_TRIGGER_CHANNELS > 0')
+        if not np.allclose(timeline.fs, self.stim_fs, rtol=0, atol=0.5):
+            raise ValueError('timeline.fs (%s) must match stim_fs (%s)'
+                             % (timeline.fs, self.stim_fs))
+        samples = self._validate_audio(timeline.render())
+        samples *= self._stim_scaler
+        ratio = 1.
+        if self._fs_mismatch and not self._suppress_resamp:
+            ratio = self.fs / self.stim_fs
+        triggers = [(0, 1)] + [(int(round(offset * ratio)), code)
+                               for offset, code in timeline.triggers]
+        logger.exp('Expyfun: Loading {} samples and {} triggers to buffer'
+                   ''.format(samples.size, len(triggers)))
+        self._ac.load_buffer(samples, triggers)
+        self._timeline_triggers = triggers[1:]
+
+    def prepare_buffer(self, samples, cache=True):
+        """Validate, resample, check, and scale audio data for playback
+
+        Parameters
+        ----------
+        samples : np.array
+            Audio data (see `load_buffer`).
+        cache : bool
+            If True, keep the result in a least-recently-used cache keyed by
+            the content of ``samples``, so that preparing identical data
+            again returns the cached buffer.
+
+        Returns
+        -------
+        buffer : instance of PreparedBuffer
+            The prepared data, which can be passed to `load_buffer`
+            repeatedly without being copied or checked again.
+
+        See Also
+        --------
+        ExperimentController.load_buffer
+
+        Notes
+        -----
+        The cache holds at most 256 MB of prepared data. If the stimulus
+        level is changed with `set_stim_db` after preparation, the samples
+        are rescaled (with a copy) when loaded.
+        """
+        if isinstance(samples, PreparedBuffer):
+            return samples
+        key = None
+        if cache:
+            samples = np.ascontiguousarray(samples)
+            if samples.dtype.kind in 'biuf':
+                key = (samples.dtype.str, samples.shape,
+                       hashlib.sha1(samples).hexdigest())
+                buffer = self._buffer_cache.get(key)
+                if buffer is not None:
+                    return buffer
+        data = self._validate_audio(samples)
+        data *= self._stim_scaler
+        buffer = PreparedBuffer(data, self._stim_scaler, self)
+        if key is not None:
+            self._buffer_cache.put(key, buffer, data.nbytes)
+        return buffer
 
     def play(self):
         """Start audio playback
@@ -1672,10 +1976,18 @@ class ExperimentController(object):
         ExperimentController.stop
         """
         logger.exp('Expyfun: Playing audio')
+        self._wait_for_triggers()
         # ensure self._play comes first in list:
         self._play()
         return self.get_time()
 
+    def _wait_for_triggers(self):
+        """Wait for non-blocking trigger stamps to finish before playing."""
+        waited = self._tc._wait_for_triggers()
+        if waited > 1e-3:
+            logger.warning('Expyfun: Waited %0.1f ms for triggers to be '
+                           'stamped before starting audio' % (1000 * waited,))
+
     def _play(self):
         """Play the audio buffer.
         """
@@ -1683,7 +1995,11 @@ class ExperimentController(object):
             raise RuntimeError('Previous audio must be stopped before playing')
         self._ac.play()
         logger.debug('Expyfun: started audio')
-        self.write_data_line('play')
+        play_time = self._master_clock()
+        self.write_data_line('play', timestamp=play_time)
+        for offset, code in self._timeline_triggers:
+            self.write_data_line('trigger', code,
+                                 play_time + offset / float(self.fs))
 
     @property
     def _playing(self):
@@ -1783,22 +2099,16 @@ class ExperimentController(object):
         # resample if needed
         if self._fs_mismatch and not self._suppress_resamp:
             logger.warning('Expyfun: Resampling {} seconds of audio'
-                           ''.format(round(len(samples) / self.stim_fs), 2))
-            from mne.filter import resample
-            samples = resample(
-                samples.astype(np.float64), self.fs, self.stim_fs,
-                axis=0).astype(np.float32)
+                           ''.format(round(len(samples) / self.stim_fs, 2)))
+            samples = resample(samples, self.stim_fs, self.fs, axis=0)
 
         # check RMS
         if self._check_rms is not None:
-            chans = [samples[:, x] for x in range(samples.shape[1])]
             if self._check_rms == 'wholefile':
-                chan_rms = [np.sqrt(np.mean(x ** 2)) for x in chans]
-                max_rms = max(chan_rms)
+                max_rms = np.sqrt(np.mean(samples ** 2, axis=0)).max()
             else:  # 'windowed'
                 win_length = int(self.fs * 0.01)  # 10ms running window
-                chan_rms = [running_rms(x, win_length) for x in chans]
-                max_rms = max([max(x) for x in chan_rms])
+                max_rms = _max_running_rms(samples.T, win_length).max()
             if max_rms > 2 * self._stim_rms:
                 warn_string = ('Expyfun: Stimulus max RMS ({}) exceeds stated '
                                'RMS ({}) by more than 6 dB.'
@@ -1875,20 +2185,32 @@ class ExperimentController(object):
 
         Notes
         -----
-        Writing a data line does not cause the file to be flushed.
+        If ``async_write=True`` was used, the line is only queued here
+        and written to disk by a background thread.
         """
         if timestamp is None:
             timestamp = self._master_clock()
-        ll = '\t'.join(_sanitize(x) for x in [timestamp, event_type,
-                                              value]) + '\n'
-        if self._data_file is not None:
-            if self._data_file.closed:
-                logger.warning('Data line not written due to closed file %s:\n'
-                               '%s' % (self.data_fname, ll[:-1]))
-            else:
-                self._data_file.write(ll)
+        if self._writer is not None:
+            # capture the current state of mutable values
+            if not isinstance(value, (string_types, int, float, type(None))):
+                value = text_type(value)
+            self._writer.put(timestamp, event_type, value)
+        elif self._data_file is not None:
+            self._write_data_line(timestamp, event_type, value)
             self.flush()
 
+    def _write_data_line(self, timestamp, event_type, value):
+        """Write a line of data to the data file(s)."""
+        items = [_sanitize(x) for x in [timestamp, event_type, value]]
+        ll = '\t'.join(items) + '\n'
+        if self._data_file.closed:
+            logger.warning('Data line not written due to closed file %s:\n'
+                           '%s' % (self.data_fname, ll[:-1]))
+        else:
+            self._data_file.write(ll)
+            if self._binary_file is not None:
+                self._binary_file.write(timestamp, items[1], items[2])
+
     def _get_time_correction(self, clock_type):
         """Clock correction (sec) for different devices (screen, bbox, etc.)
         """
@@ -2014,6 +2336,10 @@ class ExperimentController(object):
                                'did you call ec.start_stimulus?')
         if self._playing:
             logger.warning('ec.trial_ok called before stimulus had stopped')
+        if self._frame_monitor is not None:
+            self.write_data_line('frame_timing', json.dumps(
+                self._frame_monitor.get_stats()))
+            self._frame_monitor.new_trial()
         for func in self._on_trial_ok:
             func()
         logger.exp('Expyfun: Trial OK')
@@ -2023,22 +2349,25 @@ class ExperimentController(object):
         """Stamp id -- currently anything allowed"""
         self.write_data_line('trial_id', id_)
 
-    def _stamp_binary_id(self, id_, wait_for_last=True):
+    def _stamp_binary_id(self, id_, wait_for_last=True, block=True):
         """Helper for ec to stamp a set of IDs using binary controller
 
         This makes TDT and parallel port give the same output. Eventually
         we may want to customize it so that parallel could work differently,
         but for now it's unified. ``delay`` is the inter-trigger delay.
+        ``block=False`` (e.g., ``ttl_id=dict(id_=id_, block=False)``) lets
+        the parallel port or sound card stamp the ID in the background.
         """
         if not isinstance(id_, (list, tuple, np.ndarray)):
             raise TypeError('id must be array-like')
         id_ = np.array(id_)
         if not np.all(np.in1d(id_, [0, 1])):
             raise ValueError('All values of id must be 0 or 1')
-        id_ = (id_.astype(int) + 1) << 2  # 0, 1 -> 4, 8
-        self._stamp_ttl_triggers(id_, wait_for_last)
+        id_ = _binary_to_triggers(id_)  # 0, 1 -> 4, 8
+        self._stamp_ttl_triggers(id_, wait_for_last, block)
 
-    def stamp_triggers(self, ids, check='binary', wait_for_last=True):
+    def stamp_triggers(self, ids, check='binary', wait_for_last=True,
+                       block=True):
         """Stamp binary values
 
         Parameters
@@ -2051,11 +2380,22 @@ class ExperimentController(object):
             1 and 15.
         wait_for_last : bool
             If True, wait for last trigger to be stamped before returning.
+        block : bool
+            If False, return without waiting for the triggers to be stamped
+            (when triggering with the parallel port or the sound card).
+
+        Returns
+        -------
+        future : instance of concurrent.futures.Future
+            Completion handle, whose result is set once the triggers have
+            been stamped.
 
         Notes
         -----
         This may be (nearly) instantaneous, or take a while, depending
         on the type of triggering (TDT, sound card, or parallel).
+        Triggers are always stamped in the order they were requested, and
+        `start_stimulus` and `play` wait for non-blocking stamps to finish.
 
         See Also
         --------
@@ -2071,18 +2411,48 @@ class ExperimentController(object):
             if not all(id_ in _vals for id_ in ids):
                 raise ValueError('with check="binary", ids must all be '
                                  '1, 2, 4, or 8: {0}'.format(ids))
-        self._stamp_ttl_triggers(ids, wait_for_last)
+        return self._stamp_ttl_triggers(ids, wait_for_last, block)
 
-    def _stamp_ttl_triggers(self, ids, wait_for_last):
+    def _stamp_ttl_triggers(self, ids, wait_for_last, block=True):
         logger.exp('Stamping TTL triggers: %s', ids)
-        self._tc.stamp_triggers(ids, wait_for_last=wait_for_last)
-        self.flush()
+        future = self._tc.stamp_triggers(ids, wait_for_last=wait_for_last,
+                                         block=block)
+        self._flush(wait=False)
+        return future
 
     def flush(self):
-        """Flush logs and data files."""
+        """Flush logs and data files.
+
+        Notes
+        -----
+        If ``async_write=True`` was used, this waits until all queued data
+        lines have been written and flushed.
+        """
+        self._flush(wait=True)
+
+    def _flush(self, wait):
+        """Flush logs and data files, optionally without waiting."""
         flush_logger()
+        if self._writer is not None:
+            self._writer.commit(wait=wait)
+        else:
+            self._flush_data_files()
+
+    def _flush_data_files(self):
+        """Flush the data file(s)."""
         if self._data_file is not None and not self._data_file.closed:
             self._data_file.flush()
+        if self._binary_file is not None:
+            self._binary_file.flush()
+
+    def _close_data_files(self):
+        """Write any queued data lines and close the data file(s)."""
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            writer.close()
+        self._data_file.close()
+        if self._binary_file is not None:
+            self._binary_file.close()
 
     def close(self):
         """Close all connections in experiment controller.
@@ -2104,7 +2474,8 @@ class ExperimentController(object):
         cleanup_actions = []
         if hasattr(self, '_win'):
             cleanup_actions.append(self._win.close)
-        cleanup_actions.extend([self.stop_noise, self.stop])
+        cleanup_actions.extend([self.stop_noise, self.stop,
+                                self._end_profiling])
         cleanup_actions.extend(self._extra_cleanup_fun)
         cleanup_actions.append(self.flush)  # probably shouldn't be necessary
         for action in cleanup_actions:
@@ -1,5 +1,6 @@
 # Prefer newest SciPy interface
 try:
-    from scipy.fft import rfft, irfft, rfftfreq  # noqa
+    from scipy.fft import rfft, irfft, rfftfreq, next_fast_len  # noqa
 except ImportError:
     from numpy.fft import rfft, irfft, rfftfreq  # noqa
+    from scipy.fftpack import next_fast_len  # noqa
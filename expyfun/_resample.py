@@ -0,0 +1,186 @@
+"""Polyphase resampling"""
+
+# License: BSD (3-clause)
+
+from fractions import Fraction
+
+import numpy as np
+from scipy.signal import firwin, upfirdn
+
+from ._utils import _LRUCache
+
+# (up, down) -> (read-only float32 filter, half length), at most 64 MB
+_filter_cache = _LRUCache(64 * 1024 * 1024)
+
+
+def _get_ratio(fs_in, fs_out):
+    """Get the (up, down) integer resampling factors."""
+    fs_in, fs_out = float(fs_in), float(fs_out)
+    if fs_in <= 0 or fs_out <= 0:
+        raise ValueError('sample rates must be positive, got %s and %s'
+                         % (fs_in, fs_out))
+    ratio = (Fraction(fs_out) / Fraction(fs_in)).limit_denominator(2 ** 16)
+    return ratio.numerator, ratio.denominator
+
+
+def _get_filter(up, down):
+    """Get the (cached) anti-aliasing filter for a resampling ratio."""
+    key = (up, down)
+    out = _filter_cache.get(key)
+    if out is None:
+        max_rate = max(up, down)
+        if max_rate == 1:
+            half_len, h = 0, np.ones(1)
+        else:
+            # same design as scipy.signal.resample_poly
+            half_len = 10 * max_rate
+            h = firwin(2 * half_len + 1, 1. / max_rate,
+                       window=('kaiser', 5.0)) * up
+        h = h.astype(np.float32)
+        h.flags.writeable = False
+        out = (h, half_len)
+        _filter_cache.put(key, out, h.nbytes)
+    return out
+
+
+class Resampler(object):
+    """Resample a signal, optionally in consecutive blocks.
+
+    Parameters
+    ----------
+    fs_in : float
+        The sample rate of the input.
+    fs_out : float
+        The desired output sample rate.
+
+    See Also
+    --------
+    resample
+
+    Notes
+    -----
+    A polyphase windowed-sinc FIR filter is used. Filters are cached per
+    resampling ratio, so creating many resamplers for the same pair of
+    sample rates is cheap. The ratio ``fs_out / fs_in`` is approximated
+    by a fraction with a denominator of at most 65536.
+
+    All computations are done in float32. The output is identical whether
+    the signal is processed all at once or in blocks.
+    """
+
+    def __init__(self, fs_in, fs_out):
+        self.fs_in = float(fs_in)
+        self.fs_out = float(fs_out)
+        self._up, self._down = _get_ratio(fs_in, fs_out)
+        self._h, self._delay = _get_filter(self._up, self._down)
+        # Input segments passed to upfirdn must start at an input index s
+        # with (delay - s * up) % down == 0 so that its outputs fall on our
+        # output grid. As delay is a multiple of max(up, down), s can be 0
+        # or delay // up.
+        self._s0 = self._delay // self._up if self._up > self._down else 0
+        self.reset()
+
+    def reset(self):
+        """Reset the resampler to start a new signal."""
+        self._buf = None
+        self._start = 0  # input index of self._buf[..., 0]
+        self._n_in = 0
+        self._n_out = 0
+
+    def _align(self, idx):
+        """Get the largest valid segment start that is <= idx."""
+        return idx - (idx - self._s0) % self._down
+
+    def _first_input(self, m):
+        """Get the first input sample that output sample m depends on."""
+        return -((self._delay - m * self._down) // self._up)
+
+    def process(self, x, final=False):
+        """Resample a block of a signal.
+
+        Parameters
+        ----------
+        x : array-like
+            The next block of the signal. The last dimension is time, and
+            the other dimensions must be the same for all blocks.
+        final : bool
+            If True, this is the last block of the signal. The remaining
+            output is returned and the resampler is reset.
+
+        Returns
+        -------
+        y : array
+            The output samples that could be computed from the input so
+            far (float32). Because of the filter delay, the output lags the
+            input until ``final=True`` is used.
+        """
+        x = np.atleast_1d(np.asarray(x, np.float32))
+        up, down, delay = self._up, self._down, self._delay
+        if self._buf is None:
+            # zeros before the start of the signal
+            self._start = self._align(self._first_input(0))
+            self._buf = np.zeros(x.shape[:-1] + (-self._start,), np.float32)
+        if x.shape[:-1] != self._buf.shape[:-1]:
+            raise ValueError('x must have shape (..., n_samples) with leading '
+                             'dimensions %s, got %s'
+                             % (self._buf.shape[:-1], x.shape))
+        buf = np.concatenate((self._buf, x), axis=-1)
+        self._n_in += x.shape[-1]
+        n_out = -(-self._n_in * up // down)
+        if not final:  # only outputs whose input has all arrived
+            n_out = max(min(-((delay - self._n_in * up) // down), n_out),
+                        self._n_out)
+        n_new = n_out - self._n_out
+        if n_new > 0:
+            last = ((n_out - 1) * down + delay) // up
+            n_seg = last + 1 - self._start
+            if n_seg > buf.shape[-1]:  # zeros after the end of the signal
+                pad = np.zeros(buf.shape[:-1] + (n_seg - buf.shape[-1],),
+                               np.float32)
+                buf = np.concatenate((buf, pad), axis=-1)
+            y = upfirdn(self._h, buf[..., :n_seg], up, down, axis=-1)
+            k0 = self._n_out + (delay - self._start * up) // down
+            y = y[..., k0:k0 + n_new]
+            start = self._align(self._first_input(n_out))
+            buf = buf[..., start - self._start:]
+            self._start = start
+            self._n_out = n_out
+        else:
+            y = np.zeros(buf.shape[:-1] + (0,), np.float32)
+        self._buf = buf
+        if final:
+            self.reset()
+        return y
+
+
+def resample(x, fs_in, fs_out, axis=-1):
+    """Resample a signal using a polyphase filter.
+
+    Parameters
+    ----------
+    x : array-like
+        The signal to resample.
+    fs_in : float
+        The sample rate of ``x``.
+    fs_out : float
+        The desired output sample rate.
+    axis : int
+        The time axis of ``x``.
+
+    Returns
+    -------
+    y : array
+        The resampled signal (float32). It has ``ceil(n * fs_out / fs_in)``
+        samples along ``axis``, where ``n`` is the number of input samples.
+
+    See Also
+    --------
+    Resampler
+
+    Notes
+    -----
+    Use :class:`Resampler` to resample long signals in blocks.
+    """
+    x = np.moveaxis(np.asarray(x, np.float32), axis, -1)
+    y = Resampler(fs_in, fs_out).process(x, final=True)
+    return np.moveaxis(y, -1, axis)
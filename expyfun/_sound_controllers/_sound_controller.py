@@ -5,15 +5,18 @@
 #
 # License: BSD (3-clause)
 
+from collections import OrderedDict
 import importlib
 import operator
 import os
 import os.path as op
+from threading import Timer
+import time
 
 import numpy as np
 
 from .._fixes import rfft, irfft, rfftfreq
-from .._utils import logger, flush_logger, _check_params
+from .._utils import logger, flush_logger, _check_params, clock, Future
 
 
 _BACKENDS = tuple(sorted(
@@ -134,6 +137,10 @@ class SoundCardController(object):
         self.playing = False
         self._trigger_duration = trigger_duration
         self._trig_scale = trig_scale
+        # (triggers, delay) -> (player, future of its last trigger train)
+        self._trigger_players = OrderedDict()
+        self._trigger_timers = list()  # (timer, future) of non-blocking trains
+        self._trigger_end = 0.  # when the last requested trigger train ends
         flush_logger()
 
     def __repr__(self):
@@ -170,34 +177,54 @@ class SoundCardController(object):
     def _noise_playing(self):
         return self.noise is not None
 
-    def load_buffer(self, samples):
+    def load_buffer(self, samples, triggers=None):
         """Load the buffer.
 
         Parameters
         ----------
         samples : ndarray
             The sound samples.
+        triggers : list of tuple | None
+            The ``(sample, code)`` of each trigger to encode in the trigger
+            channels (if there are any). None (default) uses ``[(0, 1)]``.
         """
         self.stop(wait=False)
         if self.audio is not None:
             self.audio.delete()
             self.audio = None
-        if self._n_channels_stim > 0:
-            stim = self._make_digital_trigger([1])
-            extra = len(samples) - len(stim)
-            if extra > 0:  # stim shorter than samples (typical)
-                stim = np.pad(stim, ((0, extra), (0, 0)), 'constant')
-            elif extra < 0:  # samples shorter than stim (very brief stim)
-                samples = np.pad(samples, ((0, -extra), (0, 0)), 'constant')
-            samples = np.concatenate((stim, samples), axis=-1)
+        samples = self._make_buffer(samples, triggers)
         self.audio = self.backend.SoundPlayer(samples.T, **self._kwargs)
 
-    def _make_digital_trigger(self, trigs, delay=None):
-        if delay is None:
-            delay = 2 * self._trigger_duration
+    def _make_buffer(self, samples, triggers=None):
+        """Prepend the trigger channels to samples (n_samples, n_channels)."""
+        if self._n_channels_stim == 0:
+            if triggers is not None:
+                raise RuntimeError('Cannot encode triggers when '
+                                   'SOUND_CARD_TRIGGER_CHANNELS is zero')
+            return samples
+        if triggers is None:
+            triggers = [(0, 1)]
+        triggers = sorted((int(offset), code) for offset, code in triggers)
         n_on = int(round(self.fs * self._trigger_duration))
-        n_off = int(round(self.fs * (delay - self._trigger_duration)))
-        n_each = n_on + n_off
+        # at least one trigger on and off period (as for stamp_triggers)
+        n_each = 2 * n_on
+        offsets = np.array([offset for offset, _ in triggers], int)
+        if len(offsets) and (offsets[0] < 0 or np.any(np.diff(offsets) <
+                                                      n_each)):
+            raise ValueError('Trigger samples must be nonnegative and at '
+                             'least %s samples (twice the trigger duration) '
+                             'apart, got %s' % (n_each, list(offsets)))
+        n_samples = max([len(samples)] + [offset + n_each
+                                          for offset in offsets])
+        buf = np.zeros((n_samples, self._n_channels_tot), np.float32)
+        buf[:len(samples), self._n_channels_stim:] = samples
+        values = self._trigger_values([code for _, code in triggers])
+        for offset, value in zip(offsets, values):
+            buf[offset:offset + n_on, :self._n_channels_stim] = value
+        return buf
+
+    def _trigger_values(self, trigs):
+        """Convert trigger codes to trigger channel values."""
         # At some point below we did:
         #
         #     (np.array(trigs, int) << 8) + 101
@@ -227,6 +254,15 @@ class SoundCardController(object):
         trigs = ((np.array(trigs, int) << 8) *
                  self._trig_scale).astype(np.float32)
         assert trigs.ndim == 1
+        return trigs
+
+    def _make_digital_trigger(self, trigs, delay=None):
+        if delay is None:
+            delay = 2 * self._trigger_duration
+        n_on = int(round(self.fs * self._trigger_duration))
+        n_off = int(round(self.fs * (delay - self._trigger_duration)))
+        n_each = n_on + n_off
+        trigs = self._trigger_values(trigs)
         n_samples = n_each * len(trigs)
         stim = np.zeros((n_samples, self._n_channels_stim), np.float32)
         offset = 0
@@ -235,7 +271,8 @@ class SoundCardController(object):
             offset += n_each
         return stim
 
-    def stamp_triggers(self, triggers, delay=None, wait_for_last=True):
+    def stamp_triggers(self, triggers, delay=None, wait_for_last=True,
+                       block=True):
         """Stamp a list of triggers with a given inter-trigger delay.
 
         Parameters
@@ -248,13 +285,42 @@ class SoundCardController(object):
             If None, will use twice the trigger duration (50% duty cycle).
         wait_for_last : bool
             If True, wait for last trigger to be stamped before returning.
+        block : bool
+            If False, return immediately instead of waiting for the triggers.
+            They are then played (and the player stopped) from a timer
+            thread.
+
+        Returns
+        -------
+        future : instance of concurrent.futures.Future
+            Completion handle, whose result is set (to None) once the
+            triggers have been stamped.
+
+        Notes
+        -----
+        The player of each trigger train is created once and reused, so
+        repeated trains do not need new buffers or mixer setup. The
+        players of the least recently used trains are deleted when more
+        than 16 are kept.
+
+        A train requested while another one is still playing starts when
+        the previous one ends, so trains never overlap.
         """
         if delay is None:
             delay = 2 * self._trigger_duration
-        stim = self._make_digital_trigger(triggers, delay)
-        stim = np.pad(stim, ((0, 0), (0, self._n_channels)), 'constant')
-        stim = self.backend.SoundPlayer(stim.T, **self._kwargs)
-        stim.play()
+        key = (tuple(int(trig) for trig in triggers), float(delay))
+        entry = self._trigger_players.pop(key, None)
+        keep = entry is None or entry[1].done()
+        if keep:
+            player = self._make_trigger_player(key) if entry is None \
+                else entry[0]
+        else:  # still playing this train, so use a one-off player
+            self._trigger_players[key] = entry
+            player = self._make_trigger_player(key)
+        future = Future()
+        if keep:
+            self._trigger_players[key] = (player, future)
+            self._prune_trigger_players()
         t_each = self._trigger_duration + delay
         duration = len(triggers) * t_each
         extra_delay = 0.1
@@ -262,9 +328,64 @@ class SoundCardController(object):
             delta = (delay - self._trigger_duration)
             duration -= delta
             extra_delay += delta
-        self.ec.wait_secs(duration)
-        # Impose an extra delay on the "stop" action
-        stim.stop(wait=False, extra_delay=extra_delay)
+        now = clock()
+        wait = max(self._trigger_end - now, 0.)
+        self._trigger_end = now + wait + duration
+
+        def _finish():
+            # Impose an extra delay on the "stop" action
+            player.stop(wait=False, extra_delay=extra_delay)
+            if not keep:
+                player.delete()
+            future.set_result(None)
+
+        if block:
+            if wait > 0:
+                self.ec.wait_secs(wait)
+            player.play()
+            self.ec.wait_secs(duration)
+            _finish()
+        else:
+            if wait > 0:  # play after the previous train, on the timer thread
+                def _play_and_finish():
+                    player.play()
+                    time.sleep(duration)
+                    _finish()
+
+                timer = Timer(wait, _play_and_finish)
+            else:
+                player.play()
+                timer = Timer(duration, _finish)
+            timer.daemon = True
+            self._trigger_timers = [
+                (t, f) for t, f in self._trigger_timers if not f.done()]
+            self._trigger_timers.append((timer, future))
+            timer.start()
+        return future
+
+    def _wait_for_triggers(self):
+        """Wait for requested trigger trains to end, returning the wait."""
+        remaining = self._trigger_end - clock()
+        if remaining <= 0:
+            return 0.
+        self.ec.wait_secs(remaining)
+        return remaining
+
+    def _make_trigger_player(self, key):
+        """Make a player for a (triggers, delay) trigger train."""
+        stim = self._make_digital_trigger(list(key[0]), key[1])
+        stim = np.pad(stim, ((0, 0), (0, self._n_channels)), 'constant')
+        return self.backend.SoundPlayer(stim.T, **self._kwargs)
+
+    def _prune_trigger_players(self, n_keep=16):
+        """Delete the least recently used idle trigger players."""
+        for key in list(self._trigger_players):
+            if len(self._trigger_players) <= n_keep:
+                break
+            player, future = self._trigger_players[key]
+            if future.done():
+                del self._trigger_players[key]
+                player.delete()
 
     def play(self):
         """Play."""
@@ -307,6 +428,18 @@ class SoundCardController(object):
         """Halt."""
         self.stop(wait=True)
         self.stop_noise(wait=True)
+        # stop the timer threads before their players are deleted
+        for timer, future in self._trigger_timers:
+            timer.cancel()
+            timer.join()
+            if not future.done():  # cancelled before it was played
+                future.set_exception(RuntimeError('Trigger stamping was '
+                                                  'halted'))
+        self._trigger_timers = list()
+        for player, future in self._trigger_players.values():
+            player.stop(wait=False)
+            player.delete()
+        self._trigger_players.clear()
 
 
 def _import_backend(backend):
@@ -12,7 +12,7 @@ from os import path as op
 from functools import partial
 import warnings
 
-from ._utils import _check_params, logger, ZeroClock
+from ._utils import _check_params, logger, ZeroClock, Future
 from ._input_controllers import Keyboard
 
 
@@ -288,7 +288,8 @@ class TDTController(Keyboard):  # lgtm [py/missing-call-to-init]
         logger.info('Expyfun: Setting TDT trigger delay to %s' % delay_trig)
 
 # ############################### TRIGGER METHODS #############################
-    def stamp_triggers(self, triggers, delay=None, wait_for_last=True):
+    def stamp_triggers(self, triggers, delay=None, wait_for_last=True,
+                       block=True):
         """Stamp a list of triggers with a given inter-trigger delay.
 
         Parameters
@@ -301,6 +302,13 @@ class TDTController(Keyboard):  # lgtm [py/missing-call-to-init]
             If None, will use twice the trigger duration (50% duty cycle).
         wait_for_last : bool
             If True, wait for last trigger to be stamped before returning.
+        block : bool
+            Ignored; the TDT is always driven from the calling thread.
+
+        Returns
+        -------
+        future : instance of concurrent.futures.Future
+            Completion handle (already done).
         """
         if delay is None:
             delay = 0.02  # we have a fixed trig duration of 0.01
@@ -309,6 +317,13 @@ class TDTController(Keyboard):  # lgtm [py/missing-call-to-init]
             self._trigger(6)
             if ti < len(triggers) - 1 or wait_for_last:
                 self.ec.wait_secs(delay)
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def _wait_for_triggers(self):
+        """Wait for pending triggers (none, as stamping always blocks)."""
+        return 0.
 
     def _trigger(self, trig):
         """Wrapper for tdt.util.RPcoX.SoftTrg()
@@ -0,0 +1,185 @@
+"""Timing instrumentation"""
+
+# License: BSD (3-clause)
+
+from functools import wraps
+import json
+
+import numpy as np
+
+from ._utils import logger, clock, process_time
+
+
+class _FrameMonitor(object):
+    """Ring buffer of flip timing measurements.
+
+    Parameters
+    ----------
+    screen_fs : float
+        The screen refresh rate (Hz).
+    buffer_size : int
+        The number of flips to keep.
+
+    Notes
+    -----
+    Every interval between consecutive monitored flips that is longer than
+    1.5 refresh periods is counted as late, so monitoring should only be
+    enabled during periods of continuous flipping.
+    """
+
+    _percentiles = (50, 95, 99)
+    _hist_edges = (0., 1.5, 2.5, 3.5, np.inf)  # in refresh periods
+
+    def __init__(self, screen_fs, buffer_size=1000):
+        self.screen_fs = float(screen_fs)
+        if self.screen_fs <= 0:
+            raise ValueError('screen_fs must be positive, got %s'
+                             % (screen_fs,))
+        buffer_size = int(buffer_size)
+        if buffer_size < 1:
+            raise ValueError('buffer_size must be positive, got %s'
+                             % (buffer_size,))
+        # interval, swap, and callback durations for each flip
+        self._data = np.zeros((buffer_size, 3))
+        self._dropped = np.zeros(buffer_size, int)
+        self._count = 0
+        self._trial_start = 0
+        self._last_flip = None
+
+    def add(self, flip_time, swap_dur, callback_dur):
+        """Add the measurements of one flip."""
+        if self._last_flip is not None:
+            interval = flip_time - self._last_flip
+            n_dropped = max(int(round(interval * self.screen_fs)) - 1, 0)
+            if n_dropped:
+                logger.warning('Expyfun: Flip at %0.6f was late by %0.1f ms '
+                               '(%d frame%s dropped)'
+                               % (flip_time, 1000 * (interval - 1. /
+                                                     self.screen_fs),
+                                  n_dropped, 's' if n_dropped > 1 else ''))
+            idx = self._count % len(self._data)
+            self._data[idx] = (interval, swap_dur, callback_dur)
+            self._dropped[idx] = n_dropped
+            self._count += 1
+        self._last_flip = flip_time
+
+    def new_trial(self):
+        """Start collecting statistics for a new trial."""
+        self._trial_start = self._count
+
+    def get_stats(self, scope='trial'):
+        """Get summary statistics of the flip timing."""
+        if scope not in ('trial', 'buffer'):
+            raise ValueError('scope must be "trial" or "buffer", got %r'
+                             % (scope,))
+        n = min(self._count - (self._trial_start if scope == 'trial' else 0),
+                len(self._data))
+        idx = (self._count - 1 - np.arange(n)[::-1]) % len(self._data)
+        data = self._data[idx]
+        period = 1. / self.screen_fs
+        stats = dict(n_intervals=n,
+                     n_late=int(np.sum(self._dropped[idx] > 0)),
+                     n_dropped=int(np.sum(self._dropped[idx])),
+                     hist=np.histogram(data[:, 0] / period,
+                                       self._hist_edges)[0].tolist())
+        for ii, name in enumerate(('interval', 'swap', 'callback')):
+            if n:
+                vals = np.percentile(data[:, ii], self._percentiles).tolist()
+                vals.append(float(data[:, ii].max()))
+            else:
+                vals = [np.nan] * (len(self._percentiles) + 1)
+            keys = ['p%d' % p for p in self._percentiles] + ['max']
+            for key, val in zip(keys, vals):
+                stats['%s_%s' % (name, key)] = val
+        return stats
+
+
+class _Profiler(object):
+    """Record the wall-clock and CPU durations of calls to object methods.
+
+    Parameters
+    ----------
+    obj : object
+        The object whose methods should be wrapped. The wrappers are set as
+        instance attributes, so calls made by the object itself are also
+        recorded.
+    methods : list of str
+        The names of the methods to wrap.
+    start_time : float
+        The clock value to use as time zero in traces.
+    """
+
+    _percentiles = (50, 95)
+
+    def __init__(self, obj, methods, start_time=0.):
+        self._obj = obj
+        self._start_time = start_time
+        self._records = dict()
+        for name in methods:
+            self._records[name] = list()
+            setattr(obj, name, self._wrap(name, getattr(obj, name)))
+
+    def _wrap(self, name, func):
+        append = self._records[name].append
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            t0, c0 = clock(), process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                append((t0, clock() - t0, process_time() - c0))
+        return wrapped
+
+    def remove(self):
+        """Restore the original methods."""
+        for name in self._records:
+            if name in vars(self._obj):
+                delattr(self._obj, name)
+
+    def get_stats(self):
+        """Get per-method call counts and duration percentiles (sec)."""
+        stats = dict()
+        keys = ['p%d' % p for p in self._percentiles] + ['max']
+        for name, records in self._records.items():
+            stats[name] = dict(n_calls=len(records))
+            durs = np.array([r[1:] for r in records]).reshape(-1, 2)
+            for di, kind in enumerate(('wall', 'cpu')):
+                if len(records):
+                    vals = np.percentile(durs[:, di],
+                                         self._percentiles).tolist()
+                    vals.append(float(durs[:, di].max()))
+                else:
+                    vals = [np.nan] * len(keys)
+                for key, val in zip(keys, vals):
+                    stats[name]['%s_%s' % (kind, key)] = val
+                stats[name]['%s_total' % kind] = float(durs[:, di].sum())
+        return stats
+
+    def get_report(self):
+        """Get a text table of the per-method statistics (in ms)."""
+        stats = self.get_stats()
+        keys = ['wall_p50', 'wall_p95', 'wall_max', 'cpu_p50', 'cpu_p95',
+                'cpu_max']
+        width = max([len(name) for name in stats] + [6])
+        lines = ['%s  %7s' % ('method'.ljust(width), 'calls') +
+                 ''.join(' %9s' % key for key in keys)]
+        for name in sorted(stats, key=lambda n: -stats[n]['wall_total']):
+            lines.append('%s  %7d' % (name.ljust(width),
+                                      stats[name]['n_calls']) +
+                         ''.join(' %9.3f' % (1000 * stats[name][key])
+                                 for key in keys))
+        return '\n'.join(lines)
+
+    def write_trace(self, fname):
+        """Write the calls as a Chrome trace (chrome://tracing) JSON file."""
+        events = list()
+        for name, records in self._records.items():
+            for t0, wall, cpu in records:
+                events.append(dict(
+                    name=name, ph='X', pid=0, tid=0,
+                    ts=1e6 * (t0 - self._start_time), dur=1e6 * wall,
+                    args=dict(cpu_ms=1e3 * cpu)))
+        events.sort(key=lambda e: e['ts'])
+        with open(fname, 'w') as fid:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), fid)
@@ -6,9 +6,23 @@
 # License: BSD (3-clause)
 
 import sys
+import threading
+import time
+
 import numpy as np
 
-from ._utils import verbose_dec, string_types, logger
+from ._utils import (verbose_dec, string_types, logger, queue, clock,
+                     Future)
+
+
+def _sleep_until(t_end, spin=0.002):
+    """Sleep until a time, spinning for the last ``spin`` seconds."""
+    while True:
+        remaining = t_end - clock()
+        if remaining <= 0:
+            break
+        if remaining > spin:
+            time.sleep(remaining - spin)
 
 
 class ParallelTrigger(object):
@@ -43,8 +57,14 @@ class ParallelTrigger(object):
     -----
     Parallel port activation is enabled by using the ``trigger_controller``
     argument of :class:`expyfun.ExperimentController`.
+
+    Triggers stamped with ``block=False`` are sent by a worker thread (that
+    sleeps and then spins until each edge is due), in the order in which
+    they were requested.
     """
 
+    _close_marker = object()
+
     @verbose_dec
     def __init__(self, mode='dummy', address=None, trigger_duration=0.01,
                  ec=None, verbose=None):
@@ -96,6 +116,9 @@ class ParallelTrigger(object):
                                         if x != 0 else None)
         self.trigger_duration = trigger_duration
         self.mode = mode
+        self._queue = queue.Queue()
+        self._thread = None
+        self._last_future = None
 
     def __repr__(self):
         return '<ParallelTrigger : %s (%s)>' % (self.mode, self._portname)
@@ -106,7 +129,8 @@ class ParallelTrigger(object):
         self.ec.wait_secs(self.trigger_duration)
         self._set_data(0)
 
-    def stamp_triggers(self, triggers, delay=None, wait_for_last=True):
+    def stamp_triggers(self, triggers, delay=None, wait_for_last=True,
+                       block=True):
         """Stamp a list of triggers with a given inter-trigger delay.
 
         Parameters
@@ -119,16 +143,100 @@ class ParallelTrigger(object):
             If None, will use twice the trigger duration (50% duty cycle).
         wait_for_last : bool
             If True, wait for last trigger to be stamped before returning.
+        block : bool
+            If False, queue the triggers to be stamped by the worker thread
+            and return immediately.
+
+        Returns
+        -------
+        future : instance of concurrent.futures.Future
+            Completion handle. Its result is set (to None) once the triggers
+            have been stamped (including the final delay if
+            ``wait_for_last``).
         """
         if delay is None:
             delay = 2 * self.trigger_duration
+        triggers = [int(trig) for trig in triggers]
+        if not block:
+            future = Future()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='expyfun-trigger')
+                self._thread.daemon = True
+                self._thread.start()
+            self._queue.put((triggers, delay, wait_for_last, future))
+            self._last_future = future
+            return future
+        # keep the order with respect to triggers still being stamped
+        self._wait_for_triggers()
         for ti, trig in enumerate(triggers):
             self._stamp_trigger(trig)
             if ti < len(triggers) - 1 or wait_for_last:
                 self.ec.wait_secs(delay - self.trigger_duration)
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def _wait_for_triggers(self):
+        """Wait for queued triggers to be stamped, returning the wait."""
+        if self._last_future is None:
+            return 0.
+        t0 = clock()
+        try:
+            self._last_future.result()
+        except Exception:
+            pass  # already logged by the worker thread
+        self._last_future = None
+        return clock() - t0
+
+    def _run(self):
+        """Stamp queued triggers (on the worker thread)."""
+        while True:
+            item = self._queue.get()
+            if item is self._close_marker:
+                break
+            triggers, delay, wait_for_last, future = item
+            try:
+                self._stamp_train(triggers, delay, wait_for_last)
+            except Exception as exp:
+                logger.error('Expyfun: Trigger thread error: %s' % (exp,))
+                future.set_exception(exp)
+            else:
+                future.set_result(None)
+
+    def _stamp_train(self, triggers, delay, wait_for_last):
+        """Stamp triggers with precise sleeps, logging the timing."""
+        t_start = clock()
+        onsets, durations = list(), list()
+        for ti, trig in enumerate(triggers):
+            t_on = t_start + ti * delay
+            _sleep_until(t_on)
+            self._set_data(trig)
+            onsets.append(clock() - t_on)
+            t_on += onsets[-1]
+            _sleep_until(t_on + self.trigger_duration)
+            self._set_data(0)
+            durations.append(clock() - t_on)
+        if wait_for_last and len(triggers):
+            _sleep_until(t_start + len(triggers) * delay)
+        logger.debug('Expyfun: Stamped triggers %s in %0.1f ms'
+                     % (triggers, 1000 * (clock() - t_start)))
+        late = max(onsets + [0.])
+        if late > 1e-3:
+            logger.warning('Expyfun: A trigger started %0.1f ms later than '
+                           'scheduled' % (1000 * late,))
+        late = max(durations + [0.]) - self.trigger_duration
+        if late > 1e-3:
+            logger.warning('Expyfun: A trigger lasted %0.1f ms longer than '
+                           'trigger_duration' % (1000 * late,))
 
     def close(self):
         """Release hardware interfaces."""
+        thread = getattr(self, '_thread', None)
+        if thread is not None and thread.is_alive():
+            self._queue.put(self._close_marker)  # after any queued triggers
+            thread.join()
+            self._thread = None
         if hasattr(self, '_port'):
             del self._port
 
@@ -136,6 +244,14 @@ class ParallelTrigger(object):
         return self.close()
 
 
+def _bit_shifts(n_bits):
+    """Get the group and left shift of each bit of MSB-first binary groups."""
+    group = np.repeat(np.arange(len(n_bits)), n_bits)
+    starts = np.cumsum(n_bits) - n_bits
+    pos = np.arange(n_bits.sum()) - np.repeat(starts, n_bits)
+    return group, n_bits[group] - 1 - pos
+
+
 def decimals_to_binary(decimals, n_bits):
     """Convert a sequence of decimal numbers to a sequence of binary numbers.
 
@@ -144,18 +260,23 @@ def decimals_to_binary(decimals, n_bits):
     decimals : array-like
         Array of integers to convert. Must all be >= 0.
     n_bits : array-like
-        Array of the number of bits to use to represent each decimal number.
+        Array of the number of bits to use to represent each decimal number
+        (at most 63).
 
     Returns
     -------
     binary : list
         Binary representation.
 
+    See Also
+    --------
+    decimals_to_triggers
+
     Notes
     -----
     This function is useful for generating IDs to be stamped using the TDT.
     """
-    decimals = np.array(decimals, int)
+    decimals = np.array(decimals, np.int64)
     if decimals.ndim != 1 or (decimals < 0).any():
         raise ValueError('decimals must be 1D with all nonnegative values')
     n_bits = np.array(n_bits, int)
@@ -163,14 +284,15 @@ def decimals_to_binary(decimals, n_bits):
         raise ValueError('n_bits must have same shape as decimals')
     if (n_bits <= 0).any():
         raise ValueError('all n_bits must be positive')
-    binary = list()
-    for d, b in zip(decimals, n_bits):
-        if d > 2 ** b - 1:
-            raise ValueError('cannot convert number {0} using {1} bits'
-                             ''.format(d, b))
-        binary.extend([int(bb) for bb in np.binary_repr(d, b)])
-    assert len(binary) == n_bits.sum()  # make sure we didn't do something dumb
-    return binary
+    if (n_bits > 63).any():
+        raise ValueError('n_bits must all be <= 63, got %s' % (n_bits.max(),))
+    bad = np.where(decimals >> n_bits != 0)[0]
+    if len(bad):
+        raise ValueError('cannot convert number {0} using {1} bits'
+                         ''.format(decimals[bad[0]], n_bits[bad[0]]))
+    group, shifts = _bit_shifts(n_bits)
+    binary = (decimals[group] >> shifts) & 1
+    return binary.tolist()
 
 
 def binary_to_decimals(binary, n_bits):
@@ -181,12 +303,17 @@ def binary_to_decimals(binary, n_bits):
     binary : array-like
         Array of integers to convert. Must all be 0 or 1.
     n_bits : array-like
-        Array of the number of bits used to represent each decimal number.
+        Array of the number of bits used to represent each decimal number
+        (at most 63).
 
     Returns
     -------
     decimals : array-like
         Array of integers.
+
+    See Also
+    --------
+    triggers_to_decimals
     """
     if not np.array_equal(binary, np.array(binary, bool)):
         raise ValueError('binary must only contain zeros and ones')
@@ -196,14 +323,99 @@ def binary_to_decimals(binary, n_bits):
     n_bits = np.atleast_1d(n_bits).astype(int)
     if np.any(n_bits <= 0):
         raise ValueError('n_bits must all be > 0')
+    if np.any(n_bits > 63):
+        raise ValueError('n_bits must all be <= 63, got %s' % (n_bits.max(),))
     if n_bits.sum() != len(binary):
         raise ValueError('the sum of n_bits must be equal to the number of '
                          'elements in binary')
-    offset = 0
-    outs = []
-    for nb in n_bits:
-        outs.append(np.sum(binary[offset:offset + nb] *
-                           (2 ** np.arange(nb - 1, -1, -1))))
-        offset += nb
-    assert offset == len(binary)
-    return np.array(outs)
+    _, shifts = _bit_shifts(n_bits)
+    return np.add.reduceat(binary.astype(np.int64) << shifts,
+                           np.cumsum(n_bits) - n_bits)
+
+
+def _binary_to_triggers(binary):
+    """Convert bits to the trigger values used for binary IDs (0, 1 -> 4, 8).
+    """
+    return (np.asarray(binary, int) + 1) << 2
+
+
+def decimals_to_triggers(decimals, n_bits):
+    """Convert decimal numbers to the trigger values of a binary ID.
+
+    Parameters
+    ----------
+    decimals : array-like
+        Array of integers to convert. Must all be >= 0.
+    n_bits : array-like
+        Array of the number of bits to use to represent each decimal number
+        (at most 63).
+
+    Returns
+    -------
+    triggers : array
+        The trigger value of each bit, with 4 for a zero and 8 for a one
+        (most significant bit first).
+
+    See Also
+    --------
+    decimals_to_binary
+    triggers_to_decimals
+
+    Notes
+    -----
+    These are the values that
+    :meth:`expyfun.ExperimentController.identify_trial` stamps for
+    ``ttl_id=decimals_to_binary(decimals, n_bits)``. The whole array can be
+    passed to :meth:`expyfun.ExperimentController.stamp_triggers` at once.
+    """
+    return _binary_to_triggers(decimals_to_binary(decimals, n_bits))
+
+
+def triggers_to_decimals(data, n_bits):
+    """Decode binary IDs from a recorded trigger channel.
+
+    Parameters
+    ----------
+    data : array-like, shape (n_samples,)
+        The trigger channel, e.g. the stim channel of an EEG recording.
+    n_bits : array-like
+        Array of the number of bits used to represent each decimal number
+        of an ID.
+
+    Returns
+    -------
+    decimals : array, shape (n_ids, n_decimals)
+        The decimal numbers of each ID.
+    onsets : array, shape (n_ids,)
+        The sample index of the first trigger of each ID.
+
+    See Also
+    --------
+    binary_to_decimals
+    decimals_to_triggers
+
+    Notes
+    -----
+    A trigger starts wherever the channel changes to a nonzero value. The
+    triggers with values 4 and 8 are taken as the zeros and ones of the IDs,
+    in order, and all other triggers (such as the 1 stamped at stimulus
+    onset) are ignored.
+    """
+    data = np.array(data).astype(np.int64)
+    if data.ndim != 1:
+        raise ValueError('data must be 1 dimensional, got shape %s'
+                         % (data.shape,))
+    n_bits = np.atleast_1d(n_bits).astype(int)
+    if n_bits.ndim != 1 or len(n_bits) == 0 or np.any(n_bits <= 0):
+        raise ValueError('n_bits must be 1D with all values > 0')
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], data])) != 0)
+    edges = edges[np.in1d(data[edges], [4, 8])]
+    n_id = n_bits.sum()
+    if len(edges) % n_id != 0:
+        raise ValueError('found %s binary triggers, which is not a multiple '
+                         'of the %s bits of each ID' % (len(edges), n_id))
+    bits = (data[edges] == 8).astype(np.int64).reshape(-1, n_id)
+    _, shifts = _bit_shifts(n_bits)
+    decimals = np.add.reduceat(bits << shifts, np.cumsum(n_bits) - n_bits,
+                               axis=1)
+    return decimals, edges[::n_id]
@@ -17,6 +17,7 @@ import tempfile
 import ssl
 from shutil import rmtree
 import atexit
+from collections import OrderedDict
 import json
 from functools import partial
 from distutils.version import LooseVersion
@@ -24,6 +25,7 @@ from numpy import sqrt, convolve, ones
 import logging
 import datetime
 from timeit import default_timer as clock
+import threading
 from threading import Timer
 
 import numpy as np
@@ -43,19 +45,54 @@ except Exception:
 # for py3k (eventually)
 if sys.version.startswith('2'):
     string_types = basestring  # noqa
+    import Queue as queue  # noqa
     input = raw_input  # noqa, input is raw_input in py3k
     text_type = unicode  # noqa
     from __builtin__ import reload
     from urllib2 import urlopen  # noqa
     from cStringIO import StringIO  # noqa
+    from time import clock as process_time  # noqa
 else:
     string_types = str
     text_type = str
+    import queue
     from urllib.request import urlopen
     input = input
     from io import StringIO  # noqa, analysis:ignore
+    from time import process_time  # noqa
     from importlib import reload  # noqa, analysis:ignore
 
+try:
+    from concurrent.futures import Future
+except ImportError:  # Python 2 without the futures backport
+    class Future(object):
+        """Minimal completion handle (subset of concurrent.futures.Future)."""
+
+        def __init__(self):
+            self._event = threading.Event()
+            self._result = self._exception = None
+
+        def done(self):
+            return self._event.is_set()
+
+        def set_result(self, result):
+            self._result = result
+            self._event.set()
+
+        def set_exception(self, exception):
+            self._exception = exception
+            self._event.set()
+
+        def exception(self, timeout=None):
+            if not self._event.wait(timeout):
+                raise RuntimeError('Timed out waiting for the result')
+            return self._exception
+
+        def result(self, timeout=None):
+            if self.exception(timeout) is not None:
+                raise self._exception
+            return self._result
+
 ###############################################################################
 # LOGGING
 
@@ -763,6 +800,42 @@ def running_rms(signal, win_length):
     return sqrt(convolve(signal ** 2, ones(win_length) / win_length, 'valid'))
 
 
+def _max_running_rms(signal, win_length, block_size=65536):
+    """Maximum of the running RMS of each row of a signal.
+
+    Parameters
+    ----------
+    signal : array_like
+        The signal of interest, with time along the last axis.
+    win_length : int
+        Length (in samples) of the rectangular window.
+    block_size : int
+        Number of window positions to process at once.
+
+    Returns
+    -------
+    max_rms : ndarray
+        The maximum of ``running_rms`` for each row, computed using
+        cumulative sums over blocks so that memory use does not scale
+        with the signal length.
+    """
+    signal = np.asarray(signal)
+    n_samples = signal.shape[-1]
+    # like convolve, use the whole signal if it is shorter than the window
+    n_sum = min(win_length, n_samples)
+    n_windows = max(n_samples - win_length, 0) + 1
+    max_sq = np.zeros(signal.shape[:-1])
+    for start in range(0, n_windows, block_size):
+        stop = min(start + block_size, n_windows)
+        seg = signal[..., start:stop + n_sum - 1].astype(np.float64)
+        csum = np.cumsum(seg * seg, axis=-1)
+        sums = csum[..., n_sum - 1:].copy()
+        sums[..., 1:] -= csum[..., :-n_sum]
+        np.maximum(max_sq, sums.max(axis=-1), out=max_sq)
+    scale = 1. / win_length
+    return np.sqrt(max_sq * scale)
+
+
 def _fix_audio_dims(signal, n_channels):
     """Make it so a valid audio buffer is in the standard dimensions
 
@@ -803,6 +876,159 @@ def _sanitize(text_like):
     return text_type(text_like).encode('unicode_escape').decode('utf-8')
 
 
+class _LRUCache(object):
+    """Thread-safe least-recently-used cache bounded by total size.
+
+    Parameters
+    ----------
+    max_size : int
+        The maximum total size (e.g., in bytes) of the cached values.
+        Values larger than this are not cached.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get a value, marking it as recently used."""
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data[key] = self._data.pop(key)  # mark as most recent
+            return self._data[key][0]
+
+    def put(self, key, value, size):
+        """Add a value, evicting the least recently used ones if needed."""
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        """Remove all values."""
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _AsyncWriter(object):
+    """Write records on a background thread, committing them in groups.
+
+    Parameters
+    ----------
+    write : callable
+        Function called (on the writer thread) with each record's args.
+    flush : callable
+        Function called (on the writer thread) to commit written records.
+    max_size : int
+        Maximum number of queued records. Writes block when it is full.
+    flush_size : int
+        Number of written records that triggers a flush.
+    timeout : float
+        Maximum time (sec) that written records wait before a flush.
+
+    Notes
+    -----
+    Records are also committed whenever `commit` or `close` is called.
+    Pending records are drained at interpreter exit if `close` was never
+    called. Once closed, queuing a record raises an error.
+    """
+
+    _flush_marker = object()
+    _close_marker = object()
+
+    def __init__(self, write, flush, max_size=10000, flush_size=1000,
+                 timeout=1.):
+        self._write = write
+        self._flush = flush
+        self._flush_size = int(flush_size)
+        self._timeout = float(timeout)
+        self._queue = queue.Queue(int(max_size))
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='expyfun-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, *args):
+        """Queue a record to be written."""
+        if self._closed:
+            raise RuntimeError('Cannot write to a closed writer')
+        self._queue.put(args)
+
+    def commit(self, wait=False):
+        """Request that all queued records be written and flushed.
+
+        Parameters
+        ----------
+        wait : bool
+            If True, block until the records have been written and flushed.
+        """
+        if self._closed:
+            return
+        self._queue.put(self._flush_marker)
+        if wait:
+            self._queue.join()
+
+    def close(self):
+        """Write and flush all queued records and stop the thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._close_marker)
+        self._thread.join()
+        if hasattr(atexit, 'unregister'):  # not available on Python 2
+            atexit.unregister(self.close)
+
+    def _run(self):
+        n_pending = 0
+        first_time = 0.
+        while True:
+            timeout = None
+            if n_pending:
+                timeout = max(first_time + self._timeout - clock(), 0.)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item, got = self._flush_marker, False
+            else:
+                got = True
+            try:
+                if item is self._flush_marker or \
+                        item is self._close_marker:
+                    n_pending = self._flush_size
+                else:
+                    self._write(*item)
+                    if n_pending == 0:
+                        first_time = clock()
+                    n_pending += 1
+                if n_pending >= self._flush_size or (
+                        n_pending and clock() - first_time >= self._timeout):
+                    self._flush()
+                    n_pending = 0
+            except Exception as exp:
+                logger.error('Expyfun: Writer thread error: %s' % (exp,))
+            if got:
+                self._queue.task_done()
+            if item is self._close_marker:
+                break
+
+
 def _sort_keys(x):
     """Sort and return keys of dict"""
     keys = list(x.keys())  # note: not thread-safe
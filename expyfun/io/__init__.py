@@ -9,7 +9,9 @@ from ._wav import read_wav, write_wav
 from .._externals._h5io import (read_hdf5 as _read_hdf5,
                                 write_hdf5 as _write_hdf5)
 from ._parse import (read_tab, reconstruct_tracker,
-                     reconstruct_dealer, read_tab_raw)
+                     reconstruct_dealer, read_tab_raw, read_tab_columns,
+                     iter_tab, read_tab_batch)
+from ._binary import read_tab_binary, tab_to_binary, binary_to_tab
 
 
 def read_hdf5(fname):
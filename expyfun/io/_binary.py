@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Binary sidecar event log functions
+"""
+
+from collections import OrderedDict
+import json
+from os import path as op
+import struct
+
+import numpy as np
+
+from .._utils import _sanitize
+
+# One fixed-size record per data line. Event types are interned in the .evk
+# table (which also holds the JSON header), and values are stored as ASCII
+# (thanks to _sanitize) in the .evs blob.
+_EVT_STRUCT = struct.Struct('<dIIQ')
+_EVT_DTYPE = np.dtype([('timestamp', '<f8'), ('event', '<u4'),
+                       ('value_len', '<u4'), ('value_start', '<u8')])
+assert _EVT_DTYPE.itemsize == _EVT_STRUCT.size
+_EXTENSIONS = ('.evt', '.evs', '.evk')
+
+
+def _get_base(fname):
+    """Strip a .tab or sidecar extension from a filename."""
+    base, ext = op.splitext(fname)
+    return base if ext in ('.tab',) + _EXTENSIONS else fname
+
+
+class _BinaryTabWriter(object):
+    """Write the binary sidecar of a .tab file.
+
+    Parameters
+    ----------
+    base : str
+        The filename (without extension) to write to.
+    header : str
+        The comment line (including ``'# '``) of the .tab file.
+
+    Notes
+    -----
+    The event and value strings must already be sanitized. Data are written
+    to the records file last so that every record that makes it to disk
+    references table and blob entries that do as well.
+    """
+
+    def __init__(self, base, header):
+        self._evk = open(base + '.evk', 'w')
+        self._evs = open(base + '.evs', 'wb')
+        self._evt = open(base + '.evt', 'wb')
+        self._evk.write(header.rstrip('\n') + '\n')
+        self._codes = dict()
+        self._offset = 0
+
+    def write(self, timestamp, event, value):
+        code = self._codes.get(event)
+        if code is None:
+            code = self._codes[event] = len(self._codes)
+            self._evk.write(event + '\n')
+        value = value.encode('ascii')
+        self._evs.write(value)
+        self._evt.write(_EVT_STRUCT.pack(float(timestamp), code, len(value),
+                                         self._offset))
+        self._offset += len(value)
+
+    def flush(self):
+        for fid in (self._evk, self._evs, self._evt):
+            if not fid.closed:
+                fid.flush()
+
+    def close(self):
+        self.flush()
+        for fid in (self._evk, self._evs, self._evt):
+            fid.close()
+
+    @property
+    def closed(self):
+        return self._evt.closed
+
+
+def read_tab_binary(fname, return_params=False):
+    """Read the binary sidecar of a .tab file into columnar arrays.
+
+    Parameters
+    ----------
+    fname : str
+        Input filename. Can be the .tab filename or that of any of its
+        binary sidecar files (``.evt``, ``.evs``, ``.evk``).
+    return_params : bool
+        If True, return the JSON-parsed comment header.
+
+    Returns
+    -------
+    data : dict
+        The data, in the same format as returned by
+        :func:`read_tab_columns`. ``data['timestamp']`` is a read-only
+        memory-mapped view of the records file.
+    params : dict
+        The JSON-parsed comment header. Only returned if
+        ``return_params=True``.
+
+    See Also
+    --------
+    binary_to_tab
+    read_tab_columns
+    tab_to_binary
+    """
+    base = _get_base(fname)
+    with open(base + '.evk', 'r') as fid:
+        lines = fid.read().split('\n')[:-1]
+    assert len(lines) >= 1 and lines[0].startswith('# ')
+    if return_params:
+        params = json.loads(lines[0][2:], object_pairs_hook=OrderedDict)
+    names = lines[1:]
+    # ignore any partially written trailing record
+    n_records = op.getsize(base + '.evt') // _EVT_DTYPE.itemsize
+    if n_records > 0:
+        records = np.memmap(base + '.evt', _EVT_DTYPE, 'r',
+                            shape=(n_records,))
+    else:
+        records = np.zeros(0, _EVT_DTYPE)
+    with open(base + '.evs', 'rb') as fid:
+        blob = fid.read().decode('ascii')
+    starts = records['value_start'].tolist()
+    stops = (records['value_start'] + records['value_len']).tolist()
+    vals = np.empty(n_records, object)
+    vals[:] = [blob[start:stop] for start, stop in zip(starts, stops)]
+    # recode events so that codes index into the sorted names
+    order = sorted(range(len(names)), key=names.__getitem__)
+    recode = np.empty(len(names), np.intp)
+    recode[order] = np.arange(len(names))
+    data = dict(timestamp=records['timestamp'],
+                event=recode[records['event']],
+                event_names=[names[ii] for ii in order], value=vals)
+    return (data, params) if return_params else data
+
+
+def tab_to_binary(fname, overwrite=False):
+    """Write the binary sidecar files for an existing .tab file.
+
+    Parameters
+    ----------
+    fname : str
+        The .tab filename. The sidecar files are written next to it.
+    overwrite : bool
+        If True, overwrite the sidecar files if necessary.
+
+    See Also
+    --------
+    binary_to_tab
+    read_tab_binary
+    """
+    base = _get_base(fname)
+    for ext in _EXTENSIONS:
+        if not overwrite and op.isfile(base + ext):
+            raise IOError('File {} exists, overwrite=True must be '
+                          'used'.format(op.basename(base + ext)))
+    with open(fname, 'r') as fid:
+        header = fid.readline()
+        assert header.startswith('# ')
+        assert fid.readline().rstrip('\n').split('\t') == \
+            ['timestamp', 'event', 'value']
+        writer = _BinaryTabWriter(base, header)
+        try:
+            for line in fid:
+                writer.write(*line.rstrip('\n').split('\t'))
+        finally:
+            writer.close()
+
+
+def binary_to_tab(fname, fname_out, overwrite=False):
+    """Rebuild a .tab file from its binary sidecar files.
+
+    Parameters
+    ----------
+    fname : str
+        Input filename (see :func:`read_tab_binary`).
+    fname_out : str
+        The .tab filename to write.
+    overwrite : bool
+        If True, overwrite the file if necessary.
+
+    See Also
+    --------
+    read_tab_binary
+    tab_to_binary
+
+    Notes
+    -----
+    Timestamps are stored as float64, so the rebuilt file matches the
+    original exactly as long as only float timestamps were written.
+    """
+    if not overwrite and op.isfile(fname_out):
+        raise IOError('File {} exists, overwrite=True must be '
+                      'used'.format(op.basename(fname_out)))
+    base = _get_base(fname)
+    with open(base + '.evk', 'r') as fid:
+        header = fid.readline()
+    data = read_tab_binary(fname)
+    names = data['event_names']
+    with open(fname_out, 'w') as fid:
+        fid.write(header)
+        fid.write('timestamp\tevent\tvalue\n')
+        for time, code, value in zip(data['timestamp'].tolist(),
+                                     data['event'].tolist(), data['value']):
+            fid.write('\t'.join((_sanitize(time), names[code], value)) +
+                      '\n')
@@ -5,10 +5,35 @@
 import ast
 from collections import OrderedDict
 import csv
+from itertools import islice
 import json
 
 import numpy as np
 
+from .._utils import logger
+
+
+def _read_tab_header(csvr, return_params):
+    """Consume and check the two header lines of a .tab file."""
+    line = next(csvr)
+    assert len(line) == 1 and line[0].startswith('# ')
+    if return_params:
+        params = json.loads(line[0][2:], object_pairs_hook=OrderedDict)
+    else:
+        params = None
+    assert next(csvr) == ['timestamp', 'event', 'value']
+    return params
+
+
+def _lines_to_columns(lines):
+    """Convert a list of parsed .tab lines to (times, keys, values) arrays."""
+    times = np.array([line[0] for line in lines], np.float64)
+    keys = np.empty(len(lines), object)
+    keys[:] = [line[1] for line in lines]
+    vals = np.empty(len(lines), object)
+    vals[:] = [line[2] for line in lines]
+    return times, keys, vals
+
 
 def read_tab_raw(fname, return_params=False):
     """Read .tab file from expyfun output without segmenting into trials.
@@ -32,20 +57,13 @@ def read_tab_raw(fname, return_params=False):
     See Also
     --------
     read_tab
+    read_tab_columns
     """
     with open(fname, 'r') as f:
         csvr = csv.reader(f, delimiter='\t')
+        params = _read_tab_header(csvr, return_params)
         lines = [c for c in csvr]
 
-    # first two lines are headers
-    assert len(lines[0]) == 1 and lines[0][0].startswith('# ')
-    if return_params:
-        params = json.loads(lines[0][0][2:], object_pairs_hook=OrderedDict)
-    else:
-        params = None
-    assert lines[1] == ['timestamp', 'event', 'value']
-    lines = lines[2:]
-
     times = [float(line[0]) for line in lines]
     keys = [line[1] for line in lines]
     vals = [line[2] for line in lines]
@@ -53,43 +71,46 @@ def read_tab_raw(fname, return_params=False):
     return (data, params) if return_params else data
 
 
-def read_tab(fname, group_start='trial_id', group_end='trial_ok',
-             return_params=False):
-    """Read .tab file from expyfun output and segment into trials.
+def read_tab_columns(fname, return_params=False):
+    """Read .tab file from expyfun output into columnar arrays.
 
     Parameters
     ----------
     fname : str
         Input filename.
-    group_start : str
-        Key to use to start a trial/row.
-    group_end : str | None
-        Key to use to end a trial/row. If None, the next ``group_start``
-        will end the current group.
     return_params : bool
         If True, return the JSON-parsed comment header.
 
     Returns
     -------
-    data : list of dict
-        The data, with a dict for each trial. Each value in the dict
-        is a list of tuples (event, time) for each occurrence of that
-        key.
+    data : dict
+        The data, with one entry per column. ``data['timestamp']`` is a
+        float64 array of times, ``data['event']`` is an integer array of
+        codes indexing into the sorted list of unique event names
+        ``data['event_names']``, and ``data['value']`` is an object array
+        of value strings. All arrays have one entry per line.
     params : dict
         The JSON-parsed comment header. Only returned if
         ``return_params=True``.
 
     See Also
     --------
+    read_tab
     read_tab_raw
     """
-    # load everything into memory for ease of use
-    out = read_tab_raw(fname, return_params=return_params)
-    lines = out[0] if return_params else out
+    with open(fname, 'r') as f:
+        csvr = csv.reader(f, delimiter='\t')
+        params = _read_tab_header(csvr, return_params)
+        times, keys, vals = _lines_to_columns([c for c in csvr])
+    names, codes = np.unique(keys.astype(str), return_inverse=True)
+    data = dict(timestamp=times, event=codes.astype(np.intp).ravel(),
+                event_names=names.tolist(), value=vals)
+    return (data, params) if return_params else data
 
-    # determine the event fields
-    header = list(set([l[1] for l in lines]))
-    header.sort()
+
+def _check_groups(names, group_start, group_end):
+    """Check group keys and return the ordered header."""
+    header = sorted(names)
     if group_start not in header:
         raise ValueError('group_start "{0}" not in header: {1}'
                          ''.format(group_start, header))
@@ -97,35 +118,320 @@ def read_tab(fname, group_start='trial_id', group_end='trial_ok',
         raise ValueError('group_start cannot equal group_end, use '
                          'group_end=None')
     header = [header.pop(header.index(group_start))] + header
-    b1s = np.where([line[1] == group_start for line in lines])[0]
-    if group_end is None:
-        b2s = np.concatenate((b1s[1:], [len(lines)]))
-    else:  # group_end is not None
+    if group_end is not None:
         if group_end not in header:
             raise ValueError('group_end "{0}" not in header ({1})'
                              ''.format(group_end, header))
         header.append(header.pop(header.index(group_end)))
-        b2s = np.where([line[1] == group_end for line in lines])[0]
-    if len(b1s) != len(b2s) or not np.all(b1s < b2s):
+    return header
+
+
+def _get_bounds(is_start, is_end, fname, final=True):
+    """Get trial bounds from boolean start/end masks.
+
+    Returns the start indices, the (exclusive) stop indices, and the index
+    of the first line of a trial left open at the end (only possible when
+    ``final=False``).
+    """
+    n_lines = len(is_start)
+    b1s = np.where(is_start)[0]
+    open_idx = n_lines
+    if is_end is None:
+        b2s = np.concatenate((b1s[1:], [n_lines] if len(b1s) else []))
+        b2s = b2s.astype(np.intp)
+        if not final and len(b1s) > 0:
+            open_idx = b1s[-1]
+            b1s, b2s = b1s[:-1], b2s[:-1]
+        ends = b2s
+    else:
+        b2s = np.where(is_end)[0]
+        if not final and len(b1s) == len(b2s) + 1 and \
+                (len(b2s) == 0 or b1s[-1] > b2s[-1]):
+            open_idx = b1s[-1]
+            b1s = b1s[:-1]
+        ends = b2s + 1  # include the end
+    if len(b1s) != len(b2s) or not np.all(b1s < b2s) or \
+            not np.all(b1s[1:] >= ends[:-1]):
         raise RuntimeError('bad bounds in {0}:\n{1}\n{2}'
                            .format(fname, b1s, b2s))
-    data = []
-    for b1, b2 in zip(b1s, b2s):
-        assert lines[b1][1] == group_start  # prevent stupidity
-        if group_end is not None:
-            b2 = b2 + 1  # include the end
-            assert lines[b2 - 1][1] == group_end
-        d = dict()
-        these_times = [float(line[0]) for line in lines[b1:b2]]
-        these_keys = [line[1] for line in lines[b1:b2]]
-        these_vals = [line[2] for line in lines[b1:b2]]
-        for ki, key in enumerate(header):
-            idx = np.where(key == np.array(these_keys))[0]
-            d[key] = [(these_vals[ii], these_times[ii]) for ii in idx]
-        data.append(d)
+    return b1s, ends, open_idx
+
+
+def _label_trials(n_lines, b1s, b2s):
+    """Get the indices of lines within trials and their trial numbers."""
+    delta = np.zeros(n_lines + 1, int)
+    delta[b1s] += 1
+    delta[b2s] -= 1
+    idx = np.where(np.cumsum(delta[:-1]) > 0)[0]
+    trial = np.searchsorted(b1s, idx, side='right') - 1
+    return idx, trial
+
+
+def _columns_to_trials(times, codes, vals, names, header, b1s, b2s):
+    """Build the list-of-dict trial representation from columns."""
+    data = [dict((key, []) for key in header) for _ in range(len(b1s))]
+    if len(b1s) == 0:
+        return data
+    idx, trial = _label_trials(len(times), b1s, b2s)
+    # stable sort by (trial, event), then split at group changes
+    order = np.lexsort((idx, codes[idx], trial))
+    idx, trial = idx[order], trial[order]
+    these_codes = codes[idx]
+    splits = np.where((np.diff(trial) != 0) |
+                      (np.diff(these_codes) != 0))[0] + 1
+    these_times = times[idx].tolist()
+    these_vals = vals[idx].tolist()
+    for start, stop in zip(np.concatenate(([0], splits)),
+                           np.concatenate((splits, [len(idx)]))):
+        data[trial[start]][names[these_codes[start]]] = list(
+            zip(these_vals[start:stop], these_times[start:stop]))
+    return data
+
+
+def read_tab(fname, group_start='trial_id', group_end='trial_ok',
+             return_params=False):
+    """Read .tab file from expyfun output and segment into trials.
+
+    Parameters
+    ----------
+    fname : str
+        Input filename.
+    group_start : str
+        Key to use to start a trial/row.
+    group_end : str | None
+        Key to use to end a trial/row. If None, the next ``group_start``
+        will end the current group.
+    return_params : bool
+        If True, return the JSON-parsed comment header.
+
+    Returns
+    -------
+    data : list of dict
+        The data, with a dict for each trial. Each value in the dict
+        is a list of tuples (event, time) for each occurrence of that
+        key.
+    params : dict
+        The JSON-parsed comment header. Only returned if
+        ``return_params=True``.
+
+    See Also
+    --------
+    iter_tab
+    read_tab_columns
+    read_tab_raw
+    """
+    out = read_tab_columns(fname, return_params=return_params)
+    cols = out[0] if return_params else out
+    names, codes = cols['event_names'], cols['event']
+    header = _check_groups(names, group_start, group_end)
+    is_start = codes == names.index(group_start)
+    is_end = None if group_end is None else codes == names.index(group_end)
+    b1s, b2s, _ = _get_bounds(is_start, is_end, fname)
+    data = _columns_to_trials(cols['timestamp'], codes, cols['value'],
+                              names, header, b1s, b2s)
     return (data, out[1]) if return_params else data
 
 
+def iter_tab(fname, group_start='trial_id', group_end='trial_ok',
+             chunk_size=10000):
+    """Iterate over the trials of a .tab file with bounded memory.
+
+    Parameters
+    ----------
+    fname : str
+        Input filename.
+    group_start : str
+        Key to use to start a trial/row.
+    group_end : str | None
+        Key to use to end a trial/row. If None, the next ``group_start``
+        will end the current group.
+    chunk_size : int
+        Number of lines to parse at a time.
+
+    Yields
+    ------
+    trial : dict
+        The data for one trial, in the same format as the entries of
+        the list returned by :func:`read_tab`.
+
+    See Also
+    --------
+    read_tab
+
+    Notes
+    -----
+    The file is read twice: once to determine the set of event keys, and
+    once to segment the trials. Only ``chunk_size`` lines (plus any trial
+    that spans a chunk boundary) are held in memory at a time.
+    """
+    chunk_size = int(chunk_size)
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be positive, got %s'
+                         % (chunk_size,))
+    with open(fname, 'r') as f:
+        csvr = csv.reader(f, delimiter='\t')
+        _read_tab_header(csvr, False)
+        names = sorted(set(line[1] for line in csvr))
+    header = _check_groups(names, group_start, group_end)
+    lookup = dict((name, ni) for ni, name in enumerate(names))
+    with open(fname, 'r') as f:
+        csvr = csv.reader(f, delimiter='\t')
+        _read_tab_header(csvr, False)
+        carry = []
+        final = False
+        while not final:
+            lines = carry + list(islice(csvr, chunk_size))
+            final = len(lines) - len(carry) < chunk_size
+            times, keys, vals = _lines_to_columns(lines)
+            codes = np.array([lookup[key] for key in keys], np.intp)
+            is_start = codes == lookup[group_start]
+            is_end = (None if group_end is None else
+                      codes == lookup[group_end])
+            b1s, b2s, open_idx = _get_bounds(is_start, is_end, fname, final)
+            for trial in _columns_to_trials(times, codes, vals, names,
+                                            header, b1s, b2s):
+                yield trial
+            carry = lines[open_idx:]
+
+
+def _read_tab_rows(fname, group_start, group_end):
+    """Read one .tab file as tidy rows, returning an error string on failure.
+    """
+    try:
+        cols, params = read_tab_columns(fname, return_params=True)
+        names, codes = cols['event_names'], cols['event']
+        _check_groups(names, group_start, group_end)
+        is_start = codes == names.index(group_start)
+        is_end = (None if group_end is None else
+                  codes == names.index(group_end))
+        b1s, b2s, _ = _get_bounds(is_start, is_end, fname)
+        idx, trial = _label_trials(len(codes), b1s, b2s)
+        rows = dict(
+            participant=params.get('participant'),
+            session=params.get('session'), trial=trial,
+            event=np.array(names, object)[codes[idx]],
+            value=cols['value'][idx], timestamp=cols['timestamp'][idx])
+    except Exception as exp:
+        return None, '%s: %s' % (type(exp).__name__, exp)
+    return rows, None
+
+
+def read_tab_batch(fnames, group_start='trial_id', group_end='trial_ok',
+                   n_jobs=1):
+    """Read and segment many .tab files into a single tidy table.
+
+    Parameters
+    ----------
+    fnames : list of str
+        Input filenames.
+    group_start : str
+        Key to use to start a trial/row.
+    group_end : str | None
+        Key to use to end a trial/row. If None, the next ``group_start``
+        will end the current group.
+    n_jobs : int
+        Number of files to parse in parallel (requires ``joblib``).
+
+    Returns
+    -------
+    data : dict
+        The data, with one entry per line that falls within a trial.
+        ``data['participant']`` and ``data['session']`` are object arrays
+        of the values in each file's header, ``data['trial']`` is the
+        zero-based trial index within the file, ``data['event']`` and
+        ``data['value']`` are object arrays of strings, and
+        ``data['timestamp']`` is a float64 array of times.
+    errors : dict
+        Error message for each file that could not be read, keyed by
+        filename. Rows from these files are omitted from ``data``.
+
+    See Also
+    --------
+    read_tab
+    read_tab_columns
+
+    Notes
+    -----
+    To get the press times of trial ``ti`` from participant ``p``
+    (e.g., for :func:`expyfun.analyze.press_times_to_hmfc`), use::
+
+        mask = ((data['participant'] == p) & (data['trial'] == ti) &
+                (data['event'] == 'keypress'))
+        presses = data['timestamp'][mask]
+    """
+    from .._parallel import parallel_func
+    fnames = list(fnames)
+    parallel, p_fun, _ = parallel_func(_read_tab_rows, n_jobs)
+    out = parallel(p_fun(fname, group_start, group_end) for fname in fnames)
+    errors = OrderedDict()
+    keys = ('participant', 'session', 'trial', 'event', 'value', 'timestamp')
+    data = dict((key, []) for key in keys)
+    for fname, (rows, error) in zip(fnames, out):
+        if error is not None:
+            logger.warning('Expyfun: Could not read %s: %s' % (fname, error))
+            errors[fname] = error
+            continue
+        n_rows = len(rows['trial'])
+        for key in keys:
+            if key in ('participant', 'session'):
+                val = np.empty(n_rows, object)
+                val.fill(rows[key])
+                data[key].append(val)
+            else:
+                data[key].append(rows[key])
+    dtypes = dict(trial=np.intp, timestamp=np.float64)
+    for key in keys:
+        data[key] = (np.concatenate(data[key]) if len(data[key]) else
+                     np.array([], dtypes.get(key, object)))
+    return data, errors
+
+
+def _read_tab_index(fname):
+    """Read the values of a .tab file and map each event to its lines."""
+    cols = read_tab_columns(fname)
+    codes = cols['event']
+    order = np.argsort(codes, kind='stable')
+    splits = np.searchsorted(codes[order],
+                             np.arange(1, len(cols['event_names'])))
+    index = dict(zip(cols['event_names'], np.split(order, splits)))
+    return cols['value'], index
+
+
+def _reconstruct_tracker(vals, index, tracker_id, tracker_type, occurrence):
+    """Reconstruct the given occurrence of a tracker from indexed lines."""
+    from ..stimuli import TrackerUD, TrackerBinom, TrackerMHW
+    # find tracker_ID_init lines and get dict
+    init_str = 'tracker_' + str(tracker_id) + '_init'
+    tracker_dict = json.loads(vals[index[init_str][occurrence]])
+    td = dict(TrackerUD=TrackerUD, TrackerBinom=TrackerBinom,
+              TrackerMHW=TrackerMHW)
+    tr = td[tracker_type](**tracker_dict)
+    tr._tracker_id = tracker_id  # make sure tracker has original ID
+    stop_str = 'tracker_' + str(tracker_id) + '_stop'
+    stop_idx = index.get(stop_str, [])
+    if len(stop_idx) <= occurrence:
+        raise ValueError('Tracker {} has not stopped. All Trackers '
+                         'must be stopped.'.format(tracker_id))
+    responses = json.loads(vals[stop_idx[occurrence]])['responses']
+    # feed in responses from tracker_ID_stop
+    for r in responses:
+        tr.respond(r)
+    return tr
+
+
+def _identify_trackers(vals, index):
+    """Get the ID, type, and occurrence number of each tracker."""
+    out = []
+    counts = dict()  # they can have repeat names!
+    for ii in index.get('tracker_identify', []):
+        info = ast.literal_eval(vals[ii])
+        tracker_id = info['tracker_id']
+        occurrence = counts.get(tracker_id, 0)
+        counts[tracker_id] = occurrence + 1
+        out.append((tracker_id, info['tracker_type'], occurrence))
+    return out
+
+
 def reconstruct_tracker(fname):
     """Reconstruct TrackerUD, TrackerBinom, TrackerMHW objects from .tab files.
 
@@ -142,51 +448,18 @@ def reconstruct_tracker(fname):
         the generation of the file.) If only one tracker is found in the file,
         it will still be stored in a list and will be accessible as ``tr[0]``.
     """
-    from ..stimuli import TrackerUD, TrackerBinom, TrackerMHW
-    # read in raw data
-    raw = read_tab_raw(fname)
-
-    # find tracker_identify and make list of IDs
-    tracker_idx = np.where([r[1] == 'tracker_identify' for r in raw])[0]
-    if len(tracker_idx) == 0:
+    vals, index = _read_tab_index(fname)
+    trackers = _identify_trackers(vals, index)
+    if len(trackers) == 0:
         raise ValueError('There are no Trackers in this file.')
-    tr = []
-    used_dict_idx = []  # they can have repeat names!
-    used_stop_idx = []
-    for ii in tracker_idx:
-        tracker_id = ast.literal_eval(raw[ii][2])['tracker_id']
-        tracker_type = ast.literal_eval(raw[ii][2])['tracker_type']
-        # find tracker_ID_init lines and get dict
-        init_str = 'tracker_' + str(tracker_id) + '_init'
-        tracker_dict_idx = np.where([r[1] == init_str for r in raw])[0]
-        tracker_dict_idx = np.setdiff1d(tracker_dict_idx, used_dict_idx)
-        tracker_dict_idx = tracker_dict_idx[0]
-        used_dict_idx.append(tracker_dict_idx)
-        tracker_dict = json.loads(raw[tracker_dict_idx][2])
-        td = dict(TrackerUD=TrackerUD, TrackerBinom=TrackerBinom,
-                  TrackerMHW=TrackerMHW)
-        tr.append(td[tracker_type](**tracker_dict))
-        tr[-1]._tracker_id = tracker_id  # make sure tracker has original ID
-        stop_str = 'tracker_' + str(tracker_id) + '_stop'
-        tracker_stop_idx = np.where([r[1] == stop_str for r in raw])[0]
-        tracker_stop_idx = np.setdiff1d(tracker_stop_idx, used_stop_idx)
-        if len(tracker_stop_idx) == 0:
-            raise ValueError('Tracker {} has not stopped. All Trackers '
-                             'must be stopped.'.format(tracker_id))
-        tracker_stop_idx = tracker_stop_idx[0]
-        used_stop_idx.append(tracker_stop_idx)
-        responses = json.loads(raw[tracker_stop_idx][2])['responses']
-        # feed in responses from tracker_ID_stop
-        for r in responses:
-            tr[-1].respond(r)
-    return tr
+    return [_reconstruct_tracker(vals, index, *info) for info in trackers]
 
 
 def reconstruct_dealer(fname):
     """Reconstruct TrackerDealer object from .tab files.
 
-    The ``reconstruct_tracker`` function will be called to retrieve the
-    trackers.
+    The trackers of each dealer are reconstructed as in
+    :func:`reconstruct_tracker`.
 
     Parameters
     ----------
@@ -201,27 +474,26 @@ def reconstruct_dealer(fname):
         still be stored in a list and will be assessible as ``td[0]``.
     """
     from ..stimuli import TrackerDealer
-    raw = read_tab_raw(fname)
+    vals, index = _read_tab_index(fname)
 
     # find info on dealer
-    dealer_idx = np.where([r[1] == 'dealer_identify' for r in raw])[0]
+    dealer_idx = index.get('dealer_identify', [])
     if len(dealer_idx) == 0:
         raise ValueError('There are no TrackerDealers in this file.')
+    # the first tracker with a given ID is the one a dealer will use
+    tracker_info = dict()
+    for info in _identify_trackers(vals, index):
+        tracker_info.setdefault(info[0], info)
     dealer = []
     for ii in dealer_idx:
-        dealer_id = ast.literal_eval(raw[ii][2])['dealer_id']
+        dealer_id = ast.literal_eval(vals[ii])['dealer_id']
         dealer_init_str = 'dealer_' + str(dealer_id) + '_init'
-        dealer_dict_idx = np.where([r[1] == dealer_init_str
-                                    for r in raw])[0][0]
-        dealer_dict = ast.literal_eval(raw[dealer_dict_idx][2])
+        dealer_dict = ast.literal_eval(vals[index[dealer_init_str][0]])
         dealer_trackers = dealer_dict['trackers']
 
         # match up tracker objects to id
-        trackers = reconstruct_tracker(fname)
-        tr_objects = []
-        for t in dealer_trackers:
-            idx = np.where([t == t_id._tracker_id for t_id in trackers])[0][0]
-            tr_objects.append(trackers[idx])
+        tr_objects = [_reconstruct_tracker(vals, index, *tracker_info[t])
+                      for t in dealer_trackers]
 
         # make the dealer object
         max_lag = dealer_dict['max_lag']
@@ -230,11 +502,11 @@ def reconstruct_dealer(fname):
 
         # force input responses/log data
         dealer_stop_str = 'dealer_' + str(dealer_id) + '_stop'
-        dealer_stop_idx = np.where([r[1] == dealer_stop_str for r in raw])[0]
+        dealer_stop_idx = index.get(dealer_stop_str, [])
         if len(dealer_stop_idx) == 0:
             raise ValueError('TrackerDealer {} has not stopped. All dealers '
                              'must be stopped.'.format(dealer_id))
-        dealer_stop_log = json.loads(raw[dealer_stop_idx[0]][2])
+        dealer_stop_log = json.loads(vals[dealer_stop_idx[0]])
 
         shape = tuple(dealer_dict['shape'])
         log_response_history = dealer_stop_log['response_history']
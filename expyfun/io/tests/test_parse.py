@@ -1,9 +1,14 @@
+import os.path as op
+
 import numpy as np
 import pytest
 from numpy.testing import assert_equal
 
 from expyfun import ExperimentController, __version__
-from expyfun.io import read_tab, reconstruct_tracker, reconstruct_dealer
+from expyfun.io import (read_tab, reconstruct_tracker, reconstruct_dealer,
+                        read_tab_raw, read_tab_columns, iter_tab,
+                        read_tab_batch, read_tab_binary, tab_to_binary,
+                        binary_to_tab)
 from expyfun._utils import _TempDir
 from expyfun.stimuli import TrackerUD, TrackerBinom, TrackerDealer
 
@@ -48,6 +53,43 @@ def test_parse(hide_window):
     assert_equal(params['version_used'], __version__)
     assert (params['file'].endswith('test_parse.py'))
 
+    # columnar and chunked reading
+    raw = read_tab_raw(ec.data_fname)
+    cols = read_tab_columns(ec.data_fname)
+    assert_equal(cols['timestamp'], [r[0] for r in raw])
+    assert_equal([cols['event_names'][c] for c in cols['event']],
+                 [r[1] for r in raw])
+    assert_equal(list(cols['value']), [r[2] for r in raw])
+    assert_equal(cols['event_names'], sorted(cols['event_names']))
+    for group_end in ('trial_ok', None):
+        data = read_tab(ec.data_fname, group_end=group_end)
+        for chunk_size in (1, 2, 3, 7, 1000):
+            assert_equal(list(iter_tab(ec.data_fname, group_end=group_end,
+                                       chunk_size=chunk_size)), data)
+    pytest.raises(ValueError, list, iter_tab(ec.data_fname, chunk_size=0))
+    pytest.raises(ValueError, list, iter_tab(ec.data_fname, 'foo'))
+    pytest.raises(RuntimeError, list, iter_tab(ec.data_fname,
+                                               group_end='misc'))
+
+    # batch reading, with one bad file
+    bad_fname = op.join(temp_dir, 'bad.tab')
+    with open(bad_fname, 'w') as fid:
+        fid.write('garbage\n')
+    batch, errors = read_tab_batch([ec.data_fname, bad_fname, ec.data_fname])
+    assert_equal(list(errors.keys()), [bad_fname])
+    data = read_tab(ec.data_fname)
+    n_rows = sum(len(v) for d in data for v in d.values())
+    assert_equal(len(batch['trial']), 2 * n_rows)
+    assert_equal(set(batch['participant']), set(['foo']))
+    assert_equal(set(batch['session']), set(['01']))
+    assert_equal(set(batch['trial']), set([0, 1]))
+    mask = (batch['trial'] == 1) & (batch['event'] == 'misc')
+    assert_equal(list(batch['value'][mask]), ['trial two'] * 2)
+    assert_equal(batch['timestamp'][mask][0], data[1]['misc'][0][1])
+    batch, errors = read_tab_batch([bad_fname])
+    assert_equal(len(errors), 1)
+    assert_equal(len(batch['timestamp']), 0)
+
 
 def test_reconstruct(hide_window):
     """Test Tracker objects reconstruction."""
@@ -93,6 +135,25 @@ def test_reconstruct(hide_window):
     assert (td.shape == dealer.shape)
     assert (td.trackers.shape == dealer.trackers.shape)
 
+    # test with multiple dealers in one file
+    with ExperimentController(*std_args, **std_kwargs) as ec:
+        tds = list()
+        for _ in range(2):
+            tr = [TrackerUD(ec, 1, 1, 3, 1, 5, np.inf, 3) for _ in range(2)]
+            tds.append(TrackerDealer(ec, tr))
+            for _, x_current in tds[-1]:
+                tds[-1].respond(np.random.rand() < x_current)
+
+    trackers = reconstruct_tracker(ec.data_fname)
+    assert_equal(len(trackers), 4)
+    dealers = reconstruct_dealer(ec.data_fname)
+    assert_equal(len(dealers), 2)
+    for td, dealer in zip(tds, dealers):
+        assert_equal(td._x_history, dealer._x_history)
+        assert_equal(td._tracker_history, dealer._tracker_history)
+        assert_equal([t._tracker_id for t in td.trackers.ravel()],
+                     [t._tracker_id for t in dealer.trackers.ravel()])
+
     # no tracker/dealer in file
     with ExperimentController(*std_args, **std_kwargs) as ec:
         ec.identify_trial(ec_id='one', ttl_id=[0])
@@ -104,3 +165,36 @@ def test_reconstruct(hide_window):
 
     pytest.raises(ValueError, reconstruct_tracker, ec.data_fname)
     pytest.raises(ValueError, reconstruct_dealer, ec.data_fname)
+
+
+def test_binary(hide_window):
+    """Test binary sidecar writing, reading, and conversion."""
+    kwargs = dict(std_kwargs, binary_log=True)
+    with ExperimentController(*std_args, **kwargs) as ec:
+        ec.identify_trial(ec_id='one', ttl_id=[0])
+        ec.start_stimulus()
+        ec.write_data_line('misc', u'tab\tnewline\n"quote" é')
+        ec.write_data_line('misc', 1.5, timestamp=10.)
+        ec.stop()
+        ec.trial_ok()
+    cols, params = read_tab_columns(ec.data_fname, return_params=True)
+    bins, bin_params = read_tab_binary(ec.data_fname, return_params=True)
+    assert_equal(bin_params, params)
+    assert_equal(sorted(bins.keys()), sorted(cols.keys()))
+    for key in cols:
+        assert_equal(list(bins[key]), list(cols[key]))
+    assert (isinstance(bins['timestamp'], np.memmap))
+    # round-trip through the .tab format
+    fname_out = op.join(temp_dir, 'rebuilt.tab')
+    binary_to_tab(ec.data_fname, fname_out)
+    pytest.raises(IOError, binary_to_tab, ec.data_fname, fname_out)
+    with open(ec.data_fname, 'r') as fid:
+        orig = fid.read()
+    with open(fname_out, 'r') as fid:
+        assert_equal(fid.read(), orig)
+    pytest.raises(IOError, tab_to_binary, fname_out[:-4] + '.evt')
+    tab_to_binary(fname_out)
+    pytest.raises(IOError, tab_to_binary, fname_out)
+    tab_to_binary(fname_out, overwrite=True)
+    assert_equal(read_tab_binary(fname_out)['value'], cols['value'])
+    assert_equal(read_tab(fname_out), read_tab(ec.data_fname))
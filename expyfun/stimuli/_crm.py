@@ -8,15 +8,20 @@
 from multiprocessing import cpu_count
 import os
 from os.path import join
+import threading
+import warnings
 from zipfile import ZipFile
 
 import numpy as np
+from scipy.io import wavfile
 
 from ..io import read_wav, write_wav
-from .._parallel import parallel_func
+from .._parallel import parallel_func, _check_n_jobs
+from .._resample import resample, _get_ratio
 from ._stimuli import window_edges
 from .. import visual as vis
-from .._utils import fetch_data_file, _get_user_home_path
+from .._utils import (fetch_data_file, _get_user_home_path, _LRUCache,
+                      logger)
 
 _fs_binary = 40e3  # the sampling rate of the original corpus binaries
 _rms_binary = 0.099977227591239365  # the RMS of the original corpus binaries
@@ -107,6 +112,12 @@ _n_talkers = 4
 _n_callsigns = 8
 _n_colors = 4
 _n_numbers = 8
+_shape = (_n_sexes, _n_talkers, _n_callsigns, _n_colors, _n_numbers)
+
+# packed corpus: all sentences of a sampling rate concatenated in one array,
+# with the (start, stop) of each sentence in an index (-1 if not prepared)
+_fname_packed = 'crm.npy'
+_fname_index = 'crm_index.npy'
 
 
 def _check(name, value):
@@ -151,19 +162,28 @@ def _read_binary(zip_file, callsign, color, number,
         return x
 
 
-def _prepare_stim(zfn, path_out, sex, tal, cal, col, num, fs_out, dtype,
-                  ref_rms, n_jobs):
-    """Read in a binary CRM file and write out a scaled resampled wav.
+def _prepare_talker(zfn, path_out, sex, tal, fs_out, dtype, ref_rms):
+    """Read in all binary CRM files of a talker and write scaled wavs.
     """
-    from mne.filter import resample
-    zip_file = ZipFile(zfn)
-    x = _read_binary(zip_file, cal, col, num, 0)
-    fn = '%i%i%i%i%i.wav' % (sex, tal, cal, col, num)
+    ids = [(cal, col, num) for cal in range(_n_callsigns)
+           for col in range(_n_colors) for num in range(_n_numbers)]
+    with ZipFile(zfn) as zip_file:
+        xs = [_read_binary(zip_file, cal, col, num, 0)
+              for cal, col, num in ids]
+    lens = np.array([len(x) for x in xs])
+    batch = np.zeros((len(xs), lens.max()), np.float32)
+    for x, row in zip(xs, batch):
+        row[:len(x)] = x
     if int(np.round(fs_out)) != int(np.round(_fs_binary)):
-        x = resample(x, fs_out, _fs_binary, n_jobs=n_jobs, verbose=0)
-    x *= ref_rms / _rms_binary
-    write_wav(join(path_out, fn), x, fs_out, overwrite=True, dtype=dtype,
-              verbose=False)
+        # resampling zero-pads anyway, so padding does not change the result
+        batch = resample(batch, _fs_binary, fs_out)
+        up, down = _get_ratio(_fs_binary, fs_out)
+        lens = -(-lens * up // down)
+    batch *= ref_rms / _rms_binary
+    for (cal, col, num), x, n in zip(ids, batch, lens):
+        fn = '%i%i%i%i%i.wav' % (sex, tal, cal, col, num)
+        write_wav(join(path_out, fn), x[:n], fs_out, overwrite=True,
+                  dtype=dtype, verbose=False)
 
 
 def crm_prepare_corpus(fs, path_out=None, overwrite=False, dtype=np.float64,
@@ -184,9 +204,11 @@ def crm_prepare_corpus(fs, path_out=None, overwrite=False, dtype=np.float64,
     dtype : type
         The data type for saving the data. ``np.float64`` is the default for
         maintaining fidelity. ``np.int16`` is standard for wav files.
-    n_jobs : int | ``'cuda'`` | ``None``
-        Number of cores to use. The fastest option, if enabled, is ``'cuda'``.
+    n_jobs : int | ``None``
+        Number of cores to use. Talkers are prepared in parallel.
         If ``None`` it will use all available cores except for one.
+        ``'cuda'`` is no longer supported; it uses one core (with a
+        warning).
     verbose : bool
         Whether or not to output status as stimuli are prepared.
     talker_list : list of dict
@@ -195,13 +217,24 @@ def crm_prepare_corpus(fs, path_out=None, overwrite=False, dtype=np.float64,
         eight talkers (four female, four male), and it is strongly recommended
         to that you do so to avoid headaches. This option is mainly for
         expedient unit tests.
+
+    Notes
+    -----
+    In addition to one wav file per sentence, all prepared sentences at the
+    sampling rate are packed into a single float32 ``.npy`` array (plus an
+    index) that :class:`expyfun.stimuli.CRMPreload` memory-maps.
     """
     if path_out is None:
         path_out = join(_get_user_home_path(), '.expyfun', 'data', 'crm')
-    if n_jobs is None:
-        n_jobs = cpu_count() - 1
-    if n_jobs != 'cuda':
-        n_jobs = min([n_jobs, cpu_count()])
+    if n_jobs == 'cuda':
+        warnings.warn('n_jobs="cuda" is no longer supported, using one CPU '
+                      'core instead')
+        n_jobs = 1
+    elif n_jobs is None:
+        n_jobs = max(cpu_count() - 1, 1)
+    elif n_jobs == np.inf:  # all cores
+        n_jobs = cpu_count()
+    n_jobs = min(_check_n_jobs(n_jobs), cpu_count())
     if not os.path.isdir(path_out):
         os.makedirs(path_out)
 
@@ -226,35 +259,67 @@ def _crm_prepare_corpus_helper(fs, path_out, overwrite, dtype, n_jobs,
     elif not overwrite:
         raise RuntimeError('Directory already exists and overwrite=False')
 
-    cn = [[c, n] for c in range(_n_colors) for n in range(_n_numbers)]
+    talkers = [(sex, tal) for sex in range(_n_sexes)
+               for tal in range(_n_talkers)
+               if dict(sex=sex, talker_num=tal) in talker_list]
+    parallel, p_fun, n_jobs = parallel_func(
+        _prepare_talker, max(min(n_jobs, len(talkers)), 1))
     from time import time
     start_time = time()
-    for sex in range(_n_sexes):
+    for ti in range(0, len(talkers), n_jobs):
+        these = talkers[ti:ti + n_jobs]
+        parallel(p_fun(_get_talker_zip_file(sex, tal), path_out_fs, sex, tal,
+                       fs, dtype, _rms_prepped) for sex, tal in these)
         if verbose:
-            print('Preparing sex %i.' % sex)
-        for tal in range(_n_talkers):
-            if dict(sex=sex, talker_num=tal) in talker_list:
-                zfn = _get_talker_zip_file(sex, tal)
-                if verbose:
-                    print('    Preparing talker %i.' % tal),
-                if n_jobs != 'cuda':
-                    parallel, p_fun, _ = parallel_func(_prepare_stim, n_jobs)
-                    parallel(p_fun(
-                        zfn, path_out_fs, sex, tal, cal, col, num, fs, dtype,
-                        _rms_prepped, n_jobs=1) for
-                        col, num in cn for cal in range(_n_callsigns))
-                else:
-                    for cal in range(_n_callsigns):
-                        for col, num in cn:
-                            _prepare_stim(zfn, path_out_fs, sex, tal, cal, col,
-                                          num, fs, dtype, _rms_prepped,
-                                          n_jobs='cuda')
-                if verbose:
-                    print('')
+            n_done = ti + len(these)
+            elapsed = (time() - start_time) / 60.
+            remaining = elapsed * (len(talkers) - n_done) / float(n_done)
+            print('Prepared %i/%i talkers (%0.1f min elapsed, about %0.1f '
+                  'min remaining).' % (n_done, len(talkers), elapsed,
+                                       remaining))
+    _write_packed(path_out_fs)
     if verbose:
         print('Finished in %0.1f minutes.' % ((time() - start_time) / 60.))
 
 
+def _pack_corpus(path, fname=None):
+    """Pack the prepared wav files in a directory into one array.
+
+    If ``fname`` is given, the array is written to it as a ``.npy`` memmap one
+    sentence at a time, instead of being built in memory.
+    """
+    index = np.full(_shape + (2,), -1, np.int64)
+    offset = 0
+    for ids in np.ndindex(*_shape):  # the lengths, without reading the data
+        fn = join(path, '%i%i%i%i%i.wav' % ids)
+        if os.path.isfile(fn):
+            n_samp = len(wavfile.read(fn, mmap=True)[1])
+            index[ids] = (offset, offset + n_samp)
+            offset += n_samp
+    if fname is None or offset == 0:  # memmaps cannot be empty
+        data = np.zeros(offset, np.float32)
+        if fname is not None:
+            np.save(fname, data)
+    else:
+        data = np.lib.format.open_memmap(fname, 'w+', np.float32, (offset,))
+    for ids in np.ndindex(*_shape):
+        start, stop = index[ids]
+        if start >= 0:
+            fn = join(path, '%i%i%i%i%i.wav' % ids)
+            data[start:stop] = read_wav(fn, verbose=False)[0][0]
+        if isinstance(data, np.memmap) and ids[2:] == (
+                _n_callsigns - 1, _n_colors - 1, _n_numbers - 1):
+            data.flush()  # after each talker
+    return data, index
+
+
+def _write_packed(path):
+    """Write the packed version of the prepared corpus in a directory."""
+    data, index = _pack_corpus(path, join(path, _fname_packed))
+    del data  # close the memmap
+    np.save(join(path, _fname_index), index)
+
+
 # Read a CRM wav file that has been prepared for use with expyfun
 def crm_sentence(fs, sex, talker_num, callsign, color, number, ref_rms=0.01,
                  ramp_dur=0.01, stereo=False, path=None):
@@ -464,30 +529,145 @@ class CRMPreload(object):
     path : str
         The location of the stimulus directory. Defaults to the data directory
         where the raw CRM originals are stored.
+    copy : bool
+        If False and ``ref_rms=0.01`` and ``ramp_dur=0``, :meth:`sentence`
+        returns read-only float32 views of the corpus instead of copies.
+        With ``lazy=True``, it returns the read-only cached arrays.
+    lazy : bool
+        If True, do not load anything up front. Instead, each sentence is
+        loaded (and scaled, ramped, etc.) the first time it is requested, and
+        kept in a least-recently-used cache. See also :meth:`warm`.
+    cache_size : float
+        The maximum size (in bytes) of the cache used when ``lazy=True``.
+
+    Notes
+    -----
+    The corpus is stored as a single packed array by
+    :func:`expyfun.stimuli.crm_prepare_corpus`, which is memory-mapped so
+    that loading is fast and the memory is shared between processes. For
+    corpora prepared with older versions of expyfun, the packed array is
+    built in memory from the wav files instead (or, with ``lazy=True``,
+    sentences are read from their wav files); re-run
+    :func:`expyfun.stimuli.crm_prepare_corpus` to create it on disk.
+    Scaling, ramping, and stereo conversion are done when a sentence is
+    requested.
     """
 
     def __init__(self, fs, ref_rms=0.01, ramp_dur=0.01, stereo=False,
-                 path=None):
+                 path=None, copy=True, lazy=False, cache_size=256e6):
         if path is None:
             path = join(_get_user_home_path(), '.expyfun', 'data', 'crm')
-        if not os.path.isdir(join(path, str(fs))):
+        path = join(path, str(fs))
+        if not os.path.isdir(path):
             raise RuntimeError('prepare_corpus has not yet been run '
                                'for sampling rate of %i' % fs)
-        self._excluded = []
-        self._all_stim = {}
-        for sex in range(_n_sexes):
-            for tal in range(_n_talkers):
-                for cal in range(_n_callsigns):
-                    for col in range(_n_colors):
-                        for num in range(_n_numbers):
-                            stim_id = '%i%i%i%i%i' % (sex, tal, cal, col, num)
-                            try:
-                                self._all_stim[stim_id] = \
-                                    crm_sentence(fs, sex, tal, cal, col, num,
-                                                 ref_rms, ramp_dur, stereo,
-                                                 path)
-                            except Exception:
-                                self._excluded += [stim_id]
+        fname = join(path, _fname_packed)
+        fname_index = join(path, _fname_index)
+        if os.path.isfile(fname) and os.path.isfile(fname_index):
+            self._data = np.load(fname, mmap_mode='r')
+            self._index = np.load(fname_index)
+        elif lazy:
+            self._data = self._index = None
+        else:
+            self._data, self._index = _pack_corpus(path)
+            self._data.flags.writeable = False
+        self._path = path
+        self._scale = ref_rms / _rms_prepped
+        self._ramp_dur = ramp_dur
+        self._stereo = stereo
+        self._copy = copy
+        self._cache = _LRUCache(cache_size) if lazy else None
+
+    def _is_prepared(self, ids):
+        if self._index is None:
+            return os.path.isfile(join(self._path, '%i%i%i%i%i.wav' % ids))
+        return self._index[ids][0] >= 0
+
+    def _load(self, ids):
+        """Load and process a sentence."""
+        if not self._is_prepared(ids):
+            raise RuntimeError('prepare_corpus has not yet been run for the '
+                               'requested talker')
+        if self._index is None:
+            x = read_wav(join(self._path, '%i%i%i%i%i.wav' % ids),
+                         verbose=False)[0][0].astype(np.float32)
+        else:
+            start, stop = self._index[ids]
+            x = np.asarray(self._data[start:stop])
+        if self._copy or self._scale != 1 or self._ramp_dur:
+            x = x * self._scale
+            if self._ramp_dur:
+                x = window_edges(x, _fs_binary, dur=self._ramp_dur)
+            if self._stereo:
+                x = np.tile(x[np.newaxis, :], (2, 1))
+        elif self._stereo:
+            x = np.broadcast_to(x, (2, len(x)))
+        return x
+
+    def _get(self, ids):
+        """Get a sentence from the cache, loading it if necessary."""
+        x = self._cache.get(ids)
+        if x is None:
+            x = self._load(ids)
+            if x.flags.writeable:
+                x.flags.writeable = False
+            self._cache.put(ids, x, x.nbytes)
+        return x
+
+    def warm(self, subset=None):
+        """Load sentences into the cache on a background thread.
+
+        Parameters
+        ----------
+        subset : list of dict | None
+            The sentences to load. Each dict can have keys ``sex``,
+            ``talker_num``, ``callsign``, ``color``, and ``number``; all
+            values are used for missing keys. For example,
+            ``[dict(sex='f', talker_num=0)]`` loads all sentences of one
+            talker. Sentences that have not been prepared are skipped.
+            None (default) loads all prepared sentences.
+
+        Returns
+        -------
+        thread : instance of threading.Thread
+            The thread loading the sentences. Use ``thread.join()`` to wait
+            for it to finish.
+
+        Notes
+        -----
+        This is only useful with ``lazy=True``. Make sure that
+        ``cache_size`` is large enough to hold the subset.
+        """
+        if self._cache is None:
+            raise RuntimeError('warm can only be used with lazy=True')
+        names = ('sex', 'talker_num', 'callsign', 'color', 'number')
+        ids = list()
+        for sub in [dict()] if subset is None else subset:
+            bad = set(sub) - set(names)
+            if bad:
+                raise ValueError('subset keys must be among %s, got %s'
+                                 % (names, sorted(bad)))
+            vals = [[_check(name, sub[name])] if name in sub else range(n)
+                    for name, n in zip(names, _shape)]
+            these = np.array(np.meshgrid(*vals, indexing='ij')).reshape(
+                len(names), -1).T.tolist()
+            these = [tuple(i) for i in these if self._is_prepared(tuple(i))]
+            if subset is not None and not these:
+                raise RuntimeError('prepare_corpus has not yet been run for '
+                                   'any of the sentences in %s' % (sub,))
+            ids.extend(these)
+        thread = threading.Thread(target=self._warm, args=(ids,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _warm(self, ids):
+        for i in ids:
+            try:
+                self._get(i)
+            except Exception as exp:
+                logger.warning('Expyfun: Could not load CRM sentence '
+                               '%i%i%i%i%i: %s' % (i + (exp,)))
 
     def sentence(self, sex, talker_num, callsign, color, number):
         """Get a specific sentence from the pre-loaded data.
@@ -528,11 +708,10 @@ class CRMPreload(object):
         index of ``'1'`` is 0, so care must be taken if using indices for the
         number argument.
         """
-        stim_id = '%i%i%i%i%i' % (
-            _check('sex', sex), _check('talker_num', talker_num),
-            _check('callsign', callsign), _check('color', color),
-            _check('number', number))
-        if stim_id in self._excluded:
-            raise RuntimeError('prepare_corpus has not yet been run for the '
-                               'requested talker')
-        return self._all_stim[stim_id].copy()
+        ids = (_check('sex', sex), _check('talker_num', talker_num),
+               _check('callsign', callsign), _check('color', color),
+               _check('number', number))
+        if self._cache is None:
+            return self._load(ids)
+        x = self._get(ids)
+        return x.copy() if self._copy else x
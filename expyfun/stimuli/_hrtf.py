@@ -1,11 +1,14 @@
 """Stimulus generation functions
 """
 
+import threading
+
 import numpy as np
 
 from ..io import read_hdf5
-from .._fixes import irfft
-from .._utils import fetch_data_file, _fix_audio_dims
+from .._fixes import irfft, rfft, next_fast_len
+from .._resample import resample
+from .._utils import fetch_data_file, _fix_audio_dims, _LRUCache
 
 # This was used to generate "barb_anech.gz":
 #
@@ -54,60 +57,164 @@ def _get_hrtf(angle, source, fs, interp=False):
        Functions", Australian Government Department of Defence: Defence Science
        and Technology Organization, Melbourne, Victoria, Australia, 2007.
     """
+    db = _get_hrtf_db(source, fs)
+    return db.get_brir(abs(float(angle)), interp), db.fs, angle < 0
+
+
+# HRTF databases, keyed by filename
+_hrtf_dbs = dict()
+_hrtf_dbs_lock = threading.Lock()
+
+
+def _get_hrtf_db(source, fs):
+    """Get the (cached) HRTF database of a source at a sample rate."""
     fname = fetch_data_file('hrtf/{0}_{1}.hdf5'.format(source, fs))
-    data = read_hdf5(fname)
-    angles = data['angles']
-    leftward = False
-    read_angle = float(angle)
-    if angle < 0:
-        leftward = True
-        read_angle = float(-angle)
-    if read_angle not in angles and not interp:
-        raise ValueError('angle "{0}" must be one of +/-{1}'
-                         ''.format(angle, list(angles)))
-    brir = data['brir']
-    if read_angle in angles:
-        interp = False
-    if not interp:
-        idx = np.where(angles == read_angle)[0]
-        if len(idx) != 1:
-            raise ValueError('angle "{0}" not uniquely found in angles'
-                             ''.format(angle))
-        brir = brir[idx[0]]
-    else:  # interpolation
-        if source != 'cipic':
-            raise ValueError('source must be ''cipic'' when interp=True')
+    with _hrtf_dbs_lock:
+        if fname not in _hrtf_dbs:
+            _hrtf_dbs[fname] = _HRTFDatabase(fname, source, fs)
+        return _hrtf_dbs[fname]
+
+
+class _HRTFDatabase(object):
+    """The BRIRs of one source at one sample rate, kept in memory.
+
+    Selected, interpolated, resampled BRIRs and their spectra are memoized in
+    a least-recently-used cache. All returned arrays are read-only.
+    """
 
-        # pull in files containing known hrtfs and extract magnitude and phase
-        fname = fetch_data_file('hrtf/pair_cipic_{0}.hdf5'.format(fs))
+    _cache_size = 64e6  # bytes
+
+    def __init__(self, fname, source, fs):
         data = read_hdf5(fname)
-        hrtf_amp = data['hrtf_amp']
-        hrtf_phase = data['hrtf_phase']
-        pairs = data['pairs']
+        self.source = source
+        self.fs = data['fs']
+        self.angles = np.array(data['angles'], float)
+        self.brir = np.array(data['brir'], np.float64)
+        self.brir.flags.writeable = False
+        self._pair_fs = fs
+        self._pairs = None
+        self._lock = threading.Lock()
+        self._cache = _LRUCache(self._cache_size)
+
+    def _get_pairs(self):
+        """Get the known HRTF pairs as (pairs, log amplitude, phase)."""
+        with self._lock:
+            if self._pairs is None:
+                fname = fetch_data_file('hrtf/pair_cipic_{0}.hdf5'
+                                        ''.format(self._pair_fs))
+                data = read_hdf5(fname)
+                self._pairs = (data['pairs'], np.log(data['hrtf_amp']),
+                               data['hrtf_phase'])
+            return self._pairs
+
+    def _cached(self, key, func, *args):
+        out = self._cache.get(key)
+        if out is None:
+            out = func(*args)
+            out.flags.writeable = False
+            self._cache.put(key, out, out.nbytes)
+        return out
+
+    def _check_angle(self, read_angle, interp):
+        """Check that a nonnegative angle can be read."""
+        read_angle = float(read_angle)
+        if read_angle not in self.angles and not interp:
+            raise ValueError('angle "{0}" must be one of +/-{1}'
+                             ''.format(read_angle, list(self.angles)))
+        return read_angle
+
+    def get_brir(self, read_angle, interp, fs=None):
+        """Get the BRIR for a nonnegative angle, resampled to fs."""
+        read_angle = self._check_angle(read_angle, interp)
+        if fs is not None and np.allclose(self.fs, fs, rtol=0, atol=0.5):
+            fs = None
+        if fs is not None:
+            return self._cached(('brir', read_angle, fs), lambda: resample(
+                self.get_brir(read_angle, interp), self.fs,
+                fs).astype(np.float64))
+        if read_angle in self.angles:
+            idx = np.where(self.angles == read_angle)[0]
+            if len(idx) != 1:
+                raise ValueError('angle "{0}" not uniquely found in angles'
+                                 ''.format(read_angle))
+            return self.brir[idx[0]]
+        return self._cached(('brir', read_angle, None), self._interpolate,
+                            read_angle)
+
+    def get_rfft(self, read_angle, interp, fs, n_fft):
+        """Get the rFFT of the BRIR for a nonnegative angle."""
+        read_angle = self._check_angle(read_angle, interp)
+        return self._cached(('rfft', read_angle, fs, n_fft),
+                            lambda: rfft(self.get_brir(read_angle, interp, fs),
+                                         n_fft))
+
+    def get_partitions(self, read_angle, interp, fs, block_size):
+        """Get the spectra of the BRIR partitions for a nonnegative angle.
+
+        The BRIR is split into blocks of ``block_size`` samples, each of which
+        is zero-padded to ``2 * block_size`` (for overlap-save convolution).
+        """
+        read_angle = self._check_angle(read_angle, interp)
+
+        def _partition():
+            brir = self.get_brir(read_angle, interp, fs)
+            n_parts = -(-brir.shape[-1] // block_size)
+            parts = np.zeros((2, n_parts * block_size))
+            parts[:, :brir.shape[-1]] = brir
+            parts = parts.reshape(2, n_parts, block_size)
+            return rfft(parts, 2 * block_size)
+
+        return self._cached(('partitions', read_angle, fs, block_size),
+                            _partition)
+
+    def _interpolate(self, read_angle):
+        """Interpolate the BRIR for an unknown angle."""
+        if self.source != 'cipic':
+            raise ValueError('source must be ''cipic'' when interp=True')
+        # known hrtfs (log magnitude and phase)
+        pairs, hrtf_log_amp, hrtf_phase = self._get_pairs()
 
         # isolate appropriate pair of amplitude and phase
+        angles = self.angles
         idx = np.searchsorted(angles, read_angle)
         if idx > len(pairs):
             raise ValueError('angle magnitude "{0}" must be smaller than "{1}"'
                              ''.format(read_angle, pairs[-1][-1]))
         knowns = np.array([angles[idx - 1], angles[idx]])
         index = np.where(pairs == knowns)[0][0]
-        hrtf_amp = hrtf_amp[index]
-        hrtf_phase = hrtf_phase[index]
 
         # weighted averages of log magnitude and unwrapped phase
         step = float(knowns[1] - knowns[0])
         weights = (step - np.abs(read_angle - knowns)) / step
-        hrtf_amp = np.prod(hrtf_amp ** weights[:, np.newaxis, np.newaxis],
-                           axis=0)
-        hrtf_phase = np.sum(hrtf_phase * weights[:, np.newaxis, np.newaxis],
-                            axis=0)
+        hrtf_amp = np.exp(np.einsum('k,kef->ef', weights,
+                                    hrtf_log_amp[index]))
+        hrtf_phase = np.einsum('k,kef->ef', weights, hrtf_phase[index])
 
         # reconstruct hrtf and convert to time domain
         hrtf = hrtf_amp * np.exp(1j * hrtf_phase)
-        brir = irfft(hrtf, int(hrtf.shape[-1]))
+        return irfft(hrtf, int(hrtf.shape[-1]))
+
+
+def _check_hrtf_params(fs, source, interp):
+    """Check the parameters and get the sample rate of the BRIRs to use."""
+    known_sources = ['barb', 'cipic']
+    known_fs = [24414, 44100]  # must be sorted
+    if source not in known_sources:
+        raise ValueError('Source "{0}" unknown, must be one of {1}'
+                         ''.format(source, known_sources))
+    if not isinstance(interp, bool):
+        raise ValueError('interp must be bool')
+    # Find out which sampling rate to get--first that is >= fs
+    # Use the last, highest one whether it is high enough or not
+    ge = [int(np.round(fs)) <= k for k in known_fs[:-1]] + [True]
+    return known_fs[ge.index(True)]
+
 
-    return brir, data['fs'], leftward
+def _get_brirs(angles, source, fs, interp):
+    """Get the BRIRs for angles, with ears ordered and resampled to fs."""
+    db = _get_hrtf_db(source, _check_hrtf_params(fs, source, interp))
+    return [db.get_brir(abs(angle), interp, fs)[::-1 if angle < 0 else 1]
+            for angle in angles]
 
 
 def convolve_hrtf(data, fs, angle, source='cipic', interp=False):
@@ -186,25 +293,165 @@ def convolve_hrtf(data, fs, angle, source='cipic', interp=False):
     """
     fs = float(fs)
     angle = float(angle)
-    known_sources = ['barb', 'cipic']
-    known_fs = [24414, 44100]  # must be sorted
-    if source not in known_sources:
-        raise ValueError('Source "{0}" unknown, must be one of {1}'
-                         ''.format(source, known_sources))
-    if not isinstance(interp, bool):
-        raise ValueError('interp must be bool')
     data = np.array(data, np.float64)
+    _check_hrtf_params(fs, source, interp)
     data = _fix_audio_dims(data, n_channels=1).ravel()
-
-    # Find out which sampling rate to get--first that is >= fs
-    # Use the last, highest one whether it is high enough or not
-    ge = [int(np.round(fs)) <= k for k in known_fs[:-1]] + [True]
-    brir_fs = known_fs[ge.index(True)]
-
-    brir, brir_fs, leftward = _get_hrtf(angle, source, brir_fs, interp)
-    order = [1, 0] if leftward else [0, 1]
-    if not np.allclose(brir_fs, fs, rtol=0, atol=0.5):
-        from mne.filter import resample
-        brir = [resample(b, fs, brir_fs) for b in brir]
-    out = np.array([np.convolve(data, brir[o]) for o in order])
+    brir = _get_brirs([angle], source, fs, interp)[0]
+    out = np.array([np.convolve(data, b) for b in brir])
     return out
+
+
+def convolve_hrtf_batch(signals, fs, angles, source='cipic', interp=False):
+    """Convolve many signals with HRTFs and mix them.
+
+    Parameters
+    ----------
+    signals : list of array-like | array-like
+        The mono signals, either as a list of 1D arrays (which can have
+        different lengths) or as a 2D array of shape
+        ``(n_signals, n_samples)``.
+    fs : float
+        The sample rate of the data. (HRTFs will be resampled if necessary.)
+    angles : array-like
+        The azimuthal angle of the HRTF for each signal.
+    source : str
+        Source to use for HRTFs. Currently `'barb'` and `'cipic'` are
+        supported.
+    interp : bool
+        Parameter to determine whether to restrict use to known HRTF values or
+        to use an interpolated HRTF for angles not in the source.
+
+    Returns
+    -------
+    data_hrtf : array
+        A 2D array ``shape=(2, n_samples)`` containing the sum of the
+        convolved signals, where ``n_samples`` is the length of the longest
+        signal plus the length of the BRIRs minus one.
+
+    See Also
+    --------
+    convolve_hrtf
+
+    Notes
+    -----
+    This gives the same result as summing the outputs of
+    :func:`convolve_hrtf` (with shorter outputs zero-padded at the end), but
+    the HRTF files are read once, signals at the same angle are combined
+    before filtering, and the convolutions are done in the frequency domain.
+    The spectra of the BRIRs are cached, so repeated calls with signals of
+    the same length are faster.
+    """
+    fs = float(fs)
+    _check_hrtf_params(fs, source, interp)
+    signals = [_fix_audio_dims(np.array(sig, np.float64), n_channels=1).ravel()
+               for sig in signals]
+    angles = np.array(angles, float).ravel()
+    if len(signals) == 0 or len(signals) != len(angles):
+        raise ValueError('There must be one angle for each signal, got %s '
+                         'angles and %s signals' % (len(angles), len(signals)))
+    # signals at the same angle can be mixed before filtering
+    unique_angles, inverse = np.unique(angles, return_inverse=True)
+    n_samples = max(len(sig) for sig in signals)
+    mixed = np.zeros((len(unique_angles), n_samples))
+    for sig, ii in zip(signals, inverse):
+        mixed[ii, :len(sig)] += sig
+    db = _get_hrtf_db(source, _check_hrtf_params(fs, source, interp))
+    n_out = n_samples + db.get_brir(abs(unique_angles[0]), interp,
+                                    fs).shape[-1] - 1
+    n_fft = next_fast_len(n_out)
+    brirs = np.array([db.get_rfft(abs(angle), interp, fs, n_fft)
+                      [::-1 if angle < 0 else 1] for angle in unique_angles])
+    spectrum = np.einsum('af,aef->ef', rfft(mixed, n_fft), brirs)
+    return irfft(spectrum, n_fft)[:, :n_out]
+
+
+def convolve_hrtf_moving(data, fs, angles, source='cipic', interp=False,
+                         block_size=512):
+    """Convolve a signal with HRTFs that change over time
+
+    Parameters
+    ----------
+    data : 1-dimensional or 1xN array-like
+        Data to operate on.
+    fs : float
+        The sample rate of the data. (HRTFs will be resampled if necessary.)
+    angles : array-like
+        The azimuthal angle trajectory. The values are taken to be evenly
+        spaced in time from the first to the last sample of ``data`` (so
+        there can be e.g. one value per sample, or just the start and end
+        angles), and are linearly interpolated to get the angle of each
+        block.
+    source : str
+        Source to use for HRTFs. Currently `'barb'` and `'cipic'` are
+        supported.
+    interp : bool
+        Parameter to determine whether to restrict use to known HRTF values or
+        to use an interpolated HRTF for angles not in the source. Continuous
+        trajectories require ``interp=True``.
+    block_size : int
+        The number of samples in each block. The HRTF is updated once per
+        block, so smaller blocks give smoother motion at a higher
+        computational cost.
+
+    Returns
+    -------
+    data_hrtf : array
+        A 2D array ``shape=(2, n_samples)`` containing the convolved data.
+
+    See Also
+    --------
+    convolve_hrtf
+    convolve_hrtf_batch
+
+    Notes
+    -----
+    The signal is filtered with uniformly partitioned overlap-save FFT
+    convolution. Within each block, the output obtained with the HRTF of
+    the previous block is cross-faded (with a raised cosine) into the output
+    obtained with the HRTF of the current block, which avoids clicks when the
+    HRTF changes. For a constant angle, the output is the same as that of
+    :func:`convolve_hrtf`.
+    """
+    fs = float(fs)
+    block_size = int(block_size)
+    if block_size < 1:
+        raise ValueError('block_size must be positive, got %s' % block_size)
+    db = _get_hrtf_db(source, _check_hrtf_params(fs, source, interp))
+    data = _fix_audio_dims(np.array(data, np.float64), n_channels=1).ravel()
+    angles = np.array(angles, float).ravel()
+    if len(angles) == 0:
+        raise ValueError('angles must not be empty')
+    n_taps = db.get_brir(abs(angles[0]), interp, fs).shape[-1]
+    n_out = len(data) + n_taps - 1
+    n_blocks = -(-n_out // block_size)
+
+    # the angle of each block (at its center)
+    times = (np.arange(n_blocks) + 0.5) * block_size
+    block_angles = np.interp(times, np.linspace(0, len(data) - 1,
+                                                len(angles)), angles)
+    unique_angles, idx = np.unique(block_angles, return_inverse=True)
+    spectra = np.array([db.get_partitions(abs(angle), interp, fs,
+                                          block_size)[::-1 if angle < 0 else 1]
+                        for angle in unique_angles])
+    idx_prev = np.concatenate((idx[:1], idx[:-1]))
+
+    # overlap-save: block k uses the input of blocks k - 1 and k
+    x = np.zeros((n_blocks + 1) * block_size)
+    x[block_size:block_size + len(data)] = data
+    segments = x[np.arange(n_blocks)[:, np.newaxis] * block_size +
+                 np.arange(2 * block_size)]
+    x_spectra = rfft(segments, 2 * block_size)[:, np.newaxis]
+    y_cur = np.zeros((n_blocks, 2, block_size + 1), np.complex128)
+    y_prev = np.zeros_like(y_cur)
+    for pi in range(spectra.shape[2]):
+        xs = x_spectra[:n_blocks - pi]
+        y_cur[pi:] += xs * spectra[idx[pi:], :, pi]
+        y_prev[pi:] += xs * spectra[idx_prev[pi:], :, pi]
+    y_cur = irfft(y_cur, 2 * block_size)[..., block_size:]
+    y_prev = irfft(y_prev, 2 * block_size)[..., block_size:]
+
+    # cross-fade from the previous HRTF to the current one in each block
+    fade = 0.5 - 0.5 * np.cos(np.pi * (np.arange(block_size) + 0.5) /
+                              block_size)
+    out = y_prev + (y_cur - y_prev) * fade
+    return out.transpose(1, 0, 2).reshape(2, -1)[:, :n_out]
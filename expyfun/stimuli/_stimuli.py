@@ -11,7 +11,28 @@ from .._sound_controllers import SoundPlayer
 from .._utils import _wait_secs, string_types
 
 
-def window_edges(sig, fs, dur=0.01, axis=-1, window='hann', edges='both'):
+# rising half-windows, keyed by (window, win_len)
+_tapers = dict()
+
+
+def _get_taper(window, win_len):
+    """Get the (cached, read-only) rising half of a window."""
+    key = (window, win_len)
+    if key not in _tapers:
+        if window == 'dpss':
+            win = signal.windows.dpss(2 * win_len + 1, 1)[:win_len]
+            if win_len > 0:
+                win -= win[0]
+                win /= win.max()
+        else:
+            win = signal.windows.get_window(window, 2 * win_len)[:win_len]
+        win.flags.writeable = False
+        _tapers[key] = win
+    return _tapers[key]
+
+
+def window_edges(sig, fs, dur=0.01, axis=-1, window='hann', edges='both',
+                 copy=True):
     """Window the edges of a signal (e.g., to prevent "pops")
 
     Parameters
@@ -29,41 +50,44 @@ def window_edges(sig, fs, dur=0.01, axis=-1, window='hann', edges='both'):
         ``scipy.signal.get_window()``, but can also be 'dpss'.
     edges : str
         Can be ``'leading'``, ``'trailing'``, or ``'both'`` (default).
+    copy : bool
+        If True (default), window a float64 copy of ``sig``. If False,
+        ``sig`` must be a floating-point array, which is windowed in place.
 
     Returns
     -------
     windowed_sig : array-like
-        The modified array (float64).
+        The modified array (float64 if ``copy=True``).
+
+    Notes
+    -----
+    The windows are cached, and only the samples at the edges are
+    modified.
     """
     fs = float(fs)
-    sig = np.array(sig, dtype=np.float64)  # this will make a copy
+    if copy:
+        sig = np.array(sig, dtype=np.float64)  # this will make a copy
+    elif not (isinstance(sig, np.ndarray) and
+              np.issubdtype(sig.dtype, np.floating)):
+        raise ValueError('sig must be a floating-point array when '
+                         'copy=False, got %s' % type(sig))
     sig_len = sig.shape[axis]
     win_len = int(dur * fs)
     if win_len > sig_len:
         raise RuntimeError('cannot create window of size {0} samples (dur={1})'
                            'for signal with length {2}'
                            ''.format(win_len, dur, sig_len))
-    if window == 'dpss':
-        from mne.time_frequency.multitaper import dpss_windows
-        win = dpss_windows(2 * win_len + 1, 1, 1)[0][0][:win_len]
-        win -= win[0]
-        win /= win.max()
-    else:
-        win = signal.windows.get_window(window, 2 * win_len)[:win_len]
+    win = _get_taper(window, win_len)
     valid_edges = ('leading', 'trailing', 'both')
     if edges not in valid_edges:
         raise ValueError('edges must be one of {0}, not "{1}"'
                          ''.format(valid_edges, edges))
-    # now we can actually do the calculation
-    flattop = np.ones(sig_len, dtype=np.float64)
+    # now we can actually do the calculation (on the edges only)
+    view = np.moveaxis(sig, axis, -1)
     if edges in ('trailing', 'both'):  # eliminate trailing
-        flattop[-win_len:] *= win[::-1]
+        view[..., sig_len - win_len:] *= win[::-1]
     if edges in ('leading', 'both'):  # eliminate leading
-        flattop[:win_len] *= win
-    shape = np.ones_like(sig.shape)
-    shape[axis] = sig.shape[axis]
-    flattop.shape = shape
-    sig *= flattop
+        view[..., :win_len] *= win
     return sig
 
 
@@ -138,6 +162,105 @@ def play_sound(sound, fs=None, norm=True, wait=False, backend='auto'):
     return snd
 
 
+def _parse_events(events):
+    """Get the (signal, onset, gain, channel_map) of each event."""
+    parsed = list()
+    for ei, event in enumerate(events):
+        if not isinstance(event, (tuple, list)) or not 2 <= len(event) <= 4:
+            raise ValueError('events[%s] must be a tuple (signal, onset[, '
+                             'gain[, channel_map]]), got %r' % (ei, event))
+        event = tuple(event) + (1., None)[len(event) - 2:]
+        sig, onset, gain, ch_map = event
+        sig = np.asarray(sig)
+        if sig.ndim > 2:
+            raise ValueError('events[%s] signal must have no more than 2 '
+                             'dimensions, got %s' % (ei, sig.ndim))
+        sig = np.atleast_2d(sig)
+        if ch_map is not None:
+            ch_map = np.array(ch_map, int).ravel()
+            if len(ch_map) != len(sig) or np.any(ch_map < 0):
+                raise ValueError('events[%s] channel_map must have a '
+                                 'nonnegative channel for each of the %s '
+                                 'signal channels, got %s'
+                                 % (ei, len(sig), ch_map))
+        parsed.append((sig, int(onset), gain, ch_map))
+    return parsed
+
+
+def mix_events(events, n_samples=None, n_channels=None, out=None):
+    """Mix sound events into one buffer
+
+    Parameters
+    ----------
+    events : list of tuple
+        The events to mix. Each is a tuple
+        ``(signal, onset, gain, channel_map)``, where the last two entries
+        are optional. ``signal`` has shape ``(n_event_samples,)`` or
+        ``(n_event_channels, n_event_samples)``, ``onset`` is the output
+        sample at which it starts (can be negative), and ``gain`` is a
+        linear gain (default 1.). ``channel_map`` gives the output channel
+        of each event channel. If it is None (default), a one-channel
+        signal is added to all output channels and the channels of other
+        signals are added to the first output channels.
+    n_samples : int | None
+        The number of output samples. If None, the output ends with the
+        last event. The parts of events outside the output are dropped.
+    n_channels : int | None
+        The number of output channels. If None, it is the largest number
+        of channels used by an event.
+    out : array | None
+        Preallocated output of shape ``(n_channels, n_samples)``, to
+        which the events are added. If None, a float32 array of zeros is
+        allocated.
+
+    Returns
+    -------
+    out : array, shape (n_channels, n_samples)
+        The mixed events.
+
+    See Also
+    --------
+    add_pad
+
+    Notes
+    -----
+    Each event only touches the output samples it overlaps, so the time
+    needed scales with the total duration of the events rather than with
+    the output duration times the number of events.
+    """
+    events = _parse_events(events)
+    if out is not None:
+        if not isinstance(out, np.ndarray) or out.ndim != 2:
+            raise ValueError('out must be a 2D array, got %r' % (out,))
+        n_channels, n_samples = out.shape
+    if n_channels is None:
+        n_channels = max([len(sig) if ch_map is None else ch_map.max() + 1
+                          for sig, _, _, ch_map in events] + [1])
+    if n_samples is None:
+        n_samples = max([onset + sig.shape[1]
+                         for sig, onset, _, _ in events] + [0])
+    if out is None:
+        out = np.zeros((n_channels, n_samples), np.float32)
+    for ei, (sig, onset, gain, ch_map) in enumerate(events):
+        if ch_map is None:
+            if len(sig) == 1:  # to all channels
+                sig = np.broadcast_to(sig, (n_channels, sig.shape[1]))
+            ch_map = np.arange(len(sig))
+        if ch_map.max() >= n_channels:
+            raise ValueError('events[%s] uses channel %s, but there are only '
+                             '%s output channels'
+                             % (ei, ch_map.max(), n_channels))
+        start, stop = max(onset, 0), min(onset + sig.shape[1], n_samples)
+        if start >= stop:
+            continue
+        sig = sig[:, start - onset:stop - onset]
+        for src, dest in zip(sig, ch_map):
+            if gain != 1:
+                src = src * gain
+            out[dest, start:stop] += src
+    return out
+
+
 def add_pad(sounds, alignment='start'):
     """Add sounds of different lengths and channel counts together
 
@@ -161,29 +284,29 @@ def add_pad(sounds, alignment='start'):
     -----
         Even if the original sounds were all 0- or 1-dimensional, the output
         will be 2-dimensional (channels, samples).
+
+    See Also
+    --------
+    mix_events
     """
     if alignment not in ['start', 'center', 'end']:
         raise(ValueError("alignment must be either 'start', 'center', "
                          "or 'end'"))
     x = [np.atleast_2d(y) for y in sounds]
-    if not np.all(y.ndim == 2 for y in x):
+    if not np.all([y.ndim == 2 for y in x]):
         raise ValueError('Sound data must have no more than 2 dimensions.')
     shapes = [y.shape for y in x]
     ch_max, len_max = np.max(shapes, axis=0)
     if ch_max > 2:
         raise ValueError('Only 1- and 2-channel sounds are supported.')
-    for xi, (ch, length) in enumerate(shapes):
-        if length < len_max:
-            if alignment == 'start':
-                n_pre = 0
-                n_post = len_max - length
-            elif alignment == 'center':
-                n_pre = (len_max - length) // 2
-                n_post = len_max - length - n_pre
-            elif alignment == 'end':
-                n_pre = len_max - length
-                n_post = 0
-            x[xi] = np.pad(x[xi], ((0, 0), (n_pre, n_post)), 'constant')
-        if ch < ch_max:
-            x[xi] = np.tile(x[xi], [ch_max, 1])
-    return np.sum(x, 0)
+    events = list()  # mono sounds are added to all channels
+    for y, (ch, length) in zip(x, shapes):
+        if alignment == 'start':
+            n_pre = 0
+        elif alignment == 'center':
+            n_pre = (len_max - length) // 2
+        elif alignment == 'end':
+            n_pre = len_max - length
+        events.append((y, n_pre))
+    out = np.zeros((ch_max, len_max), np.result_type(*x))
+    return mix_events(events, out=out)
@@ -5,10 +5,13 @@
 # adapted (with permission) from code by Hari Bharadwaj
 
 import numpy as np
+from scipy import signal
 import warnings
 
 from ._stimuli import rms, window_edges
-from .._fixes import irfft
+from ._vocoder import _get_rng
+from .._fixes import irfft, rfft, next_fast_len
+from .._utils import _LRUCache
 
 
 def _cams(f):
@@ -21,23 +24,50 @@ def _inv_cams(E):
     return (10 ** (E / 21.4) - 1.) / 0.00437
 
 
-def _scale_sound(x):
-    """Scale appropriately to between +/- 1."""
-    return 0.95 * x / np.max(np.abs(x))
-
-
-def _make_narrow_noise(bw, f_c, dur, fs, ramp_dur, rng):
-    """Make narrow-band noise using FFT."""
+def _make_narrow_noise(bw, f_c, dur, fs, ramp_dur, rng, n_noises=1):
+    """Make narrow-band noises (one per row) using FFT."""
     f_min, f_max = f_c - bw / 2., f_c + bw / 2.
-    t = np.arange(int(round(dur * fs))) / fs
+    n_samp = int(round(dur * fs))
     # Make Noise
     f_step = 1. / dur  # Frequency bin size
     h_min = int(np.ceil(f_min / f_step))
     h_max = int(np.floor(f_max / f_step)) + 1
-    phase = rng.rand(h_max - h_min) * 2 * np.pi
-    noise = np.zeros(len(t) // 2 + 1, np.complex)
-    noise[h_min:h_max] = np.exp(1j * phase)
-    return window_edges(irfft(noise)[:len(t)], fs, ramp_dur, window='dpss')
+    phase = rng.rand(n_noises, h_max - h_min) * 2 * np.pi
+    spectrum = np.zeros((n_noises, n_samp // 2 + 1), np.complex128)
+    spectrum[:, h_min:h_max] = np.exp(1j * phase)
+    # the inverse rFFT is one sample short for odd n_samp, so zero-pad it
+    noise = np.zeros((n_noises, n_samp))
+    n_fft = 2 * (n_samp // 2)
+    noise[:, :n_fft] = window_edges(irfft(spectrum, n_fft), fs, ramp_dur,
+                                    window='dpss', copy=False)
+    return noise
+
+
+# rFFTs of the envelope filters, keyed by (fs, n_fft)
+_env_filters = _LRUCache(64 * 1024 * 1024)
+
+
+def _filter_envs(envs, fs):
+    """Rectify and low-pass filter envelopes (one per row)."""
+    n_samp = envs.shape[-1]
+    # Make a filter whose impulse response is purely positive (to avoid phase
+    # jumps) so that the filtered envelope is purely positive. Use a DPSS
+    # window to minimize sidebands. For a bandwidth of bw, to get the shortest
+    # filterlength, we need to restrict time-bandwidth product to a minimum.
+    # Thus we need a length*bw = 2 => length = 2/bw (second). Hence filter
+    # coefficients are calculated as follows:
+    n_b = int(np.floor(2 * fs / 100.))
+    n_fft = next_fast_len(n_samp + n_b - 1)
+    key = (fs, n_fft)
+    env_filter = _env_filters.get(key)
+    if env_filter is None:
+        b = signal.windows.dpss(n_b, 1.)
+        b -= b[0]
+        b /= b.sum()
+        env_filter = rfft(b, n_fft)
+        _env_filters.put(key, env_filter, env_filter.nbytes)
+    np.maximum(envs, 0., out=envs)
+    return irfft(rfft(envs, n_fft) * env_filter, n_fft)[..., :n_samp]
 
 
 def texture_ERB(n_freqs=20, n_coh=None, rho=1., seq=('inc', 'nb', 'inc', 'nb'),
@@ -79,10 +109,9 @@ def texture_ERB(n_freqs=20, n_coh=None, rho=1., seq=('inc', 'nb', 'inc', 'nb'),
 
     Notes
     -----
-    This function requires MNE.
+    All tones of a token are synthesized at once as a 2D array, with the
+    envelopes filtered in the frequency domain.
     """
-    from mne.time_frequency.multitaper import dpss_windows
-    from mne.utils import check_random_state
     if not isinstance(seq, (list, tuple, np.ndarray)):
         raise TypeError('seq must be list, tuple, or ndarray, got %s'
                         % type(seq))
@@ -92,7 +121,7 @@ def texture_ERB(n_freqs=20, n_coh=None, rho=1., seq=('inc', 'nb', 'inc', 'nb'),
             raise ValueError('all entries in seq must be one of %s, got '
                              'seq[%s]=%s' % (known_seqs, si, s))
     fs = float(fs)
-    rng = check_random_state(random_state)
+    rng = _get_rng(random_state)
     n_coh = int(np.round(n_freqs * 0.8)) if n_coh is None else n_coh
     rise = 0.002
     t = np.arange(int(round(dur * fs))) / fs
@@ -106,56 +135,35 @@ def texture_ERB(n_freqs=20, n_coh=None, rho=1., seq=('inc', 'nb', 'inc', 'nb'),
               % spacing_ERBs)
     if spacing_ERBs < 1.0:
         warnings.warn('The spacing between tones is LESS THAN 1 ERB!')
+    freqs = _inv_cams(_cams(f_min) + spacing_ERBs * np.arange(n_freqs))
+    tones = np.sin(2 * np.pi * freqs[:, np.newaxis] * t)
 
-    # Make a filter whose impulse response is purely positive (to avoid phase
-    # jumps) so that the filtered envelope is purely positive. Use a DPSS
-    # window to minimize sidebands. For a bandwidth of bw, to get the shortest
-    # filterlength, we need to restrict time-bandwidth product to a minimum.
-    # Thus we need a length*bw = 2 => length = 2/bw (second). Hence filter
-    # coefficients are calculated as follows:
-    b = dpss_windows(int(np.floor(2 * fs / 100.)), 1., 1)[0][0]
-    b -= b[0]
-    b /= b.sum()
-
-    # Incoherent
     envrate = 14
     bw = 20
-    incoh = 0.
-    for k in range(n_freqs):
-        f = _inv_cams(_cams(f_min) + spacing_ERBs * k)
-        env = _make_narrow_noise(bw, envrate, dur, fs, rise, rng)
-        env[env < 0] = 0
-        env = np.convolve(b, env)[:len(t)]
-        incoh += _scale_sound(window_edges(
-            env * np.sin(2 * np.pi * f * t), fs, rise, window='dpss'))
-    incoh /= rms(incoh)
+    # The random draws of a (discarded) incoherent mixture are kept so that
+    # a given random_state gives the same stimulus as it always has
+    _make_narrow_noise(bw, envrate, dur, fs, rise, rng, n_freqs)
 
     # Coherent (noise band)
     stims = dict(inc=0., nb=0., sam=0.)
     group = np.sort(rng.permutation(np.arange(n_freqs))[:n_coh])
     for kind in known_seqs:
         if kind == 'nb':  # noise band
-            env_coh = _make_narrow_noise(bw, envrate, dur, fs, rise, rng)
-        else:  # 'nb' or 'inc'
+            env_coh = _make_narrow_noise(bw, envrate, dur, fs, rise, rng)[0]
+        elif kind == 'sam':
             env_coh = 0.5 + np.sin(2 * np.pi * SAM_freq * t) / 2.
-            env_coh = window_edges(env_coh, fs, rise, window='dpss')
-        env_coh[env_coh < 0] = 0
-        env_coh = np.convolve(b, env_coh)[:len(t)]
-        if kind == 'inc':
-            use_group = []  # no coherent ones
-        else:  # 'nb' or 'sam'
-            use_group = group
-        for k in range(n_freqs):
-            f = _inv_cams(_cams(f_min) + spacing_ERBs * k)
-            env_inc = _make_narrow_noise(bw, envrate, dur, fs, rise, rng)
-            env_inc[env_inc < 0] = 0.
-            env_inc = np.convolve(b, env_inc)[:len(t)]
-            if k in use_group:
-                env = np.sqrt(rho) * env_coh + np.sqrt(1 - rho ** 2) * env_inc
-            else:
-                env = env_inc
-            stims[kind] += _scale_sound(window_edges(
-                env * np.sin(2 * np.pi * f * t), fs, rise, window='dpss'))
+            env_coh = window_edges(env_coh, fs, rise, window='dpss',
+                                   copy=False)
+        envs = _filter_envs(_make_narrow_noise(bw, envrate, dur, fs, rise,
+                                               rng, n_freqs), fs)
+        if kind != 'inc':  # 'nb' or 'sam' have coherent ones
+            env_coh = _filter_envs(env_coh, fs)
+            envs[group] = (np.sqrt(rho) * env_coh +
+                           np.sqrt(1 - rho ** 2) * envs[group])
+        envs *= tones
+        window_edges(envs, fs, rise, window='dpss', copy=False)
+        # scale each tone to a peak of 0.95, and mix them
+        stims[kind] = np.dot(0.95 / np.max(np.abs(envs), axis=-1), envs)
         stims[kind] /= rms(stims[kind])
     stim = np.concatenate([stims[s] for s in seq])
     stim = 0.01 * stim / rms(stim)
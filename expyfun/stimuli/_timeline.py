@@ -0,0 +1,113 @@
+"""Trial timelines of audio segments and trigger codes."""
+
+# License: BSD (3-clause)
+
+import numpy as np
+
+from ._stimuli import mix_events, _parse_events
+
+
+class Timeline(object):
+    """Audio segments and trigger codes at sample offsets
+
+    Parameters
+    ----------
+    fs : float
+        The sample rate of the audio (and of the offsets).
+    n_channels : int
+        The number of audio channels.
+
+    See Also
+    --------
+    mix_events
+    expyfun.ExperimentController.load_timeline
+
+    Notes
+    -----
+    Use :meth:`expyfun.ExperimentController.load_timeline` to load the
+    rendered audio and triggers into a single sound card buffer, so that the
+    trigger codes are sample-locked to the audio.
+    """
+
+    def __init__(self, fs, n_channels=2):
+        self.fs = float(fs)
+        self.n_channels = int(n_channels)
+        if self.n_channels < 1:
+            raise ValueError('n_channels must be positive, got %s'
+                             % (n_channels,))
+        self._events = list()
+        self._triggers = list()
+        self._n_samples = 0
+
+    def __repr__(self):
+        return ('<Timeline : %d segments, %d triggers, %0.3f sec>'
+                % (len(self._events), len(self._triggers),
+                   self.n_samples / self.fs))
+
+    @property
+    def n_samples(self):
+        """The number of samples of the timeline."""
+        return self._n_samples
+
+    def add_audio(self, samples, offset=0, gain=1., channel_map=None):
+        """Add an audio segment
+
+        Parameters
+        ----------
+        samples : array-like
+            The audio, with shape ``(n_samples,)`` or
+            ``(n_segment_channels, n_samples)``.
+        offset : int
+            The sample at which the segment starts.
+        gain : float
+            A linear gain to apply to the segment.
+        channel_map : array-like | None
+            The timeline channel of each segment channel. If None, a
+            one-channel segment is added to all channels and the channels of
+            other segments are added to the first channels.
+        """
+        offset = int(offset)
+        if offset < 0:
+            raise ValueError('offset must be nonnegative, got %s' % offset)
+        event = _parse_events([(samples, offset, gain, channel_map)])[0]
+        sig, _, _, ch_map = event
+        n_used = len(sig) if ch_map is None else ch_map.max() + 1
+        if n_used > self.n_channels:
+            raise ValueError('segment uses %s channels, but the timeline has '
+                             '%s' % (n_used, self.n_channels))
+        self._events.append(event)
+        self._n_samples = max(self._n_samples, offset + sig.shape[1])
+
+    def add_trigger(self, code, offset):
+        """Add a trigger code
+
+        Parameters
+        ----------
+        code : int
+            The trigger code, between 1 and 255.
+        offset : int
+            The sample at which the trigger starts.
+        """
+        if not isinstance(code, (int, np.integer)) or not 1 <= code <= 255:
+            raise ValueError('code must be an integer between 1 and 255, got '
+                             '%r' % (code,))
+        offset = int(offset)
+        if offset < 0:
+            raise ValueError('offset must be nonnegative, got %s' % offset)
+        self._triggers.append((offset, int(code)))
+        self._n_samples = max(self._n_samples, offset + 1)
+
+    @property
+    def triggers(self):
+        """The list of ``(offset, code)`` trigger tuples, sorted by offset."""
+        return sorted(self._triggers)
+
+    def render(self):
+        """Render the audio
+
+        Returns
+        -------
+        samples : array, shape (n_channels, n_samples)
+            The float32 audio.
+        """
+        return mix_events(self._events, self.n_samples, self.n_channels)
@@ -3,10 +3,11 @@
 """
 
 import numpy as np
-from scipy.signal import butter, lfilter, filtfilt
+from scipy.signal import butter, lfilter, filtfilt, sosfilt
 import warnings
 
-from .._utils import verbose_dec
+from .._parallel import parallel_func, _check_n_jobs
+from .._utils import verbose_dec, logger, _LRUCache, string_types
 
 
 def _freq_to_erbn(f):
@@ -143,6 +144,25 @@ def get_env(data, fs, lp_order=4, lp_cutoff=160., zero_phase=False, axis=-1):
     return(env, (b, a))
 
 
+def _check_mode(mode):
+    if mode not in ('noise', 'tone', 'poisson'):
+        raise ValueError('mode must be "noise", "tone", or "poisson", not {0}'
+                         ''.format(mode))
+
+
+def _get_rng(seed):
+    if isinstance(seed, np.random.RandomState):
+        rng = seed
+    elif seed is None:
+        rng = np.random
+    elif isinstance(seed, int):
+        rng = np.random.RandomState(seed)
+    else:
+        raise TypeError('"seed" must be an int, an instance of '
+                        'numpy.random.RandomState, or None.')
+    return rng
+
+
 def get_carriers(data, fs, edges, order=2, axis=-1, mode='tone', rate=None,
                  seed=None):
     """Generate carriers for frequency bands of a signal
@@ -178,18 +198,8 @@ def get_carriers(data, fs, edges, order=2, axis=-1, mode='tone', rate=None,
         List of numpy ndarrays of the carrier signals.
     """
     # check args
-    if mode not in ('noise', 'tone', 'poisson'):
-        raise ValueError('mode must be "noise", "tone", or "poisson", not {0}'
-                         ''.format(mode))
-    if isinstance(seed, np.random.RandomState):
-        rng = seed
-    elif seed is None:
-        rng = np.random
-    elif isinstance(seed, int):
-        rng = np.random.RandomState(seed)
-    else:
-        raise TypeError('"seed" must be an int, an instance of '
-                        'numpy.random.RandomState, or None.')
+    _check_mode(mode)
+    rng = _get_rng(seed)
     carrs = []
     fs = float(fs)
     n_samp = data.shape[axis]
@@ -268,16 +278,375 @@ def vocode(data, fs, n_bands=16, freq_lims=(200., 8000.), scale='erb',
     The default settings are adapted from a cochlear implant simulation
     algorithm described by Zachary Smith (Cochlear Corp.).
     """
-    edges = get_band_freqs(fs, n_bands=n_bands, freq_lims=freq_lims,
-                           scale=scale)
-    bands, filts = get_bands(data, fs, edges, order=order, axis=axis)
-    envs, env_filts = zip(*[get_env(x, fs, lp_order=lp_order,
-                                    lp_cutoff=lp_cutoff, axis=axis)
-                            for x in bands])
-    carrs = get_carriers(data, fs, edges, order=order, axis=axis, mode=mode,
-                         rate=rate, seed=seed)
-    # reconstruct
-    voc = np.zeros_like(data)
-    for carr, env in zip(carrs, envs):
-        voc += carr * env
-    return voc
+    key = (float(fs), n_bands, tuple(float(f) for f in freq_lims), scale,
+           order, float(lp_cutoff), lp_order, mode, rate)
+    vocoder = _vocoders.get(key)
+    if vocoder is None:
+        vocoder = Vocoder(fs, n_bands, freq_lims, scale, order, lp_cutoff,
+                          lp_order, mode, rate)
+        _vocoders.put(key, vocoder, 1)
+    return vocoder.vocode(data, seed=seed, axis=axis)
+
+
+# recently used vocoders (i.e., filter designs)
+_vocoders = _LRUCache(32)
+# number of samples per block when computing the RMS of streamed carriers
+_block_size = 65536
+# number of signals vocoded per job by vocode_corpus
+_corpus_chunk = 16
+
+
+class Vocoder(object):
+    """Vocode stimuli using precomputed filter banks
+
+    Parameters
+    ----------
+    fs : float
+        Sample rate.
+    n_bands : int
+        Number of bands to use.
+    freq_lims : tuple
+        2-element list of lower and upper frequency bounds.
+    scale : str
+        Scale on which to equally space the bands. Possible values are "erb",
+        "log" (base-2), and "hz".
+    order : int
+        Order of analysis and synthesis.
+        NOTE: Using too high an order can cause instability,
+        always check outputs for order > 2!
+    lp_cutoff : float
+        Frequency of the envelope low-pass.
+    lp_order : int
+        Order of the envelope low-pass.
+    mode : str
+        The type of signal used to excite each band. Options are "noise" for
+        band-limited noise, "tone" for sinewave-at-center-frequency, or
+        "poisson" for a poisson process of band-limited clicks at the rate
+        given by ``rate``.
+    rate : int
+        Average number of clicks per second for the poisson train used to
+        excite each band (when mode=="poisson").
+
+    See Also
+    --------
+    vocode
+
+    Notes
+    -----
+    The filters are designed once, as second-order sections, and all bands
+    are processed as one stacked array. Use this instead of
+    :func:`expyfun.stimuli.vocode` to vocode many signals with the same
+    settings.
+    """
+
+    def __init__(self, fs, n_bands=16, freq_lims=(200., 8000.), scale='erb',
+                 order=2, lp_cutoff=160., lp_order=4, mode='noise',
+                 rate=200):
+        _check_mode(mode)
+        self.fs = float(fs)
+        self.edges = list(get_band_freqs(fs, n_bands=n_bands,
+                                         freq_lims=freq_lims, scale=scale))
+        if lp_cutoff >= self.fs / 2.:
+            raise ValueError('frequency limits must not exceed Nyquist')
+        self.mode = mode
+        self.rate = rate
+        self._band_sos = [butter(order, [2 * lf / self.fs, 2 * hf / self.fs],
+                                 'bandpass', output='sos')
+                          for lf, hf in self.edges]
+        self._env_sos = butter(lp_order, 2 * lp_cutoff / self.fs, 'lowpass',
+                               output='sos')
+        self._cfs = np.array([(lf + hf) / 2. for lf, hf in self.edges])
+
+    def _filter_bands(self, x, out, zi=None):
+        """Band-pass filter each band of a stack (or a signal) into out.
+
+        If ``zi`` (a list with the filter state of each band) is given, it
+        is updated in place.
+        """
+        for bi, sos in enumerate(self._band_sos):
+            xx = x[bi] if x.ndim == out.ndim else x
+            if zi is None:
+                out[bi] = sosfilt(sos, xx, axis=-1)
+            else:
+                out[bi], zi[bi] = sosfilt(sos, xx, axis=-1, zi=zi[bi])
+        return out
+
+    def _tones(self, start, n_samp):
+        """Generate tone carriers for samples [start, start + n_samp)."""
+        carrs = np.sin(2 * np.pi * self._cfs[:, np.newaxis] *
+                       np.arange(start, start + n_samp) / self.fs)
+        carrs *= np.sqrt(2)  # rms of 1
+        return carrs
+
+    def _draw(self, rng, n_samp):
+        """Draw raw (unfiltered) noise or poisson carrier samples."""
+        if self.mode == 'noise':
+            return rng.rand(n_samp)
+        prob = self.rate / self.fs
+        with warnings.catch_warnings(record=True):  # numpy silliness
+            return rng.choice([0., 1.], n_samp, p=[1 - prob, prob])
+
+    def _carriers(self, shape, rng, axis):
+        """Generate the (time-last) carriers for data with a given shape."""
+        n_bands, n_samp = len(self.edges), shape[axis]
+        ndim = len(shape)
+        if self.mode == 'tone':
+            return self._tones(0, n_samp).reshape(
+                (n_bands,) + (1,) * (ndim - 1) + (n_samp,))
+        if self.mode == 'noise':
+            carrs = rng.rand(n_bands, *shape)
+            carrs = np.moveaxis(carrs, axis % ndim + 1, -1)
+        else:  # mode == 'poisson'
+            prob = self.rate / self.fs
+            with warnings.catch_warnings(record=True):  # numpy silliness
+                carrs = rng.choice([0., 1.], (n_bands, n_samp),
+                                   p=[1 - prob, prob])
+            carrs.shape = (n_bands,) + (1,) * (ndim - 1) + (n_samp,)
+        carrs = self._filter_bands(carrs, np.empty(carrs.shape))
+        carrs /= np.sqrt(np.mean(carrs * carrs, axis=-1,
+                                 keepdims=True))  # rms of 1
+        return carrs
+
+    def vocode(self, data, seed=None, axis=-1):
+        """Vocode a signal or a batch of signals
+
+        Parameters
+        ----------
+        data : array-like
+            Data array. Multiple signals (e.g., a batch of equal-length
+            signals along a leading axis) are vocoded independently.
+        seed : np.random.RandomState | int | None
+            Random seed to use. If ``None``, no seeding is done.
+        axis : int
+            Axis to operate over.
+
+        Returns
+        -------
+        voc : array
+            Vocoded stimuli of the same shape as data.
+        """
+        rng = _get_rng(seed)
+        data = np.atleast_1d(np.array(data, float))
+        shape = data.shape
+        data = np.moveaxis(data, axis, -1)
+        bands = self._filter_bands(data, np.empty((len(self.edges),) +
+                                                  data.shape))
+        np.maximum(bands, 0., out=bands)  # half-wave rectify
+        envs = sosfilt(self._env_sos, bands, axis=-1)
+        del bands
+        envs *= self._carriers(shape, rng, axis)
+        return np.moveaxis(envs.sum(axis=0), -1, axis)
+
+    def _carrier_streams(self, rng, lead_shape, n_samples):
+        """Set up the generation of carriers in blocks.
+
+        The RNG draws are made in the same order as in :meth:`vocode`, once
+        to compute the RMS of each (filtered) carrier. The RNG state at the
+        start of each carrier is kept to draw it again block by block.
+        """
+        n_bands = len(self.edges)
+        n_rows = int(np.prod(lead_shape)) if self.mode == 'noise' else 1
+        rngs = list()
+        sum_sq = np.zeros((n_bands, n_rows))
+        for bi, sos in enumerate(self._band_sos):
+            for ri in range(n_rows):
+                rngs.append(np.random.RandomState())
+                rngs[-1].set_state(rng.get_state())
+                zi = np.zeros((sos.shape[0], 2))
+                for start in range(0, n_samples, _block_size):
+                    x = self._draw(rng, min(_block_size, n_samples - start))
+                    x, zi = sosfilt(sos, x, zi=zi)
+                    sum_sq[bi, ri] += np.dot(x, x)
+        if self.mode == 'noise':
+            shape = (n_bands,) + tuple(lead_shape)
+        else:
+            shape = (n_bands,) + (1,) * len(lead_shape)
+        rms = np.sqrt(sum_sq / n_samples).reshape(shape + (1,))
+        return rngs, shape, rms
+
+    def vocode_blocks(self, blocks, n_samples=None, seed=None):
+        """Vocode a signal (or a batch of signals) block by block
+
+        Parameters
+        ----------
+        blocks : iterable of array-like
+            Consecutive blocks of the signal. The last dimension is time, and
+            the other dimensions must be the same for all blocks.
+        n_samples : int | None
+            The total number of samples in the signal. Required for the
+            "noise" and "poisson" modes, whose carriers are scaled to have an
+            RMS of 1 over the whole signal.
+        seed : np.random.RandomState | int | None
+            Random seed to use. If ``None``, no seeding is done.
+
+        Returns
+        -------
+        voc : generator
+            Generator of the vocoded blocks, which have the same shapes as
+            the input blocks.
+
+        Notes
+        -----
+        The filter states are carried from block to block, so memory use
+        scales with the block size instead of the signal length. The output
+        is the same as that of :meth:`vocode` (with ``axis=-1``) for the
+        whole signal with the same seed. The carriers of the "noise" and
+        "poisson" modes are generated twice: once (when the first block is
+        processed) to compute their RMS, and once block by block.
+        """
+        rng = _get_rng(seed)
+        if self.mode != 'tone':
+            if n_samples is None:
+                raise ValueError('n_samples must be given when mode is %r'
+                                 % (self.mode,))
+            n_samples = int(n_samples)
+            if n_samples < 1:
+                raise ValueError('n_samples must be positive, got %s'
+                                 % n_samples)
+        return self._vocode_blocks(blocks, n_samples, rng)
+
+    def _vocode_blocks(self, blocks, n_samples, rng):
+        n_bands = len(self.edges)
+        start = 0
+        first = True
+        for block in blocks:
+            block = np.atleast_1d(np.array(block, float))
+            if first:  # set up the filter states and carriers
+                first = False
+                lead_shape = block.shape[:-1]
+                band_zi = [np.zeros((sos.shape[0],) + lead_shape + (2,))
+                           for sos in self._band_sos]
+                env_zi = np.zeros((self._env_sos.shape[0], n_bands) +
+                                  lead_shape + (2,))
+                if self.mode != 'tone':
+                    rngs, carr_shape, rms = self._carrier_streams(
+                        rng, lead_shape, n_samples)
+                    carr_zi = [np.zeros((sos.shape[0],) + carr_shape[1:] +
+                                        (2,)) for sos in self._band_sos]
+            if block.shape[:-1] != lead_shape:
+                raise ValueError('blocks must have shape (..., n_samples) '
+                                 'with leading dimensions %s, got %s'
+                                 % (lead_shape, block.shape))
+            n_samp = block.shape[-1]
+            if n_samples is not None and start + n_samp > n_samples:
+                raise ValueError('blocks have more than n_samples (%s) '
+                                 'samples' % (n_samples,))
+            if n_samp == 0:
+                yield np.zeros(block.shape)
+                continue
+            bands = self._filter_bands(block, np.empty((n_bands,) +
+                                                       block.shape), band_zi)
+            np.maximum(bands, 0., out=bands)  # half-wave rectify
+            envs, env_zi = sosfilt(self._env_sos, bands, axis=-1, zi=env_zi)
+            del bands
+            if self.mode == 'tone':
+                carrs = self._tones(start, n_samp).reshape(
+                    (n_bands,) + (1,) * len(lead_shape) + (n_samp,))
+            else:
+                carrs = np.empty(carr_shape + (n_samp,))
+                for carr, r in zip(carrs.reshape(-1, n_samp), rngs):
+                    carr[:] = self._draw(r, n_samp)
+                carrs = self._filter_bands(carrs, np.empty(carrs.shape),
+                                           carr_zi)
+                carrs /= rms
+            envs *= carrs
+            start += n_samp
+            yield envs.sum(axis=0)
+        if n_samples is not None and start != n_samples:
+            raise ValueError('blocks had %s samples, expected n_samples=%s'
+                             % (start, n_samples))
+
+
+def _vocode_items(signals, fs, config, seeds):
+    """Vocode signals (with one seed each) using one configuration."""
+    vocoder = Vocoder(fs, **config)
+    return [vocoder.vocode(sig, seed=int(seed))
+            for sig, seed in zip(signals, seeds)]
+
+
+@verbose_dec
+def vocode_corpus(signals, fs, configs, n_jobs=1, seed=0, out=None,
+                  dtype=np.float64, verbose=None):
+    """Vocode a set of signals with one or more vocoder configurations
+
+    Parameters
+    ----------
+    signals : list of array-like | array-like
+        The mono signals, either as a list of 1D arrays (which can have
+        different lengths) or as a 2D array of shape
+        ``(n_signals, n_samples)``.
+    fs : float
+        Sample rate.
+    configs : list of dict
+        The vocoder configurations. Each dict contains keyword arguments for
+        :class:`Vocoder` (e.g., ``dict(n_bands=8, mode='tone')``).
+    n_jobs : int
+        Number of processes to use.
+    seed : int | None
+        The master seed, from which the seed used for each signal and
+        configuration is derived. If ``None``, a random master seed is
+        used.
+    out : array | str | None
+        Where to write the output. Can be an array of shape
+        ``(n_configs, n_signals, n_samples)``, the name of a ``.npy`` file
+        to create as a memory-mapped array, or ``None`` to allocate a new
+        array.
+    dtype : numpy dtype
+        The data type of the output (ignored if ``out`` is an array).
+    verbose : bool, str, int, or None
+        If not None, override default verbose level.
+
+    Returns
+    -------
+    out : array
+        The vocoded signals, with shape ``(n_configs, n_signals, n_samples)``
+        where ``n_samples`` is the length of the longest signal. Shorter
+        signals are vocoded at their own length and zero-padded at the end.
+
+    See Also
+    --------
+    vocode
+    Vocoder
+
+    Notes
+    -----
+    The seeds are derived from ``seed`` up front, so the output does not
+    depend on ``n_jobs`` or on the order in which the jobs finish.
+    """
+    signals = [np.array(sig, float) for sig in signals]
+    if len(signals) == 0 or any(sig.ndim != 1 for sig in signals):
+        raise ValueError('signals must be a non-empty list of 1D arrays')
+    configs = list(configs)
+    if len(configs) == 0:
+        raise ValueError('configs must not be empty')
+    for config in configs:  # check them here instead of in the jobs
+        Vocoder(fs, **config)
+    shape = (len(configs), len(signals), max(len(sig) for sig in signals))
+    if out is None:
+        out = np.zeros(shape, dtype)
+    elif isinstance(out, string_types):
+        out = np.lib.format.open_memmap(out, 'w+', dtype, shape)
+    elif not isinstance(out, np.ndarray) or out.shape != shape:
+        raise ValueError('out must be an array of shape %s, a filename, or '
+                         'None, got %r' % (shape, out))
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, shape[:2])
+
+    # vocode the signals in chunks, n_jobs chunks at a time
+    tasks = [(ci, si) for ci in range(len(configs))
+             for si in range(0, len(signals), _corpus_chunk)]
+    n_jobs = min(_check_n_jobs(int(n_jobs)), len(tasks))
+    parallel, p_fun, n_jobs = parallel_func(_vocode_items, n_jobs)
+    for ti in range(0, len(tasks), n_jobs):
+        these = tasks[ti:ti + n_jobs]
+        results = parallel(p_fun(signals[si:si + _corpus_chunk], fs,
+                                 configs[ci],
+                                 seeds[ci, si:si + _corpus_chunk])
+                           for ci, si in these)
+        for (ci, si), vocs in zip(these, results):
+            for ii, voc in enumerate(vocs):
+                out[ci, si + ii, :len(voc)] = voc
+                out[ci, si + ii, len(voc):] = 0.
+        logger.info('Vocoded %s/%s chunks' % (ti + len(these), len(tasks)))
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
@@ -4,15 +4,20 @@ import numpy as np
 import pytest
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_allclose, assert_equal)
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, lfilter, resample_poly
 
 from expyfun._sound_controllers import _BACKENDS
 from expyfun._utils import requires_lib, requires_opengl21, _check_skip_backend
 from expyfun.stimuli import (rms, play_sound, convolve_hrtf, window_edges,
-                             vocode, texture_ERB, crm_info, crm_prepare_corpus,
-                             crm_sentence, crm_response_menu, CRMPreload,
-                             add_pad)
+                             convolve_hrtf_batch, convolve_hrtf_moving,
+                             vocode, vocode_corpus, Vocoder, get_band_freqs,
+                             get_bands, get_env, get_carriers, texture_ERB,
+                             crm_info, crm_prepare_corpus, crm_sentence,
+                             crm_response_menu, CRMPreload, add_pad,
+                             mix_events, resample, Resampler, get_tdt_rates,
+                             Timeline)
 from expyfun import ExperimentController
+from expyfun.io import write_wav
 
 
 std_kwargs = dict(output_dir=None, full_screen=False, window_size=(340, 480),
@@ -20,10 +25,19 @@ std_kwargs = dict(output_dir=None, full_screen=False, window_size=(340, 480),
                   verbose=True, version='dev')
 
 
-@requires_lib('mne')
 def test_textures():
     """Test stimulus textures."""
     texture_ERB()  # smoke test
+    assert_array_equal(texture_ERB(random_state=0, seq=('sam', 'nb')),
+                       texture_ERB(random_state=0, seq=('sam', 'nb')))
+    # values from the original (per-tone) implementation, odd n_samples
+    x = texture_ERB(random_state=0, seq=('inc', 'nb', 'sam'), dur=0.5,
+                    verbose=False)
+    assert_equal(len(x), 36621)
+    assert_allclose(x[[1000, 5000, 9000, 15000, 20000, 27000, 33000]],
+                    [0.0015709794, -0.0033093678, 0.0187334780,
+                     -0.0000297674, -0.0035087598, -0.0024855908,
+                     -0.0184137080], rtol=0, atol=1e-10)
     pytest.raises(TypeError, texture_ERB, seq='foo')
     pytest.raises(ValueError, texture_ERB, seq=('foo',))
     with pytest.warns(UserWarning, match='LESS THAN 1 ERB'):
@@ -76,6 +90,97 @@ def test_hrtf_convolution():
                 assert (rmss[0] > 4 * rmss[1])
 
 
+def _fake_hrtf_data(tmpdir, monkeypatch):
+    """Write fake HRTF data files and use them."""
+    from expyfun.io import write_hdf5
+    monkeypatch.setenv('EXPYFUN_DATA_PATH', str(tmpdir))
+    tmpdir.mkdir('hrtf')
+    rng = np.random.RandomState(0)
+    decay = np.exp(-np.arange(64) / 8.)
+    for fs in (24414, 44100):
+        for source, step in (('cipic', 5), ('barb', 15)):
+            angles = np.arange(0, 91, step, dtype=float)
+            brir = rng.randn(len(angles), 2, 64) * decay
+            write_hdf5(str(tmpdir.join('hrtf', '%s_%s.hdf5' % (source, fs))),
+                       dict(brir=brir, angles=angles, fs=fs))
+        pairs = np.array([[a, a + 5] for a in range(0, 90, 5)], float)
+        shape = (len(pairs), 2, 2, 64)
+        write_hdf5(str(tmpdir.join('hrtf', 'pair_cipic_%s.hdf5' % fs)),
+                   dict(pairs=pairs, hrtf_amp=rng.rand(*shape) + 0.5,
+                        hrtf_phase=rng.randn(*shape), fs=fs))
+
+
+@requires_lib('h5py')
+def test_hrtf_batch(tmpdir, monkeypatch):
+    """Test batched HRTF convolution."""
+    from expyfun.stimuli._hrtf import _get_hrtf_db
+    _fake_hrtf_data(tmpdir, monkeypatch)
+    rng = np.random.RandomState(0)
+    signals = [rng.randn(n) for n in (1000, 500, 1000, 10, 700)]
+    angles = [0, -30, 30, 2.5, 0]
+    pytest.raises(ValueError, convolve_hrtf_batch, signals, 44100, [0])
+    pytest.raises(ValueError, convolve_hrtf_batch, signals, 44100, angles,
+                  source='foo')
+    pytest.raises(ValueError, convolve_hrtf_batch, signals, 44100, angles)
+    for fs in (44100, 48000, 24414):
+        out = convolve_hrtf_batch(signals, fs, angles, interp=True)
+        want = np.zeros(out.shape)
+        for sig, angle in zip(signals, angles):
+            x = convolve_hrtf(sig, fs, angle, interp=True)
+            want[:, :x.shape[1]] += x
+        assert_allclose(out, want, atol=1e-10)
+    out = convolve_hrtf_batch(np.array(signals[:1]), 44100, [-15],
+                              source='barb')
+    assert_allclose(out, convolve_hrtf(signals[0], 44100, -15, source='barb'),
+                    atol=1e-10)
+    # HRTF data and responses are cached
+    db = _get_hrtf_db('cipic', 44100)
+    assert _get_hrtf_db('cipic', 44100) is db
+    brir = db.get_brir(2.5, True)
+    assert db.get_brir(2.5, True) is brir
+    assert not brir.flags.writeable
+    assert_equal(db.get_brir(2.5, True, 48000).shape[-1], 70)
+    spectrum = db.get_rfft(2.5, True, 48000, 128)
+    assert db.get_rfft(2.5, True, 48000, 128) is spectrum
+    pytest.raises(ValueError, db.get_brir, 2.5, False)
+    pytest.raises(ValueError, db.get_rfft, 2.5, False, 48000, 128)
+    db.get_partitions(2.5, True, 48000, 64)
+    pytest.raises(ValueError, db.get_partitions, 2.5, False, 48000, 64)
+    pytest.raises(ValueError, db.get_brir, 95, True)
+
+
+@requires_lib('h5py')
+def test_hrtf_moving(tmpdir, monkeypatch):
+    """Test moving-source HRTF convolution."""
+    _fake_hrtf_data(tmpdir, monkeypatch)
+    data = np.random.RandomState(0).randn(2000)
+    pytest.raises(ValueError, convolve_hrtf_moving, data, 44100, [])
+    pytest.raises(ValueError, convolve_hrtf_moving, data, 44100, 0,
+                  block_size=0)
+    pytest.raises(ValueError, convolve_hrtf_moving, data, 44100, [0, 2.5])
+    # constant angles match static convolution
+    for fs, angle, block_size in ((44100, -2.5, 128), (48000, 30, 50)):
+        want = convolve_hrtf(data, fs, angle, interp=True)
+        out = convolve_hrtf_moving(data, fs, [angle] * 3, interp=True,
+                                   block_size=block_size)
+        assert_allclose(out, want, atol=1e-10)
+    # a jump is cross-faded over one block
+    angles = np.zeros(len(data))
+    angles[1000:] = -30
+    out = convolve_hrtf_moving(data, 44100, angles, source='barb',
+                               block_size=100)
+    before = convolve_hrtf(data, 44100, 0, source='barb')
+    after = convolve_hrtf(data, 44100, -30, source='barb')
+    assert_allclose(out[:, :1000], before[:, :1000], atol=1e-10)
+    assert_allclose(out[:, 1100:], after[:, 1100:], atol=1e-10)
+    assert not np.allclose(out[:, 1000:1100], before[:, 1000:1100])
+    assert not np.allclose(out[:, 1000:1100], after[:, 1000:1100])
+    # continuous trajectories
+    out = convolve_hrtf_moving(data, 44100, [-90, 90], interp=True,
+                               block_size=64)
+    assert_equal(out.shape, before.shape)
+
+
 @pytest.mark.parametrize('backend', ('auto',) + _BACKENDS)
 def test_play_sound(backend, hide_window):  # only works if windowing works
     """Test playing a sound."""
@@ -110,6 +215,19 @@ def test_window_edges():
     assert (np.all(y[:, 0] == 1))
     assert (np.all(y[:, -1] < 1))
     assert_allclose(x + y, z + 1)
+    # in place
+    w = sig.copy()
+    assert window_edges(w, fs, copy=False) is w
+    assert_array_equal(w, z)
+    w = np.ones((1000, 2), np.float32)
+    window_edges(w, fs, axis=0, window='dpss', edges='leading', copy=False)
+    assert_allclose(w.T, window_edges(sig, fs, window='dpss',
+                                      edges='leading'), rtol=1e-6)
+    assert_equal(w[0], 0.)
+    assert_array_equal(w[-1], 1.)
+    pytest.raises(ValueError, window_edges, [1., 1.], fs, 0., copy=False)
+    pytest.raises(ValueError, window_edges, np.ones(10, int), fs, 0.,
+                  copy=False)
 
 
 def _voc_similarity(orig, voc):
@@ -139,6 +257,88 @@ def test_vocoder():
     assert_array_equal(voc3.shape, data.shape)
 
 
+def test_vocoder_engine():
+    """Test the vocoder engine against the per-band functions."""
+    rng = np.random.RandomState(0)
+    data = rng.randn(3, 4000)
+    fs = 20000.
+    edges = list(get_band_freqs(fs, n_bands=8))
+    for mode in ('noise', 'tone', 'poisson'):
+        vocoder = Vocoder(fs, n_bands=8, mode=mode)
+        voc = vocoder.vocode(data, seed=0)
+        assert_equal(voc.shape, data.shape)
+        # same as vocoding each band separately
+        bands, _ = get_bands(data, fs, edges)
+        carrs = get_carriers(data, fs, edges, mode=mode, rate=200, seed=0)
+        want = sum(get_env(band, fs)[0] * carr
+                   for band, carr in zip(bands, carrs))
+        assert_allclose(voc, want, rtol=1e-6, atol=1e-9)
+        assert_allclose(vocode(data, fs, n_bands=8, mode=mode, seed=0), voc)
+    # other axis, and a batch gives the same as the individual signals
+    vocoder = Vocoder(fs, n_bands=8, mode='tone')
+    assert_allclose(vocoder.vocode(data.T, axis=0), vocoder.vocode(data).T)
+    voc = vocoder.vocode(data)
+    for sig, v in zip(data, voc):
+        assert_allclose(vocoder.vocode(sig), v)
+    pytest.raises(ValueError, Vocoder, fs, mode='foo')
+    pytest.raises(ValueError, Vocoder, fs, lp_cutoff=fs)
+    pytest.raises(TypeError, vocoder.vocode, data, seed='foo')
+
+
+def test_vocoder_blocks():
+    """Test block-wise vocoding."""
+    rng = np.random.RandomState(0)
+    fs = 20000.
+    for data in (rng.randn(5000), rng.randn(2, 3, 1000)):
+        n = data.shape[-1]
+        splits = np.sort(rng.randint(0, n, 4))
+        # starting with an empty block
+        blocks = [data[..., :0]] + np.split(data, splits, axis=-1)
+        for mode in ('noise', 'tone', 'poisson'):
+            vocoder = Vocoder(fs, n_bands=4, mode=mode)
+            rng_1, rng_2 = np.random.RandomState(1), np.random.RandomState(1)
+            want = vocoder.vocode(data, seed=rng_1)
+            got = np.concatenate(list(vocoder.vocode_blocks(
+                blocks, n, seed=rng_2)), axis=-1)
+            assert_allclose(got, want, rtol=1e-10, atol=1e-12)
+            assert_equal(rng_1.rand(), rng_2.rand())  # same draws
+    vocoder = Vocoder(fs, n_bands=4)
+    pytest.raises(ValueError, vocoder.vocode_blocks, blocks)
+    pytest.raises(ValueError, vocoder.vocode_blocks, blocks, 0)
+    pytest.raises(ValueError, list, vocoder.vocode_blocks(blocks, n - 1))
+    pytest.raises(ValueError, list, vocoder.vocode_blocks(blocks, n + 1))
+    pytest.raises(ValueError, list, vocoder.vocode_blocks(
+        [data[0], data[:1]], n))
+
+
+def test_vocode_corpus(tmpdir):
+    """Test vocoding a corpus in parallel."""
+    rng = np.random.RandomState(0)
+    fs = 20000.
+    signals = [rng.randn(n) for n in rng.randint(500, 1000, 20)]
+    configs = [dict(n_bands=4), dict(n_bands=2, mode='tone')]
+    out = vocode_corpus(signals, fs, configs)
+    assert_equal(out.shape, (2, 20, max(len(sig) for sig in signals)))
+    assert_equal(out.dtype, np.float64)
+    for sig, voc in zip(signals, out[1]):  # deterministic mode
+        assert_allclose(voc[:len(sig)], vocode(sig, fs, **configs[1]))
+        assert_array_equal(voc[len(sig):], 0.)
+    # the seeds do not depend on the number of jobs
+    fname = str(tmpdir.join('voc.npy'))
+    out_2 = vocode_corpus(signals, fs, configs, n_jobs=2, out=fname,
+                          dtype=np.float32)
+    assert_allclose(out_2, out, rtol=1e-5, atol=1e-7)
+    assert_allclose(np.load(fname), out_2)
+    assert_allclose(vocode_corpus(signals, fs, configs, n_jobs=-1), out)
+    assert not np.allclose(vocode_corpus(signals, fs, configs, seed=1)[0],
+                           out[0])
+    pytest.raises(ValueError, vocode_corpus, signals, fs, [])
+    pytest.raises(ValueError, vocode_corpus, [], fs, configs)
+    pytest.raises(ValueError, vocode_corpus, signals, fs, configs,
+                  out=np.zeros(3))
+    pytest.raises(TypeError, vocode_corpus, signals, fs, [dict(foo=1)])
+
+
 def test_rms():
     """Test RMS calculation."""
     # Test a couple trivial things we know
@@ -147,8 +347,46 @@ def test_rms():
     assert_array_almost_equal(rms(np.ones((100, 2)) * 2, 0), [2, 2])
 
 
+def test_resample():
+    """Test polyphase resampling."""
+    rng = np.random.RandomState(0)
+    pytest.raises(ValueError, resample, np.zeros(10), 0, 44100)
+    tdt_fs = get_tdt_rates()['25k']
+    for fs_in, fs_out, up, down in ((44100, 48000, 160, 147),
+                                    (48000, 44100, 147, 160),
+                                    (44100, tdt_fs, 15625, 28224),
+                                    (1000, 1000, 1, 1)):
+        x = rng.randn(2, 5000).astype(np.float32)
+        y = resample(x, fs_in, fs_out)
+        assert_equal(y.dtype, np.float32)
+        if up == down:
+            assert_allclose(y, x, atol=1e-7)
+        else:
+            want = resample_poly(x.astype(np.float64), up, down, axis=-1)
+            assert_allclose(y, want, atol=1e-4)
+        assert_allclose(resample(x.T, fs_in, fs_out, axis=0), y.T)
+        # streaming gives the same result regardless of block sizes
+        resampler = Resampler(fs_in, fs_out)
+        idx = np.cumsum([0, 1, 7, 1000, 0, 10])
+        blocks = [resampler.process(x[:, i1:i2])
+                  for i1, i2 in zip(idx[:-1], idx[1:])]
+        pytest.raises(ValueError, resampler.process, x[0])
+        blocks.append(resampler.process(x[:, idx[-1]:], final=True))
+        assert_allclose(np.concatenate(blocks, axis=-1), y, atol=1e-6)
+    # the filters are cached in a bounded cache
+    from expyfun._resample import _filter_cache, _get_filter
+    assert (160, 147) in _filter_cache
+    assert _get_filter(160, 147) is _get_filter(160, 147)
+    assert _filter_cache.size <= _filter_cache.max_size
+    # a tone is preserved
+    t = np.arange(44100) / 44100.
+    y = resample(np.sin(2 * np.pi * 1000 * t), 44100, 48000)
+    t = np.arange(48000) / 48000.
+    assert_allclose(y[1000:-1000], np.sin(2 * np.pi * 1000 * t)[1000:-1000],
+                    atol=1e-3)
+
+
 @pytest.mark.timeout(15)  # can be slow to load on CIs
-@requires_lib('mne')
 def test_crm(tmpdir):
     """Test CRM Corpus functions."""
     fs = 40000  # native rate, to avoid large resampling delay in testing
@@ -199,6 +437,181 @@ def test_crm(tmpdir):
     assert (np.sum(x[..., -1] == 0) and np.sum(x[..., 0] == 0))
     x = add_pad((x1, x2), 'end')
     assert (np.sum(x[..., 0] == 0))
+    assert_array_equal(x, [np.r_[np.zeros(5), np.ones(5)]] * 2)
+    assert_equal(x.dtype, np.float64)
+
+
+def test_mix_events():
+    """Test mixing sound events."""
+    rng = np.random.RandomState(0)
+    a, b = rng.randn(100), rng.randn(2, 50)
+    out = mix_events([(a, 10), (b, -10, 0.5, [2, 0]), (a, 150, 2.)])
+    assert_equal(out.dtype, np.float32)
+    want = np.zeros((3, 250))
+    want[:, 10:110] += a
+    want[2, :40] += 0.5 * b[0, 10:]
+    want[0, :40] += 0.5 * b[1, 10:]
+    want[:, 150:] += 2 * a
+    assert_allclose(out, want, rtol=1e-6, atol=1e-6)
+    # cropped into a preallocated buffer (which is added to)
+    buf = np.ones((3, 120), np.float32)
+    assert mix_events([(a, 10), (a, 150)], out=buf) is buf
+    assert_allclose(buf[:, 10:110], a + np.ones((3, 1)), rtol=1e-6)
+    assert_array_equal(buf[:, :10], 1.)
+    assert_array_equal(buf[:, 110:], 1.)
+    out = mix_events([(b, 0, 1., [0, 0])], n_samples=60, n_channels=2)
+    assert_allclose(out[0, :50], b.sum(0), rtol=1e-6)
+    assert_array_equal(out[1], 0.)
+    assert_array_equal(out[0, 50:], 0.)
+    assert_equal(mix_events([]).shape, (1, 0))
+    pytest.raises(ValueError, mix_events, [a])
+    pytest.raises(ValueError, mix_events, [(np.zeros((1, 1, 2)), 0)])
+    pytest.raises(ValueError, mix_events, [(b, 0, 1., [0])])
+    pytest.raises(ValueError, mix_events, [(b, 0, 1., [0, 1])],
+                  n_channels=1)
+    pytest.raises(ValueError, mix_events, [(a, 0)], out=np.zeros(3))
+
+
+def test_timeline():
+    """Test timelines of audio and triggers."""
+    rng = np.random.RandomState(0)
+    a, b = rng.randn(100), rng.randn(2, 50)
+    timeline = Timeline(1000., n_channels=2)
+    assert_equal(timeline.n_samples, 0)
+    timeline.add_audio(a)
+    timeline.add_audio(b, 80, 0.5, [1, 0])
+    timeline.add_trigger(4, 90)
+    timeline.add_trigger(2, 10)
+    assert_equal(timeline.n_samples, 130)
+    assert_equal(timeline.triggers, [(10, 2), (90, 4)])
+    assert '2 segments' in repr(timeline)
+    assert_allclose(timeline.render(),
+                    mix_events([(a, 0), (b, 80, 0.5, [1, 0])]))
+    timeline.add_trigger(8, 200)
+    assert_equal(timeline.render().shape, (2, 201))
+    pytest.raises(ValueError, Timeline, 1000., 0)
+    pytest.raises(ValueError, timeline.add_audio, a, -1)
+    pytest.raises(ValueError, timeline.add_audio, a, 0, 1., [2])
+    pytest.raises(ValueError, timeline.add_audio, np.zeros((3, 10)))
+    pytest.raises(ValueError, timeline.add_trigger, 256, 0)
+    pytest.raises(ValueError, timeline.add_trigger, 1.5, 0)
+    pytest.raises(ValueError, timeline.add_trigger, 1, -1)
+
+
+def test_crm_prepare_batch(tmpdir, monkeypatch):
+    """Test batched preparation of a CRM talker."""
+    import zipfile
+    from expyfun.stimuli import _crm
+    rng = np.random.RandomState(0)
+    zfn = str(tmpdir.join('Talker4.zip'))
+    raw = dict()
+    with zipfile.ZipFile(zfn, 'w') as zf:
+        for cal, col, num in np.ndindex(8, 4, 8):
+            x = (rng.randn(rng.randint(400, 800)) * 1600).astype('<h')
+            raw[(cal, col, num)] = x / 16384.
+            zf.writestr('TALKER04/%02i%02i%02i.BIN' % (cal, col, num),
+                        x.tobytes())
+    monkeypatch.setattr(_crm, '_get_talker_zip_file', lambda sex, tal: zfn)
+    fs = 44100
+    crm_prepare_corpus(fs, path_out=str(tmpdir), n_jobs=1, verbose=False,
+                       talker_list=[dict(sex='f', talker_num=0)])
+    crm = CRMPreload(fs, path=str(tmpdir), ramp_dur=0)
+    for ids in ((0, 0, 0), (7, 3, 7), (2, 1, 5)):
+        want = resample(raw[ids], 40000, fs) * 0.01 / _crm._rms_binary
+        assert_allclose(crm.sentence('f', 0, *ids), want, rtol=1e-5,
+                        atol=1e-7)
+        assert_allclose(crm_sentence(fs, 'f', 0, *ids, ramp_dur=0,
+                                     path=str(tmpdir)), want, rtol=1e-5,
+                        atol=1e-7)
+    pytest.raises(RuntimeError, crm.sentence, 'm', 0, 0, 0, 0)
+
+
+def test_crm_packed(tmpdir):
+    """Test the packed CRM corpus."""
+    from expyfun.stimuli._crm import _write_packed, _pack_corpus
+    fs = 40000
+    empty = tmpdir.mkdir('empty')
+    _write_packed(str(empty))  # nothing prepared
+    assert_equal(np.load(str(empty.join('crm.npy'))).shape, (0,))
+    path = tmpdir.mkdir(str(fs))
+    rng = np.random.RandomState(0)
+    sents = dict()
+    for ids in ((1, 0, 0, 0, 0), (1, 0, 2, 1, 4)):
+        sents[ids] = rng.randn(1000 + sum(ids)) * 0.01
+        write_wav(str(path.join('%i%i%i%i%i.wav' % ids)), sents[ids], fs,
+                  dtype=np.float32, verbose=False)
+    # packed in memory or read from disk
+    for packed in (False, True):
+        if packed:
+            _write_packed(str(path))
+            data, index = _pack_corpus(str(path))
+            assert_array_equal(np.load(str(path.join('crm.npy'))), data)
+            assert_array_equal(np.load(str(path.join('crm_index.npy'))),
+                               index)
+        for copy in (True, False):
+            crm = CRMPreload(fs, path=str(tmpdir), ramp_dur=0, copy=copy)
+            x = crm.sentence('f', 0, 'laker', 'red', '5')
+            assert_allclose(x, sents[(1, 0, 2, 1, 4)], rtol=1e-6)
+            assert_equal(x.flags.writeable, copy)
+            pytest.raises(RuntimeError, crm.sentence, 'f', 0, 0, 0, 1)
+        crm = CRMPreload(fs, path=str(tmpdir), ref_rms=0.02, stereo=True,
+                         copy=False)
+        x = crm.sentence('f', 0, 0, 0, 0)
+        want = crm_sentence(fs, 'f', 0, 0, 0, 0, ref_rms=0.02, stereo=True,
+                            path=str(tmpdir))
+        assert_allclose(x, want, rtol=1e-6)
+        assert x.flags.writeable
+    crm = CRMPreload(fs, path=str(tmpdir), ramp_dur=0, stereo=True,
+                     copy=False)
+    x = crm.sentence('f', 0, 0, 0, 0)
+    assert_equal(x.shape, (2, 1001))
+    assert not x.flags.writeable
+    pytest.raises(RuntimeError, crm.warm)
+    # n_jobs is checked before anything is prepared
+    pytest.raises(TypeError, crm_prepare_corpus, fs, str(tmpdir),
+                  n_jobs='foo')
+    with pytest.warns(UserWarning, match='cuda'):
+        pytest.raises(ValueError, crm_prepare_corpus, fs,
+                      str(tmpdir.join('cuda')), n_jobs='cuda',
+                      talker_list=[dict(sex='foo', talker_num=0)])
+
+
+def test_crm_lazy(tmpdir):
+    """Test lazy loading of the CRM corpus."""
+    from expyfun.stimuli._crm import _write_packed
+    fs = 40000
+    path = tmpdir.mkdir(str(fs))
+    for ids in ((1, 0, 0, 0, 0), (1, 0, 2, 1, 4), (1, 0, 3, 1, 4)):
+        write_wav(str(path.join('%i%i%i%i%i.wav' % ids)),
+                  np.random.RandomState(0).randn(2000) * 0.01, fs,
+                  dtype=np.float32, verbose=False)
+    for packed in (False, True):
+        if packed:
+            _write_packed(str(path))
+        crm = CRMPreload(fs, path=str(tmpdir), stereo=True, lazy=True,
+                         cache_size=1e6)
+        assert_equal(len(crm._cache), 0)
+        x = crm.sentence('f', 0, 0, 0, 0)
+        assert_allclose(x, crm_sentence(fs, 'f', 0, 0, 0, 0, stereo=True,
+                                        path=str(tmpdir)), rtol=1e-6)
+        x[:] = 0  # returns copies
+        assert_equal(len(crm._cache), 1)
+        assert crm.sentence('f', 0, 0, 0, 0).any()
+        pytest.raises(RuntimeError, crm.sentence, 'm', 0, 0, 0, 0)
+        # warming
+        pytest.raises(ValueError, crm.warm, [dict(foo=0)])
+        pytest.raises(RuntimeError, crm.warm, [dict(sex='m')])
+        crm.warm([dict(sex='f', talker_num=0, color='red', number='5')]).join()
+        assert (1, 0, 2, 1, 4) in crm._cache
+        assert (1, 0, 3, 1, 4) in crm._cache
+        # the cache is bounded (each sentence is 32000 bytes)
+        crm = CRMPreload(fs, path=str(tmpdir), stereo=True, lazy=True,
+                         copy=False, cache_size=64000)
+        crm.warm().join()
+        assert_equal(len(crm._cache), 2)
+        assert (1, 0, 0, 0, 0) not in crm._cache
+        x = crm.sentence('f', 0, 'h', 'r', 4)
+        assert not x.flags.writeable
 
 
 @pytest.mark.timeout(15)
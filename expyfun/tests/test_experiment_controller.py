@@ -2,7 +2,10 @@ from contextlib import contextmanager
 from copy import deepcopy
 from distutils.version import LooseVersion
 from functools import partial
+import json
+import os.path as op
 import sys
+import time
 
 import numpy as np
 from numpy.testing import assert_equal
@@ -11,9 +14,9 @@ from numpy.testing import assert_allclose
 
 from expyfun import ExperimentController, visual
 from expyfun._utils import (_TempDir, fake_button_press, _check_skip_backend,
-                            fake_mouse_click, requires_opengl21,
+                            fake_mouse_click, requires_opengl21, clock,
                             _wait_secs as wait_secs)
-from expyfun.stimuli import get_tdt_rates
+from expyfun.stimuli import get_tdt_rates, Timeline
 
 std_args = ['test']  # experiment name
 std_kwargs = dict(output_dir=None, full_screen=False, window_size=(1, 1),
@@ -52,7 +55,8 @@ def test_unit_conversions(hide_window, ws):
     pytest.raises(RuntimeError, ec._convert_units, verts[0], 'deg', 'pix')
 
 
-def test_data_line(hide_window):
+@pytest.mark.parametrize('async_write', (False, True))
+def test_data_line(hide_window, async_write):
     """Test writing of data lines."""
     entries = [['foo'],
                ['bar', 'bar\tbar'],
@@ -64,6 +68,7 @@ def test_data_line(hide_window):
     temp_dir = _TempDir()
     with std_kwargs_changed(output_dir=temp_dir):
         with ExperimentController(*std_args, stim_fs=44100,
+                                  async_write=async_write,
                                   **std_kwargs) as ec:
             for ent in entries:
                 ec.write_data_line(*ent)
@@ -97,6 +102,22 @@ def test_data_line(hide_window):
     # make sure we got monotonically increasing timestamps
     ts = np.array(ts)
     assert (np.all(ts[1:] >= ts[:-1]))
+    if not async_write:
+        return
+    # values are captured at call time, and lines are committed on flush
+    with std_kwargs_changed(output_dir=temp_dir):
+        with ExperimentController(*std_args, stim_fs=44100,
+                                  async_write=True, **std_kwargs) as ec:
+            val = [1]
+            ec.write_data_line('foo', val)
+            val.append(2)
+            ec._writer.put()  # errors are logged
+            ec.flush()  # waits for the queued lines
+            with open(ec.data_fname) as fid:
+                lines = fid.readlines()
+            assert_equal(lines[-1].strip().split('\t')[1:], ['foo', '[1]'])
+        assert ec._writer is None
+        ec.write_data_line('bar')  # closed file
 
 
 @contextmanager
@@ -577,6 +598,75 @@ def test_sound_card_triggering(hide_window):
         ec.load_buffer([1e-2])
         ec.start_stimulus()
         ec.stop()
+        ec.trial_ok()
+        # a timeline with sample-locked triggers
+        timeline = Timeline(ec.stim_fs, n_channels=1)
+        timeline.add_audio(np.full(1000, 1e-2))
+        timeline.add_trigger(4, 1000)
+        ec.identify_trial(ttl_id=[1, 0], ec_id='')
+        ec.load_timeline(timeline)
+        lines = dict()
+        ec.write_data_line = lambda event, value=None, timestamp=None: \
+            lines.setdefault(event, []).append((value, timestamp))
+        ec.start_stimulus()
+        ec.stop()
+        del ec.write_data_line
+        ec.trial_ok()
+        # the timeline triggers are logged when it plays
+        assert_equal([value for value, _ in lines['trigger']], [4])
+        assert_allclose(lines['trigger'][0][1] - lines['play'][0][1],
+                        1000 / ec.fs)
+        ac = ec._ac
+        buf = ac._make_buffer(np.full((5000, 1), 1e-2, np.float32),
+                              [(0, 1), (1000, 4)])
+        n_on = int(round(ac.fs * ac._trigger_duration))
+        assert_equal(buf.shape, (5000, 2))
+        assert_allclose(buf[:, 1], 1e-2)
+        trig = buf[:, 0] / ac._trig_scale / 256.
+        assert_allclose(trig[:n_on], 1, rtol=1e-6)
+        assert_allclose(trig[1000:1000 + n_on], 4, rtol=1e-6)
+        assert_equal(trig[n_on:1000], 0)
+        assert_equal(trig[1000 + n_on:], 0)
+        pytest.raises(ValueError, ac._make_buffer, buf[:, 1:],
+                      [(0, 1), (1, 4)])
+        # each trigger needs an on and an off period
+        with pytest.raises(ValueError, match='twice the trigger duration'):
+            ac._make_buffer(buf[:, 1:], [(0, 1), (n_on, 1)])
+        trig = ac._make_buffer(buf[:, 1:], [(0, 1), (2 * n_on, 1)])[:, 0]
+        assert_equal(trig[n_on:2 * n_on], 0)
+        assert_allclose(trig[2 * n_on:3 * n_on] / ac._trig_scale / 256., 1,
+                        rtol=1e-6)
+        pytest.raises(ValueError, ec.load_timeline, Timeline(ec.stim_fs / 2))
+        # trigger players are reused, and can be non-blocking
+        ac._trigger_players.clear()
+        assert ac.stamp_triggers([2, 4], block=True).done()
+        key = ((2, 4), 2 * ac._trigger_duration)
+        player = ac._trigger_players[key][0]
+        t0 = time.time()
+        future = ac.stamp_triggers([2, 4], block=False)
+        assert ac._trigger_players[key][0] is player
+        future_2 = ac.stamp_triggers([2, 4], block=False)  # a one-off player
+        assert ac._trigger_players[key][1] is future
+        assert future.result(timeout=5.) is None
+        assert future_2.result(timeout=5.) is None
+        # the second train was played after the first one
+        assert time.time() - t0 >= 4 * 3 * ac._trigger_duration * 0.9
+        for ii in range(20):
+            ac.stamp_triggers([ii + 1], wait_for_last=False)
+        assert_equal(len(ac._trigger_players), 16)
+        # audio waits for pending trigger trains
+        ec.load_buffer([1e-2])
+        ac.stamp_triggers([2, 4, 8], block=False)
+        ec.play()
+        assert clock() >= ac._trigger_end
+        ec.stop()
+        future = ac.stamp_triggers([8], block=False)
+        future_2 = ac.stamp_triggers([8], block=False)
+    assert future.done() and future_2.done()  # halted
+    with ExperimentController(*std_args, audio_controller='sound_card',
+                              suppress_resamp=True, **std_kwargs) as ec:
+        if ec._ac._n_channels_stim == 0:
+            pytest.raises(RuntimeError, ec.load_timeline, Timeline(ec.stim_fs))
 
 
 class _FakeJoystick(object):
@@ -598,3 +688,111 @@ def test_joystick(hide_window, monkeypatch):
         assert len(presses) == 1
         assert presses[0][0] == '1'
         assert ec.get_joystick_value('x') == 0.125
+
+
+def test_frame_monitoring(hide_window):
+    """Test frame timing monitoring."""
+    from expyfun._timing import _FrameMonitor
+    pytest.raises(ValueError, _FrameMonitor, 0.)
+    pytest.raises(ValueError, _FrameMonitor, 60., 0)
+    mon = _FrameMonitor(100., buffer_size=4)
+    for t in (0., 0.01, 0.02, 0.05, 0.06):
+        mon.add(t, 0.001, 0.002)
+    stats = mon.get_stats()
+    assert_equal(stats['n_intervals'], 4)
+    assert_equal(stats['n_late'], 1)
+    assert_equal(stats['n_dropped'], 2)
+    assert_equal(stats['hist'], [3, 0, 1, 0])
+    assert_allclose(stats['interval_max'], 0.03)
+    assert_allclose(stats['swap_p50'], 0.001)
+    assert_allclose(stats['callback_p95'], 0.002)
+    mon.new_trial()
+    assert_equal(mon.get_stats()['n_intervals'], 0)
+    assert (np.isnan(mon.get_stats()['swap_max']))
+    for t in (0.07, 0.08, 0.09):
+        mon.add(t, 0.001, 0.002)
+    assert_equal(mon.get_stats()['n_intervals'], 3)
+    assert_equal(mon.get_stats('buffer')['n_intervals'], 4)  # wrapped
+    assert_equal(mon.get_stats('buffer')['n_dropped'], 0)
+    pytest.raises(ValueError, mon.get_stats, 'foo')
+
+    temp_dir = _TempDir()
+    with std_kwargs_changed(output_dir=temp_dir):
+        with ExperimentController(*std_args, **std_kwargs) as ec:
+            pytest.raises(RuntimeError, ec.get_frame_stats)
+            ec.set_frame_monitoring(screen_fs=1e6)
+            ec.identify_trial(ec_id='', ttl_id=[])
+            ec.start_stimulus()
+            for _ in range(3):
+                ec.flip()
+            stats = ec.get_frame_stats()
+            assert_equal(stats['n_intervals'], 3)
+            assert (stats['n_dropped'] > 0)  # nothing is that fast
+            ec.trial_ok()
+            assert_equal(ec.get_frame_stats()['n_intervals'], 0)
+            ec.set_frame_monitoring(False)
+            pytest.raises(RuntimeError, ec.get_frame_stats)
+            fname = ec.data_fname
+    with open(fname) as fid:
+        lines = [line.strip().split('\t') for line in fid]
+    assert_equal([line[1] for line in lines[-3:-1]],
+                 ['frame_timing', 'trial_ok'])
+    assert_equal(json.loads(lines[-3][2])['n_intervals'], 3)
+
+
+def test_profiling(hide_window):
+    """Test profiling of trial methods."""
+    temp_dir = _TempDir()
+    trace_fname = op.join(temp_dir, 'trace.json')
+    with ExperimentController(*std_args, stim_fs=44100, **std_kwargs) as ec:
+        pytest.raises(RuntimeError, ec.get_profiling_stats)
+        ec.set_profiling(trace_fname=trace_fname)
+        assert ('flip' in vars(ec))
+        for _ in range(2):
+            ec.load_buffer(np.zeros(100))
+            ec.identify_trial(ec_id='', ttl_id=[])
+            ec.start_stimulus()
+            ec.wait_secs(0.001)
+            ec.stop()
+            ec.trial_ok()
+        stats = ec.get_profiling_stats()
+        for name in ('load_buffer', '_validate_audio', 'identify_trial',
+                     'start_stimulus', 'trial_ok'):
+            assert_equal(stats[name]['n_calls'], 2)
+        assert (stats['wait_secs']['n_calls'] >= 2)  # also used by triggers
+        assert_equal(stats['flip']['n_calls'], 2)  # from start_stimulus
+        assert_equal(stats['wait_one_press']['n_calls'], 0)
+        assert (stats['wait_secs']['wall_max'] >= 0.001)
+        assert (np.isnan(stats['wait_one_press']['wall_max']))
+        report = ec._profiler.get_report()
+        assert ('start_stimulus' in report)
+    assert ('flip' not in vars(ec))
+    with open(trace_fname) as fid:
+        trace = json.load(fid)
+    events = trace['traceEvents']
+    assert_equal(len([e for e in events if e['name'] == 'flip']), 2)
+    assert (all(e['ph'] == 'X' and e['dur'] >= 0 for e in events))
+    assert_equal([e['ts'] for e in events], sorted(e['ts'] for e in events))
+
+
+def test_prepare_buffer(hide_window):
+    """Test preparing audio buffers."""
+    samples = np.random.RandomState(0).randn(2, 1000) * 0.01
+    with ExperimentController(*std_args, stim_fs=44100, **std_kwargs) as ec:
+        buf = ec.prepare_buffer(samples)
+        assert ('1000 samples' in repr(buf))
+        assert (ec.prepare_buffer(buf) is buf)
+        assert (ec.prepare_buffer(samples.copy()) is buf)  # cached
+        assert (ec.prepare_buffer(samples, cache=False) is not buf)
+        assert (ec.prepare_buffer(samples[:, :-1]) is not buf)
+        assert (not buf.samples.flags.writeable)
+        assert_allclose(buf.samples,
+                        ec._validate_audio(samples) * ec._stim_scaler)
+        ec.load_buffer(buf)
+        ec.load_buffer(buf)
+        ec.set_stim_db(ec.stim_db + 6)
+        ec.load_buffer(buf)
+        pytest.raises(ValueError, ec.prepare_buffer, samples * 1000)
+        with ExperimentController(*std_args, stim_fs=44100,
+                                  **std_kwargs) as ec_2:
+            pytest.raises(ValueError, ec_2.load_buffer, buf)
@@ -1,7 +1,12 @@
-from numpy.testing import assert_array_equal
+import time
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_equal
 import pytest
 
-from expyfun import decimals_to_binary, binary_to_decimals
+from expyfun import (decimals_to_binary, binary_to_decimals,
+                     decimals_to_triggers, triggers_to_decimals,
+                     ParallelTrigger)
 
 
 def test_conversion():
@@ -11,12 +16,16 @@ def test_conversion():
     pytest.raises(ValueError, decimals_to_binary, [-1], [1])
     pytest.raises(ValueError, decimals_to_binary, [1, 1], [1])
     pytest.raises(ValueError, decimals_to_binary, [2], [1])
+    pytest.raises(ValueError, decimals_to_binary, [1], [64])
     pytest.raises(ValueError, binary_to_decimals, [2], [1])
     pytest.raises(ValueError, binary_to_decimals, [0.5], [1])
     pytest.raises(ValueError, binary_to_decimals, [-1], [1])
     pytest.raises(ValueError, binary_to_decimals, [[1]], [1])
     pytest.raises(ValueError, binary_to_decimals, [1], [-1])
     pytest.raises(ValueError, binary_to_decimals, [1], [2])
+    pytest.raises(ValueError, binary_to_decimals, [1] * 64, [64])
+    assert_array_equal(decimals_to_binary([2 ** 62], [63]), [1] + [0] * 62)
+    assert_array_equal(binary_to_decimals([1] + [0] * 62, [63]), [2 ** 62])
     # test cases
     decs = [[1],
             [1, 0, 1, 4, 5],
@@ -36,3 +45,70 @@ def test_conversion():
     for d, n, b in zip(decs, bits, bins):
         assert_array_equal(decimals_to_binary(d, n), b)
         assert_array_equal(binary_to_decimals(b, n), d)
+
+
+class _FakeEC(object):
+    wait_secs = staticmethod(time.sleep)  # no display needed
+
+
+def test_parallel_trigger_async():
+    """Test non-blocking parallel port triggering."""
+    tc = ParallelTrigger('dummy', trigger_duration=0.005, ec=_FakeEC())
+    future = tc.stamp_triggers([1, 2, 4], block=False)
+    future_2 = tc.stamp_triggers([8], wait_for_last=False, block=False)
+    assert future_2.result(timeout=5.) is None
+    assert future.done()  # stamped in order
+    assert_equal(tc._trigger_list, [1, 2, 4, 8])
+    # waiting before audio starts
+    future = tc.stamp_triggers([2], block=False)
+    assert tc._wait_for_triggers() >= 0.
+    assert future.done() and tc._last_future is None
+    assert_equal(tc._trigger_list[-1], 2)
+    # blocking stamps come after the queued ones
+    tc.stamp_triggers([1, 2], delay=0.02, block=False)
+    assert tc.stamp_triggers([16], block=True).done()
+    assert_equal(tc._trigger_list, [1, 2, 4, 8, 2, 1, 2, 16])
+    # errors of queued triggers do not propagate to later calls
+    set_data = tc._set_data
+
+    def _bad_set_data(x):
+        if x == 64:
+            raise RuntimeError('bad trigger')
+        set_data(x)
+
+    tc._set_data = _bad_set_data
+    future = tc.stamp_triggers([64], block=False)
+    with pytest.raises(RuntimeError, match='bad trigger'):
+        future.result(timeout=5.)
+    tc.stamp_triggers([16], block=True)
+    assert tc._last_future is None
+    tc._set_data = set_data
+    tc.stamp_triggers([32], block=False)
+    tc.close()  # finishes queued triggers
+    assert_equal(tc._trigger_list[-1], 32)
+    assert tc._thread is None
+
+
+def test_trigger_encoding():
+    """Test batched encoding and decoding of binary ID triggers."""
+    rng = np.random.RandomState(0)
+    n_bits = [2, 8, 16]
+    ids = np.array([rng.randint(0, 2 ** b, 20) for b in n_bits]).T
+    trigs = [decimals_to_triggers(d, n_bits) for d in ids]
+    for d, t in zip(ids, trigs):
+        binary = np.array(decimals_to_binary(d, n_bits))
+        assert_array_equal(t, 4 * (binary + 1))
+    pytest.raises(ValueError, decimals_to_triggers, [4], [2])
+    # simulated recording: ID bits and an onset trigger after each ID
+    data = np.zeros(20 * 600, int)
+    onsets = np.arange(20) * 600 + 7
+    for onset, t in zip(onsets, trigs):
+        data[onset + 10 * np.arange(len(t))] = t
+        data[onset + 10 * np.arange(len(t)) + 1] = t  # two-sample pulses
+        data[onset + 10 * len(t)] = 1
+    decimals, found = triggers_to_decimals(data, n_bits)
+    assert_array_equal(decimals, ids)
+    assert_array_equal(found, onsets)
+    pytest.raises(ValueError, triggers_to_decimals, data[:-600 + 20], n_bits)
+    pytest.raises(ValueError, triggers_to_decimals, data[np.newaxis], n_bits)
+    pytest.raises(ValueError, triggers_to_decimals, data, [0])
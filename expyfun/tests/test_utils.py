@@ -3,8 +3,11 @@ import os
 import warnings
 
 import numpy as np
+from numpy.testing import assert_equal, assert_allclose
 
-from expyfun._utils import get_config, set_config, deprecated, _fix_audio_dims
+from expyfun._utils import (get_config, set_config, deprecated,
+                            _fix_audio_dims, _LRUCache, _AsyncWriter,
+                            running_rms, _max_running_rms)
 
 warnings.simplefilter('always')
 
@@ -83,3 +86,61 @@ def test_audio_dims():
     for n_channels in (1, 2, 3):
         with pytest.raises(ValueError, match='must have one or two dimension'):
             _fix_audio_dims(np.zeros((2, 2, 2)), n_channels)
+
+
+def test_lru_cache():
+    """Test size-bounded LRU cache."""
+    cache = _LRUCache(10)
+    cache.put('a', 1, 4)
+    cache.put('b', 2, 4)
+    assert_equal(cache.get('a'), 1)  # now b is least recently used
+    cache.put('c', 3, 4)
+    assert 'b' not in cache
+    assert_equal(len(cache), 2)
+    assert_equal(cache.size, 8)
+    assert cache.get('b') is None
+    cache.put('a', 4, 2)
+    assert_equal(cache.get('a'), 4)
+    assert_equal(cache.size, 6)
+    cache.put('d', 5, 11)  # too big
+    assert 'd' not in cache
+    cache.clear()
+    assert_equal((len(cache), cache.size), (0, 0))
+
+
+def test_async_writer():
+    """Test background record writer."""
+    written, flushes = list(), list()
+    writer = _AsyncWriter(lambda *args: written.append(args),
+                          lambda: flushes.append(len(written)),
+                          flush_size=100, timeout=10.)
+    for ii in range(3):
+        writer.put(ii, 'foo')
+    writer.commit(wait=True)  # blocks until written and flushed
+    assert_equal(written, [(0, 'foo'), (1, 'foo'), (2, 'foo')])
+    assert_equal(flushes, [3])
+    writer.put(3, 'bar')
+    writer.close()
+    assert_equal(len(written), 4)
+    assert_equal(flushes, [3, 4])
+    writer.close()  # closing twice is fine
+    writer.commit(wait=True)
+    with pytest.raises(RuntimeError, match='closed writer'):
+        writer.put(4, 'baz')
+
+
+def test_max_running_rms():
+    """Test blockwise maximum running RMS."""
+    rng = np.random.RandomState(0)
+    signal = rng.randn(2, 1000)
+    signal[1, 500:510] *= 10
+    for n_samples in (5, 10, 11, 1000):
+        for block_size in (1, 7, 65536):
+            for win_length in (1, 10):
+                want = [running_rms(x, win_length).max()
+                        for x in signal[:, :n_samples]]
+                got = _max_running_rms(signal[:, :n_samples], win_length,
+                                       block_size)
+                assert_allclose(got, want, rtol=1e-10)
+    assert_allclose(_max_running_rms(signal.astype(np.float32), 10),
+                    _max_running_rms(signal, 10), rtol=1e-5)